@@ -0,0 +1,433 @@
+#!/usr/bin/env python3
+"""
+Benchmark the stages of ``format_gbif_data.py`` on synthetic data.
+
+This script:
+
+1. Generates a synthetic Darwin Core Archive (``occurrence.txt`` and
+   ``multimedia.txt``) at a configurable scale with a Zipf-skewed species
+   distribution, or reuses an existing one.
+2. Starts one or more local HTTP servers that stand in for the image
+   hosts, with injected latency and failures.
+3. Runs the pipeline stages (load, filter, select, split, download) and
+   reports rows/s, images/s, wall time and memory per stage as JSON so
+   runs can be compared.
+"""
+
+import io
+import os
+import json
+import time
+import random
+import hashlib
+import platform
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List
+
+import numpy as np
+import pandas as pd
+
+import format_gbif_data as pipeline
+from pipeline_metrics import PipelineMetrics
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow only makes the served images decodable.
+    Image = None
+
+
+def generate_dwca(out_dir: str,
+                  num_occurrences: int,
+                  num_species: int,
+                  image_hosts: List[str],
+                  skew: float = 1.3,
+                  images_per_occurrence: float = 1.3,
+                  chunk_rows: int = 1_000_000,
+                  seed: int = 0,
+                 ) -> None:
+    """Write a synthetic ``occurrence.txt`` / ``multimedia.txt`` pair.
+
+    Species are drawn from a Zipf distribution with exponent ``skew``,
+    so a few species own most records and many have only a handful, as
+    in the Pl@ntNet export. Each occurrence gets one image plus another
+    with probability ``images_per_occurrence - 1``. About 3% of the
+    multimedia rows are non-image noise (sound records, missing URLs)
+    that :func:`format_gbif_data.filter_image_records` must drop. Rows
+    are written in chunks, so memory use does not grow with the scale.
+
+    Parameters
+    ----------
+    out_dir : str
+        Directory the two files are written to. Created if missing.
+    num_occurrences : int
+        Number of rows in ``occurrence.txt``.
+    num_species : int
+        Number of distinct scientific names to draw from.
+    image_hosts : list of str
+        Base URLs (``"http://host:port"``) the image identifiers are
+        spread over.
+    skew : float, optional
+        Exponent of the Zipf species distribution. Must be above 1.
+    images_per_occurrence : float, optional
+        Mean number of multimedia rows per occurrence, between 1 and 2.
+    chunk_rows : int, optional
+        Number of occurrences generated and written at a time.
+    seed : int, optional
+        Seed of the random generator.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    genera = np.array([f"Genus{i // 7:05d}" for i in range(num_species)], dtype=object)
+    epithets = np.array([f"epithet{i:06d}" for i in range(num_species)], dtype=object)
+    species_names = genera + " " + epithets + " (L.) Auth."
+    families = np.array([f"Family{i // 40:04d}" for i in range(num_species)], dtype=object)
+    hosts = np.array(image_hosts, dtype=object)
+
+    occ_path = os.path.join(out_dir, "occurrence.txt")
+    mm_path = os.path.join(out_dir, "multimedia.txt")
+    for path in (occ_path, mm_path):
+        if os.path.exists(path):
+            os.remove(path)
+
+    for start in range(0, num_occurrences, chunk_rows):
+        n = min(chunk_rows, num_occurrences - start)
+        gbif_ids = np.arange(start, start + n, dtype=np.int64) + 1_000_000_000
+        species = (rng.zipf(skew, n) - 1) % num_species
+
+        occurrences = pd.DataFrame({
+            "gbifID": gbif_ids,
+            "datasetKey": "7a3679ef-5582-4aaa-81f0-8c2545cafc81",
+            "license": "CC_BY_4_0",
+            "scientificName": species_names[species],
+            "family": families[species],
+            "genus": genera[species],
+            "taxonRank": "SPECIES",
+            "mediaType": "StillImage",
+        })
+        occurrences.to_csv(occ_path, sep="\t", index=False, mode="a",
+                           header=start == 0)
+
+        extra = rng.random(n) < (images_per_occurrence - 1.0)
+        mm_ids = np.concatenate([gbif_ids, gbif_ids[extra]])
+        mm_ids.sort(kind="stable")
+        m = len(mm_ids)
+        serial = np.arange(m)
+        noise = rng.random(m)
+        is_sound = noise < 0.02
+        no_url = (noise >= 0.02) & (noise < 0.03)
+
+        urls = (hosts[mm_ids % len(hosts)] + "/img/" + mm_ids.astype(str)
+                + "_" + serial.astype(str) + ".jpg")
+        urls[no_url] = ""
+        multimedia = pd.DataFrame({
+            "gbifID": mm_ids,
+            "type": np.where(is_sound, "Sound", "StillImage"),
+            "format": np.where(is_sound, "audio/mpeg", "image/jpeg"),
+            "identifier": urls,
+            "references": "https://identify.plantnet.org/",
+            "title": "synthetic",
+            "creator": "benchmark",
+            "license": "http://creativecommons.org/licenses/by/4.0/",
+        })
+        multimedia.to_csv(mm_path, sep="\t", index=False, mode="a",
+                          header=start == 0)
+
+    print(f"[info] Wrote synthetic archive with {num_occurrences} occurrences to {out_dir}.")
+
+
+def _base_image() -> bytes:
+    """Return a small JPEG used as the body of every served image."""
+    if Image is None:
+        return b"\xff\xd8\xff\xe0" + bytes(64) + b"\xff\xd9"
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), (60, 140, 60)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+class SyntheticImageServer:
+    """Local HTTP server standing in for an image host.
+
+    Every ``GET`` returns a valid JPEG padded to ``image_bytes`` with
+    JPEG comment segments. The request path is embedded in the image,
+    so every URL serves distinct content. Requests are delayed by
+    ``latency_ms`` plus up to ``jitter_ms`` of random jitter. A fraction
+    ``failure_rate`` of requests fails with HTTP 503 (retriable). A
+    deterministic fraction ``missing_rate`` of paths always returns
+    HTTP 404.
+
+    Use as a context manager; :attr:`base_url` is valid inside it.
+    """
+
+    def __init__(self,
+                 latency_ms: float = 20.0,
+                 jitter_ms: float = 10.0,
+                 failure_rate: float = 0.01,
+                 missing_rate: float = 0.005,
+                 image_bytes: int = 20_000,
+                ) -> None:
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.failure_rate = failure_rate
+        self.missing_rate = missing_rate
+        self.image_bytes = image_bytes
+        self._base_image = _base_image()
+        self._server = None
+        self._thread = None
+
+    def _make_body(self, path: str) -> bytes:
+        comment = path.encode()
+        padding = max(0, self.image_bytes - len(self._base_image) - len(comment))
+        segments = [comment] + [b"\x00" * 60_000] * (padding // 60_000) + [b"\x00" * (padding % 60_000)]
+        body = bytearray(self._base_image[:2])
+        for segment in segments:
+            body += b"\xff\xfe" + (len(segment) + 2).to_bytes(2, "big") + segment
+        body += self._base_image[2:]
+        return bytes(body)
+
+    def _handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args) -> None:
+                pass
+
+            def _reply(self, status: int, body: bytes = b"",
+                       content_type: str = "image/jpeg") -> None:
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self) -> None:
+                delay = server.latency_ms + random.random() * server.jitter_ms
+                time.sleep(delay / 1000.0)
+                digest = hashlib.blake2b(self.path.encode(), digest_size=8).digest()
+                if int.from_bytes(digest, "big") / 2 ** 64 < server.missing_rate:
+                    self._reply(404, content_type="text/plain")
+                elif random.random() < server.failure_rate:
+                    self._reply(503, content_type="text/plain")
+                else:
+                    self._reply(200, server._make_body(self.path))
+
+        return Handler
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "SyntheticImageServer":
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _measure(metrics: PipelineMetrics,
+             stages: List[dict],
+             name: str,
+             func: Callable[[], object],
+             rows_in: int,
+             count: Callable[[object], int] = len,
+            ) -> object:
+    """Run one stage, append its metrics to ``stages`` and return its output.
+
+    The stage runs under :meth:`PipelineMetrics.stage`, so its memory is
+    measured the same way as in ``format_gbif_data.py``: the RSS at
+    start and end, the peak RSS sampled while it ran and how far it
+    raised the process peak.
+    """
+    with metrics.stage(name, rows_in=rows_in) as stage:
+        result = func()
+        stage.rows_out = count(result)
+    stages.append({
+        "stage": name,
+        "rows_in": rows_in,
+        "rows_out": stage.rows_out,
+        "seconds": stage.seconds,
+        "rows_per_s": round(rows_in / stage.seconds, 1) if stage.seconds > 0 else None,
+        "rss_start_mb": stage.rss_start_mb,
+        "rss_end_mb": stage.rss_end_mb,
+        "peak_rss_mb": stage.peak_rss_mb,
+        "peak_growth_mb": stage.peak_growth_mb,
+    })
+    return result
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    """Generate data, run every stage and return the metrics report."""
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="gbif_bench_")
+    servers = [
+        SyntheticImageServer(
+            latency_ms=args.latency_ms,
+            jitter_ms=args.jitter_ms,
+            failure_rate=args.failure_rate,
+            missing_rate=args.missing_rate,
+            image_bytes=args.image_kb * 1024,
+        )
+        for _ in range(args.hosts)
+    ]
+    for server in servers:
+        server.__enter__()
+
+    try:
+        dwca_dir = args.dwca_dir
+        if dwca_dir is None:
+            dwca_dir = os.path.join(work_dir, "dwca")
+            start = time.perf_counter()
+            generate_dwca(
+                dwca_dir,
+                num_occurrences=args.rows,
+                num_species=args.species,
+                image_hosts=[server.base_url for server in servers],
+                skew=args.skew,
+                images_per_occurrence=args.images_per_occurrence,
+                seed=args.seed,
+            )
+            print(f"[bench] generate: {time.perf_counter() - start:.2f}s")
+
+        metrics = PipelineMetrics()
+        stages: List[dict] = []
+        with open(os.path.join(dwca_dir, "multimedia.txt"), "rb") as f:
+            mm_rows = sum(1 for _ in f) - 1
+        merged = _measure(metrics, stages, "load_occurrence_and_multimedia", lambda: (
+            pipeline.load_occurrence_and_multimedia(
+                dwca_dir,
+                streaming=args.streaming,
+                memory_budget_mb=args.memory_budget_mb,
+                image_records_only=args.pushdown,
+            )
+        ), rows_in=mm_rows)
+        records = _measure(metrics, stages, "filter_image_records",
+                           lambda: pipeline.filter_image_records(merged),
+                           rows_in=len(merged))
+        subset = _measure(metrics, stages, "select_balanced_subset",
+                          lambda: pipeline.select_balanced_subset(records, args.max_images),
+                          rows_in=len(records))
+        labeled = _measure(metrics, stages, "assign_splits_per_species",
+                           lambda: pipeline.assign_splits_per_species(subset),
+                           rows_in=len(subset))
+
+        if not args.skip_download:
+            output_dir = os.path.join(work_dir, "output")
+            manifest_path = os.path.join(output_dir, "model_training_data",
+                                         "download_manifest.sqlite")
+
+            def downloaded_count(_: object) -> int:
+                with pipeline.DownloadManifest(manifest_path) as manifest:
+                    summary = manifest.summary()
+                return int(summary.loc[summary["status"] == "ok", "images"].sum())
+
+            _measure(metrics, stages, "download_and_save_images", lambda: (
+                pipeline.download_and_save_images(
+                    labeled,
+                    output_dir=output_dir,
+                    workers=args.download_workers,
+                    max_per_host=args.max_per_host,
+                    retry_backoff=0.1,
+                )
+            ), rows_in=len(labeled), count=downloaded_count)
+            stages[-1]["images_per_s"] = stages[-1].pop("rows_per_s")
+    finally:
+        for server in servers:
+            server.__exit__(None, None, None)
+
+    return {
+        "run": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "cpu_count": os.cpu_count(),
+            "platform": platform.platform(),
+            "parameters": {key: value for key, value in vars(args).items()
+                           if key != "output"},
+        },
+        "stages": stages,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse command-line arguments for the benchmark.
+
+    Returns
+    -------
+    argparse.Namespace
+        Namespace containing the parsed command-line options.
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Benchmark the GBIF data preparation pipeline on a synthetic "
+            "Darwin Core Archive served by local image servers."
+        )
+    )
+    parser.add_argument("--work_dir", default=None,
+                        help="Directory for generated data and downloads. Default is a new temp dir.")
+    parser.add_argument("--dwca_dir", default=None,
+                        help=("Reuse an existing synthetic archive instead of generating one. Its image "
+                              "URLs point at the servers of the run that wrote it, so combine "
+                              "with --skip_download."))
+    parser.add_argument("--rows", type=int, default=100_000,
+                        help="Number of synthetic occurrences. Default is 100000.")
+    parser.add_argument("--species", type=int, default=5000,
+                        help="Number of distinct species. Default is 5000.")
+    parser.add_argument("--skew", type=float, default=1.3,
+                        help="Zipf exponent of the species distribution (> 1). Default is 1.3.")
+    parser.add_argument("--images_per_occurrence", type=float, default=1.3,
+                        help="Mean multimedia rows per occurrence (1 to 2). Default is 1.3.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the data generator. Default is 0.")
+    parser.add_argument("--max_images", type=int, default=1000,
+                        help="max_images passed to select_balanced_subset. Default is 1000.")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Benchmark the streaming join instead of the in-memory merge.")
+    parser.add_argument("--memory_budget_mb", type=int, default=1024,
+                        help="Memory budget of the streaming join. Default is 1024.")
+    parser.add_argument("--pushdown", action="store_true",
+                        help="Apply the image filter while reading, as format_gbif_data.py does.")
+    parser.add_argument("--skip_download", action="store_true",
+                        help="Only benchmark the pandas stages.")
+    parser.add_argument("--hosts", type=int, default=2,
+                        help="Number of local image servers. Default is 2.")
+    parser.add_argument("--latency_ms", type=float, default=20.0,
+                        help="Base latency of each image response. Default is 20.")
+    parser.add_argument("--jitter_ms", type=float, default=10.0,
+                        help="Maximum random extra latency. Default is 10.")
+    parser.add_argument("--failure_rate", type=float, default=0.01,
+                        help="Fraction of requests answered with HTTP 503. Default is 0.01.")
+    parser.add_argument("--missing_rate", type=float, default=0.005,
+                        help="Fraction of URLs that always return HTTP 404. Default is 0.005.")
+    parser.add_argument("--image_kb", type=int, default=20,
+                        help="Size of each served image in KB. Default is 20.")
+    parser.add_argument("--download_workers", type=int, default=16,
+                        help="download_workers passed to the downloader. Default is 16.")
+    parser.add_argument("--max_per_host", type=int, default=4,
+                        help="max_per_host passed to the downloader. Default is 4.")
+    parser.add_argument("--output", default=None,
+                        help="Write the JSON report to this file as well as stdout.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    """Run the benchmark and print the JSON report."""
+    args = parse_args()
+    report = run_benchmark(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,501 @@
+#!/usr/bin/env python3
+"""
+Evaluate the app's exported TFLite classifier on a downloaded split.
+
+This script:
+
+1. Lists the images of one split (``test`` by default) of the tree
+   written by ``format_gbif_data.py`` and maps each species folder to a
+   line of the app's ``labels.txt``.
+2. Decodes and resizes every image exactly as ``predict`` in
+   ``lib/model.dart`` does, in a process pool, and caches the resized
+   pixels so later evaluations skip decoding.
+3. Normalizes whole batches with ``MEAN``/``STD`` into the NCHW layout
+   the model expects and runs them through the TFLite interpreter on
+   the CPU.
+4. Reports top-1/top-5 accuracy and images/s, and optionally writes
+   them to a JSON file.
+"""
+
+import os
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from format_gbif_data import class_folder_name, sanitize_species_name
+from image_utils import MODEL_INPUT_SIZE, iter_split_images, nearest_resize
+from label_index import LabelIndex
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is only needed to decode uncached images.
+    Image = None
+
+try:
+    from ai_edge_litert.interpreter import Interpreter
+except ImportError:
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tensorflow.lite import Interpreter
+        except ImportError:  # A TFLite runtime is only needed for inference.
+            Interpreter = None
+
+
+# Match OfflinePlantService.MEAN / STD in lib/model.dart.
+MEAN = [0.485, 0.456, 0.406]
+STD = [0.229, 0.224, 0.225]
+
+# Bump when the layout of the pixel cache changes.
+_CACHE_VERSION = 1
+
+
+def _require_pillow() -> None:
+    """Raise a helpful error if Pillow is not installed."""
+    if Image is None:
+        raise ImportError(
+            "Decoding images requires Pillow. Install it with 'pip install Pillow'."
+        )
+
+
+def _require_interpreter() -> None:
+    """Raise a helpful error if no TFLite runtime is installed."""
+    if Interpreter is None:
+        raise ImportError(
+            "Running the model requires a TFLite runtime. Install it with "
+            "'pip install ai-edge-litert' (or tflite-runtime / tensorflow)."
+        )
+
+
+def _normalization_table() -> np.ndarray:
+    """Return the normalized value of every 8-bit level of every channel.
+
+    The app computes ``((v / 255.0) - MEAN[c]) / STD[c]`` in double
+    precision and stores it in a ``Float32List``. Computing the 3 x 256
+    possible results the same way and looking pixels up in the table
+    gives bit-identical inputs at the cost of a gather.
+    """
+    levels = np.arange(256, dtype=np.float64) / 255.0
+    table = (levels[None, :] - np.asarray(MEAN)[:, None]) / np.asarray(STD)[:, None]
+    return table.astype(np.float32)
+
+
+_NORMALIZATION = _normalization_table()
+
+
+def load_image_pixels(path: str, size: int = MODEL_INPUT_SIZE) -> np.ndarray:
+    """Decode an image and resize it as ``predict`` in ``lib/model.dart`` does.
+
+    ``copyResize`` of the Dart ``image`` package defaults to
+    nearest-neighbour sampling; see :func:`image_utils.nearest_resize`.
+    Like the app, EXIF orientation is not applied and alpha is dropped.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``uint8`` array of shape ``(size, size, 3)``.
+    """
+    with Image.open(path) as image:
+        pixels = np.asarray(image.convert("RGB"))
+    return nearest_resize(pixels, size)
+
+
+def _load_one(path: str, size: int) -> Tuple[Optional[np.ndarray], Optional[str]]:
+    """Worker wrapper around :func:`load_image_pixels` that reports errors."""
+    try:
+        return load_image_pixels(path, size), None
+    except Exception as exc:  # noqa: BLE001
+        return None, f"{type(exc).__name__}: {exc}"
+
+
+def preprocess_batch(pixels: np.ndarray) -> np.ndarray:
+    """Normalize a batch of RGB images into the model's NCHW float input.
+
+    Parameters
+    ----------
+    pixels : numpy.ndarray
+        ``uint8`` array of shape ``(batch, height, width, 3)``.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``float32`` array of shape ``(batch, 3, height, width)``, equal
+        to the ``Float32List`` the app builds pixel by pixel.
+    """
+    channels_first = np.ascontiguousarray(pixels.transpose(0, 3, 1, 2))
+    return np.stack(
+        [_NORMALIZATION[c][channels_first[:, c]] for c in range(3)], axis=1
+    )
+
+
+def list_split_images(data_dir: str, split: str, label_index: LabelIndex) -> pd.DataFrame:
+    """List the images of ``split`` with the class index of their folder.
+
+    Folders written with ``--labels`` (``<index>_<label>``) map to their
+    class directly; plain species folders map to the class whose
+    sanitized label equals the folder name. Images in folders that match
+    no class are left out with a warning.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Columns ``path``, ``folder``, ``class_index``, ``size`` and
+        ``mtime_ns``.
+    """
+    folder_classes: Dict[str, int] = {}
+    for i, label in enumerate(label_index.labels):
+        folder_classes.setdefault(class_folder_name(i, label), i)
+    for i, label in enumerate(label_index.labels):
+        folder_classes.setdefault(sanitize_species_name(label), i)
+
+    records = []
+    unknown = set()
+    for image_split, folder, _, path in iter_split_images(data_dir):
+        if image_split != split:
+            continue
+        if folder not in folder_classes:
+            unknown.add(folder)
+            continue
+        stat = os.stat(path)
+        records.append((path, folder, folder_classes[folder], stat.st_size, stat.st_mtime_ns))
+
+    if unknown:
+        print(f"[warning] Skipped {len(unknown)} folders that match no class, e.g. {sorted(unknown)[0]}.")
+    return pd.DataFrame.from_records(
+        records, columns=["path", "folder", "class_index", "size", "mtime_ns"])
+
+
+def load_pixel_cache(images: pd.DataFrame,
+                     cache_dir: Optional[str],
+                     name: str,
+                     size: int = MODEL_INPUT_SIZE,
+                     workers: Optional[int] = None,
+                    ) -> Tuple[np.ndarray, np.ndarray]:
+    """Return the resized pixels of ``images``, decoding only what is not cached.
+
+    The cache is a ``.npy`` array of resized ``uint8`` images (memory
+    mapped on later runs) plus a CSV keyed by path, size and
+    modification time, both named after ``name``. Entries of unchanged
+    files are reused; new or modified files are decoded in a process
+    pool of ``workers`` processes and the cache is rewritten. Each
+    ``name`` (normally the split) has its own pair, so evaluating
+    ``val`` and ``test`` in turn does not evict either cache.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        The pixels, of shape ``(n, size, size, 3)`` (the memory-mapped
+        cache itself if it holds exactly ``images``), and a boolean mask
+        of the rows of ``images`` that could be decoded.
+    """
+    keys = pd.MultiIndex.from_frame(images[["path", "size", "mtime_ns"]])
+    pixels_path = index_path = None
+    cached_pixels = None
+    cached_rows = np.full(len(images), -1, dtype=np.int64)
+    if cache_dir:
+        stem = os.path.join(cache_dir, f"{name}_{size}px_v{_CACHE_VERSION}")
+        pixels_path, index_path = stem + ".npy", stem + ".csv"
+        if os.path.exists(pixels_path) and os.path.exists(index_path):
+            cached = pd.read_csv(index_path, dtype={"path": str})
+            cached_pixels = np.load(pixels_path, mmap_mode="r")
+            cached_rows = pd.MultiIndex.from_frame(
+                cached[["path", "size", "mtime_ns"]]).get_indexer(keys)
+
+    missing = np.flatnonzero(cached_rows < 0)
+    if cached_pixels is not None and np.array_equal(cached_rows, np.arange(len(images))):
+        print(f"[info] All {len(images)} images are cached in {cache_dir}.")
+        return cached_pixels, np.ones(len(images), dtype=bool)
+    print(
+        f"[info] {len(images) - len(missing)} of {len(images)} images are cached; "
+        f"decoding {len(missing)}..."
+    )
+    pixels = np.zeros((len(images), size, size, 3), dtype=np.uint8)
+    hits = np.flatnonzero(cached_rows >= 0)
+    if len(hits):
+        pixels[hits] = cached_pixels[cached_rows[hits]]
+    ok = np.ones(len(images), dtype=bool)
+
+    if len(missing):
+        _require_pillow()
+        workers = workers or os.cpu_count() or 1
+        paths = images["path"].to_numpy()[missing]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(
+                _load_one, paths, [size] * len(paths),
+                chunksize=max(1, min(64, len(paths) // (workers * 4))),
+            )
+            for row, path, (image, error) in zip(missing, paths, results):
+                if error is not None:
+                    print(f"[warning] Could not decode {path}: {error}")
+                    ok[row] = False
+                    continue
+                pixels[row] = image
+
+    if pixels_path is not None and len(missing):
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(pixels_path + ".tmp", "wb") as f:
+            np.save(f, pixels[ok])
+        images.loc[ok, ["path", "size", "mtime_ns"]].to_csv(index_path + ".tmp", index=False)
+        os.replace(pixels_path + ".tmp", pixels_path)
+        os.replace(index_path + ".tmp", index_path)
+        print(f"[info] Cached {int(ok.sum())} preprocessed images in {cache_dir}.")
+    return pixels, ok
+
+
+class BatchedClassifier:
+    """Run a TFLite image classifier on batches of NCHW inputs.
+
+    The input tensor is resized to the batch size when the model allows
+    it; models exported with a fixed batch dimension of 1 are run one
+    image at a time. Quantized inputs and outputs are converted with
+    the tensors' scale and zero point.
+
+    Parameters
+    ----------
+    model_path : str
+        Path to the ``.tflite`` file, e.g. ``assets/model/plantnet.tflite``.
+    batch_size : int, optional
+        Number of images per interpreter call. The default is 32.
+    num_threads : int, optional
+        Number of CPU threads of the interpreter. The default is the CPU
+        count.
+    """
+
+    def __init__(self, model_path: str, batch_size: int = 32,
+                 num_threads: Optional[int] = None) -> None:
+        _require_interpreter()
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Could not find model file: {model_path}")
+        self.interpreter = Interpreter(model_path=model_path,
+                                       num_threads=num_threads or os.cpu_count() or 1)
+        self._input = self.interpreter.get_input_details()[0]
+        self.batch_size = batch_size
+        shape = list(self._input["shape"])
+        if batch_size != shape[0]:
+            try:
+                self.interpreter.resize_tensor_input(self._input["index"],
+                                                     [batch_size] + shape[1:])
+                self.interpreter.allocate_tensors()
+            except (RuntimeError, ValueError) as exc:
+                print(f"[warning] Model does not accept batches ({exc}); running one image at a time.")
+                self.batch_size = shape[0]
+                self.interpreter = Interpreter(model_path=model_path,
+                                               num_threads=num_threads or os.cpu_count() or 1)
+                self.interpreter.allocate_tensors()
+        else:
+            self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+
+    @property
+    def input_size(self) -> int:
+        """Height and width of the model input."""
+        return int(self._input["shape"][-1])
+
+    def _run(self, batch: np.ndarray) -> np.ndarray:
+        scale, zero_point = self._input["quantization"]
+        if scale:
+            batch = np.round(batch / scale + zero_point)
+        self.interpreter.set_tensor(self._input["index"], batch.astype(self._input["dtype"]))
+        self.interpreter.invoke()
+        logits = self.interpreter.get_tensor(self._output["index"])
+        scale, zero_point = self._output["quantization"]
+        if scale:
+            logits = (logits.astype(np.float32) - zero_point) * scale
+        return logits.reshape(len(batch), -1)
+
+    def predict(self, inputs: np.ndarray) -> np.ndarray:
+        """Return the logits of ``inputs`` (NCHW float32), padding the last batch."""
+        count = len(inputs)
+        if count < self.batch_size:
+            padding = np.zeros((self.batch_size - count,) + inputs.shape[1:], dtype=inputs.dtype)
+            inputs = np.concatenate([inputs, padding])
+        return self._run(inputs)[:count]
+
+
+def _iter_batches(count: int, batch_size: int) -> Iterator[slice]:
+    for start in range(0, count, batch_size):
+        yield slice(start, min(start + batch_size, count))
+
+
+def evaluate(classifier: BatchedClassifier,
+             pixels: np.ndarray,
+             class_indices: np.ndarray,
+            ) -> Tuple[dict, np.ndarray]:
+    """Run every image through ``classifier`` and score the predictions.
+
+    Returns
+    -------
+    tuple of (dict, numpy.ndarray)
+        The metrics (accuracy, timings and throughput) and the top-5
+        class indices of every image, best first.
+    """
+    top5 = np.empty((len(pixels), 5), dtype=np.int64)
+    preprocess_seconds = 0.0
+    inference_seconds = 0.0
+    for rows in _iter_batches(len(pixels), classifier.batch_size):
+        start = time.perf_counter()
+        inputs = preprocess_batch(np.asarray(pixels[rows]))
+        middle = time.perf_counter()
+        logits = classifier.predict(inputs)
+        inference_seconds += time.perf_counter() - middle
+        preprocess_seconds += middle - start
+
+        # Softmax keeps the order of the logits, so rank them directly.
+        k = min(5, logits.shape[1])
+        best = np.argpartition(-logits, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(logits, best, axis=1), axis=1, kind="stable")
+        top5[rows, :k] = np.take_along_axis(best, order, axis=1)
+        top5[rows, k:] = -1
+
+    count = len(pixels)
+    hits = top5 == class_indices[:, None]
+    total_seconds = preprocess_seconds + inference_seconds
+    metrics = {
+        "images": count,
+        "top1_accuracy": round(float(hits[:, 0].mean()), 4) if count else None,
+        "top5_accuracy": round(float(hits.any(axis=1).mean()), 4) if count else None,
+        "batch_size": classifier.batch_size,
+        "preprocess_seconds": round(preprocess_seconds, 4),
+        "inference_seconds": round(inference_seconds, 4),
+        "images_per_second": round(count / total_seconds, 1) if total_seconds else None,
+        "inference_images_per_second": (
+            round(count / inference_seconds, 1) if inference_seconds else None),
+    }
+    return metrics, top5
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse command-line arguments for the evaluation.
+
+    Returns
+    -------
+    argparse.Namespace
+        Parsed command-line arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Measure the top-1/top-5 accuracy and throughput of the app's "
+            "TFLite model on a split written by format_gbif_data.py."
+        )
+    )
+    parser.add_argument(
+        "--model",
+        required=True,
+        help="Path to the exported .tflite model, e.g. 'assets/model/plantnet.tflite'.",
+    )
+    parser.add_argument(
+        "--labels",
+        required=True,
+        help="Label file of the model, e.g. 'assets/model/labels.txt'.",
+    )
+    parser.add_argument(
+        "--data_dir",
+        required=True,
+        help=(
+            "Folder containing the train/val/test splits, e.g. "
+            "'<output_dir>/model_training_data'."
+        ),
+    )
+    parser.add_argument(
+        "--split",
+        default="test",
+        choices=["train", "val", "test"],
+        help="Split to evaluate. Default is 'test'.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=32,
+        help="Number of images per interpreter call. Default is 32.",
+    )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=None,
+        help="Number of interpreter threads. Default is the CPU count.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Number of processes decoding images. Default is the CPU count.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help=(
+            "Directory for the cache of decoded and resized images. Default "
+            "is '<data_dir>/.eval_cache'."
+        ),
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Decode every image and do not write the cache.",
+    )
+    parser.add_argument(
+        "--predictions",
+        default=None,
+        help="Optional CSV file receiving the top-5 classes of every image.",
+    )
+    parser.add_argument(
+        "--output",
+        default=None,
+        help="Optional JSON file receiving the metrics.",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    """Evaluate the model and print the metrics."""
+    args = parse_args()
+    label_index = LabelIndex.from_file(args.labels)
+    classifier = BatchedClassifier(args.model, args.batch_size, args.num_threads)
+
+    images = list_split_images(args.data_dir, args.split, label_index)
+    if images.empty:
+        raise ValueError(f"No images of known classes found in {args.data_dir}/{args.split}.")
+    cache_dir = None if args.no_cache else (
+        args.cache_dir or os.path.join(args.data_dir, ".eval_cache"))
+
+    start = time.perf_counter()
+    pixels, ok = load_pixel_cache(
+        images, cache_dir, args.split, classifier.input_size, args.workers)
+    load_seconds = time.perf_counter() - start
+    if not ok.all():
+        images = images[ok].reset_index(drop=True)
+        pixels = pixels[ok]
+
+    metrics, top5 = evaluate(classifier, pixels, images["class_index"].to_numpy())
+    metrics.update({
+        "split": args.split,
+        "classes": int(images["class_index"].nunique()),
+        "load_seconds": round(load_seconds, 4),
+    })
+    print(
+        f"[metrics] {args.split}: top-1 {metrics['top1_accuracy']:.2%}, "
+        f"top-5 {metrics['top5_accuracy']:.2%} on {metrics['images']} images of "
+        f"{metrics['classes']} classes, {metrics['images_per_second']} images/s."
+    )
+
+    if args.predictions:
+        predictions = images[["path", "class_index"]].copy()
+        for k in range(top5.shape[1]):
+            predictions[f"top{k + 1}"] = top5[:, k]
+        predictions.to_csv(args.predictions, index=False)
+        print(f"[done] Wrote predictions to {args.predictions}.")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(metrics, f, indent=2)
+        print(f"[done] Wrote metrics to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,16 +11,80 @@ This script:
    train, validation and test (3 images per species).
 5. Downloads the selected images into a ``model_training_data`` folder
    with ``train/``, ``val/``, and ``test/`` subfolders.
+6. Optionally validates the downloaded files, writes a resized copy of
+   the folder for training and packs it into sequential tar shards (see
+   ``image_utils.py``).
 """
 
+import io
 import os
 import re
+import json
+import math
+import time
+import heapq
+import pickle
+import random
+import shutil
+import sqlite3
+import hashlib
+import zipfile
 import argparse
-from typing import Optional
+import itertools
+import tempfile
+import threading
+import email.utils
+import xml.etree.ElementTree as ET
+from collections import Counter, deque
+from contextlib import contextmanager
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import (Callable, Deque, Dict, Iterable, Iterator, List, Optional,
+                    Sequence, Set, Tuple, Union)
+from urllib.parse import urlsplit
 
+import numpy as np
 import pandas as pd
 import requests
 
+from image_utils import (MODEL_INPUT_SIZE, pack_dataset, resize_dataset,
+                         validate_dataset)
+from label_index import LabelIndex
+from pipeline_metrics import PROFILERS, PipelineMetrics, ProgressReporter
+from stage_cache import Stage, StageCache, run_stages
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is only needed for the columnar cache.
+    pa = None
+    pq = None
+
+
+# Columns projected out of each Darwin Core Archive table.
+MULTIMEDIA_COLUMNS = ["gbifID", "type", "format", "identifier"]
+OCCURRENCE_COLUMNS = ["gbifID", "scientificName"]
+
+# Helper column carrying the multimedia row number through a streaming join.
+_ROW_ORDER = "_mm_row"
+
+# Columns stored dictionary-encoded in the columnar cache.
+_DICTIONARY_COLUMNS = ["scientificName", "format", "type"]
+# Bump when the layout of the columnar cache changes.
+_CACHE_VERSION = 2
+# The dtype pandas.read_csv(dtype=str) produces for text columns.
+_TEXT_DTYPE = pd.Series(dtype=str).dtype
+# Default key of the hash behind --split_method hash.
+DEFAULT_SPLIT_SALT = "identiflora"
+# Key of the hash that assigns images to --shard slices.
+_SHARD_SALT = "download-shard"
+# Key of the hash that orders the backfill reserve of every species.
+_RESERVE_SALT = "backfill-reserve"
+# Largest byte range one worker of the parallel TSV reader parses at once.
+_PARSE_RANGE_BYTES = 64 * 1024 * 1024
+
 
 def extension_from_format(format_str: str) -> str:
     """Return a file extension inferred from a MIME-type-like string.
@@ -83,9 +147,880 @@ def sanitize_species_name(name: str) -> str:
     return cleaned or "unknown_species"
 
 
+def class_folder_name(class_index: int, label: str) -> str:
+    """Return the folder name of class ``class_index`` of a label file.
+
+    The zero-padded index comes first, so sorting the folders by name
+    (as ``torchvision.datasets.ImageFolder`` and
+    :func:`image_utils.pack_dataset` do) yields the class order of the
+    label file, e.g. ``"0042_cirsium_arvense_l_scop"``.
+    """
+    return f"{class_index:04d}_{sanitize_species_name(label)}"
+
+
+def write_class_table(label_index: LabelIndex, root: str) -> Dict[str, int]:
+    """Write ``classes.csv`` mapping class indices to labels and folders.
+
+    Every class of ``label_index`` is listed, including classes without
+    images, so the table lines up with the label file. ``duplicate_of``
+    names the earlier class whose label only differs in spelling, if
+    any (see :attr:`LabelIndex.duplicate_of`).
+
+    Returns
+    -------
+    dict
+        Folder name to class index, as :func:`image_utils.pack_dataset`
+        expects it.
+    """
+    folders = [class_folder_name(i, label) for i, label in enumerate(label_index.labels)]
+    os.makedirs(root, exist_ok=True)
+    path = os.path.join(root, "classes.csv")
+    pd.DataFrame({
+        "class_index": range(len(folders)),
+        "label": label_index.labels,
+        "folder": folders,
+        "duplicate_of": pd.array(
+            [i if i >= 0 else None for i in label_index.duplicate_of], dtype="Int64"),
+    }).to_csv(path, index=False)
+    print(f"[info] Wrote {len(folders)} classes to {path}.")
+    duplicates = sum(i >= 0 for i in label_index.duplicate_of)
+    if duplicates:
+        print(f"[warning] {duplicates} classes share their normalized name with an earlier "
+              "class and only receive records spelled exactly like their label; "
+              "see the duplicate_of column.")
+    return {folder: i for i, folder in enumerate(folders)}
+
+
+@dataclass
+class ArchiveMember:
+    """A table stored inside a zipped Darwin Core Archive.
+
+    Built from the archive's ``meta.xml`` by :func:`read_dwca_meta`.
+    The member is decompressed as a stream while it is parsed, so the
+    archive never has to be extracted.
+    """
+
+    archive: str
+    member: str
+    names: Optional[List[str]] = None
+    header_lines: int = 1
+    sep: str = "\t"
+    encoding: str = "utf-8"
+    size: int = 0
+    crc: int = 0
+
+    def __str__(self) -> str:
+        return f"{self.archive}:{self.member}"
+
+
+# A table is read either from a plain file path or from a zip member.
+TableSource = Union[str, ArchiveMember]
+
+# Row types of the DwC-A tables the pipeline reads, keyed by the file
+# name used for them in an extracted archive.
+_DWCA_ROW_TYPES = {
+    "occurrence.txt": "http://rs.tdwg.org/dwc/terms/Occurrence",
+    "multimedia.txt": "http://rs.gbif.org/terms/1.0/Multimedia",
+}
+
+
+def _meta_field_names(element: ET.Element, namespace: str) -> List[str]:
+    """Column names of a ``meta.xml`` core or extension, in file order.
+
+    Each column is named after the last segment of its term URI, so
+    ``http://rs.gbif.org/terms/1.0/gbifID`` becomes ``gbifID``, matching
+    the header line GBIF writes. Repeated names get a ``.1``, ``.2``
+    suffix as :func:`pandas.read_csv` would give them, and an ID column
+    without a term is named ``gbifID``.
+    """
+    columns: Dict[int, str] = {}
+    for field in element.findall(f"{namespace}field"):
+        if field.get("index") is not None:
+            term = field.get("term", "")
+            columns[int(field.get("index"))] = re.split(r"[/#]", term)[-1]
+    for tag in ("id", "coreid"):
+        key = element.find(f"{namespace}{tag}")
+        if key is not None and int(key.get("index", 0)) not in columns:
+            columns[int(key.get("index", 0))] = "gbifID"
+
+    names: List[str] = []
+    seen: Dict[str, int] = {}
+    for index in range(max(columns) + 1 if columns else 0):
+        name = columns.get(index, f"column{index}")
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def read_dwca_meta(archive_path: str) -> Dict[str, ArchiveMember]:
+    """Locate the occurrence and multimedia tables of a zipped DwC-A.
+
+    ``meta.xml`` names the data file, delimiter, encoding, number of
+    header lines and column order of the core and of every extension.
+    The occurrence core and the multimedia extension are returned. If
+    the archive has no ``meta.xml``, members called ``occurrence.txt``
+    and ``multimedia.txt`` with a header line are used.
+
+    Parameters
+    ----------
+    archive_path : str
+        Path to the GBIF download ``.zip``.
+
+    Returns
+    -------
+    dict
+        Mapping from ``"occurrence.txt"`` / ``"multimedia.txt"`` to the
+        :class:`ArchiveMember` holding that table.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the archive lacks one of the two tables.
+    """
+    with zipfile.ZipFile(archive_path) as archive:
+        infos = {info.filename: info for info in archive.infolist()}
+        members: Dict[str, ArchiveMember] = {}
+
+        if "meta.xml" in infos:
+            root = ET.fromstring(archive.read("meta.xml"))
+            namespace = root.tag[: root.tag.index("}") + 1] if root.tag.startswith("{") else ""
+            for element in [root.find(f"{namespace}core")] + root.findall(f"{namespace}extension"):
+                if element is None:
+                    continue
+                name = next((key for key, row_type in _DWCA_ROW_TYPES.items()
+                             if element.get("rowType") == row_type), None)
+                location = element.find(f"{namespace}files/{namespace}location")
+                if name is None or location is None:
+                    continue
+                sep = element.get("fieldsTerminatedBy", "\\t")
+                members[name] = ArchiveMember(
+                    archive=archive_path,
+                    member=location.text.strip(),
+                    names=_meta_field_names(element, namespace),
+                    header_lines=int(element.get("ignoreHeaderLines", 0)),
+                    sep="\t" if sep == "\\t" else sep,
+                    encoding=element.get("encoding", "utf-8"),
+                )
+        else:
+            for name in _DWCA_ROW_TYPES:
+                if name in infos:
+                    members[name] = ArchiveMember(archive=archive_path, member=name)
+
+    for name in _DWCA_ROW_TYPES:
+        if name not in members or members[name].member not in infos:
+            raise FileNotFoundError(f"Could not find the {name} table in {archive_path}")
+        info = infos[members[name].member]
+        members[name].size = info.file_size
+        members[name].crc = info.CRC
+    return members
+
+
+@contextmanager
+def _open_table(source: TableSource) -> Iterator[Tuple[object, dict]]:
+    """Open a table for :func:`pandas.read_csv`.
+
+    Yields the path or open file to parse and the keyword arguments
+    that describe its layout.
+    """
+    if isinstance(source, str):
+        yield source, {"sep": "\t"}
+        return
+
+    kwargs = {"sep": source.sep, "encoding": source.encoding}
+    if source.names is not None:
+        kwargs["names"] = source.names
+        kwargs["header"] = 0 if source.header_lines else None
+        if source.header_lines > 1:
+            kwargs["skiprows"] = range(1, source.header_lines)
+    with zipfile.ZipFile(source.archive) as archive, archive.open(source.member) as handle:
+        yield handle, kwargs
+
+
+def _source_name(source: TableSource) -> str:
+    """Short name of a table for log messages."""
+    return source.member if isinstance(source, ArchiveMember) else os.path.basename(source)
+
+
+def _source_size(source: TableSource) -> int:
+    """Uncompressed size of a table in bytes."""
+    return source.size if isinstance(source, ArchiveMember) else os.path.getsize(source)
+
+
+def _iter_tsv_chunks(path: TableSource,
+                     usecols: List[str],
+                     nrows: Optional[int],
+                     chunksize: int,
+                    ) -> Iterator[pd.DataFrame]:
+    """Yield a Darwin Core Archive table as DataFrames of ``chunksize`` rows.
+
+    The chunks are parsed exactly like the non-streaming path
+    (tab-separated, every column as ``str``), so concatenating them
+    reproduces a single :func:`pandas.read_csv` call.
+    """
+    with _open_table(path) as (handle, layout), pd.read_csv(
+        handle,
+        dtype=str,
+        low_memory=False,
+        usecols=usecols,
+        nrows=nrows,
+        chunksize=chunksize,
+        **layout,
+    ) as reader:
+        for chunk in reader:
+            yield chunk
+
+
+def _spill_partitions(chunk: pd.DataFrame,
+                      partition_paths: List[str],
+                     ) -> None:
+    """Append the rows of ``chunk`` to spill files bucketed by ``gbifID``."""
+    hashes = pd.util.hash_pandas_object(chunk["gbifID"], index=False).to_numpy()
+    buckets = hashes % len(partition_paths)
+    for bucket, part in chunk.groupby(buckets, sort=False):
+        with open(partition_paths[bucket], "ab") as f:
+            pickle.dump(part, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load_partition(path: str) -> Optional[pd.DataFrame]:
+    """Read back every chunk appended to a spill file by :func:`_spill_partitions`."""
+    if not os.path.exists(path):
+        return None
+
+    frames = []
+    with open(path, "rb") as f:
+        while True:
+            try:
+                frames.append(pickle.load(f))
+            except EOFError:
+                break
+    return pd.concat(frames, ignore_index=True)
+
+
+def _source_fingerprint(path: TableSource) -> dict:
+    """Describe a source file well enough to notice when it changes."""
+    if isinstance(path, ArchiveMember):
+        return {
+            "file": path.member,
+            "archive": os.path.basename(path.archive),
+            "size": path.size,
+            "crc": path.crc,
+            "version": _CACHE_VERSION,
+        }
+    stat = os.stat(path)
+    return {
+        "file": os.path.basename(path),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "version": _CACHE_VERSION,
+    }
+
+
+def _file_digest(path: str) -> str:
+    """Return the SHA-256 of a small file, such as a label file."""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _require_pyarrow() -> None:
+    """Raise a helpful error if pyarrow is not installed."""
+    if pq is None:
+        raise ImportError(
+            "The columnar cache requires pyarrow. Install it with "
+            "'pip install pyarrow' or run without --cache_dir."
+        )
+
+
+def _cache_is_fresh(cache_path: str, source_path: TableSource) -> bool:
+    """Return ``True`` if ``cache_path`` was built from the current ``source_path``."""
+    if not os.path.exists(cache_path):
+        return False
+    try:
+        metadata = pq.read_schema(cache_path).metadata or {}
+    except (OSError, pa.ArrowInvalid):
+        return False
+    stored = metadata.get(b"gbif_source")
+    return stored is not None and json.loads(stored) == _source_fingerprint(source_path)
+
+
+def _write_columnar_cache(source_path: TableSource,
+                          cache_path: str,
+                          usecols: List[str],
+                          chunksize: int = 500_000,
+                         ) -> None:
+    """Convert the projected columns of a DwC-A table into a Parquet file.
+
+    Every row is kept and every column is stored as text, so reading the
+    cache returns exactly the frame the TSV reader would, including rows
+    with a missing or non-numeric ``gbifID``. The low-cardinality
+    columns in :data:`_DICTIONARY_COLUMNS` are dictionary-encoded. The
+    file is written to a temporary name and renamed into place, so an
+    interrupted ingest never leaves a cache that looks valid.
+    """
+    tmp_path = cache_path + ".tmp"
+    writer = None
+    rows = 0
+    try:
+        for chunk in _iter_tsv_chunks(source_path, usecols, None, chunksize):
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            columns = []
+            for name in table.column_names:
+                column = table[name]
+                if name in _DICTIONARY_COLUMNS:
+                    column = column.cast(pa.string()).dictionary_encode()
+                else:
+                    column = column.cast(pa.string())
+                columns.append(column)
+            table = pa.Table.from_arrays(columns, names=table.column_names)
+
+            if writer is None:
+                schema = table.schema.with_metadata({
+                    b"gbif_source": json.dumps(_source_fingerprint(source_path)).encode(),
+                })
+                writer = pq.ParquetWriter(tmp_path, schema, compression="zstd")
+            writer.write_table(table.cast(writer.schema))
+            rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None:
+        raise RuntimeError(f"No rows found in {source_path}; nothing to cache.")
+
+    os.replace(tmp_path, cache_path)
+    print(f"[info] Cached {rows} rows of {_source_name(source_path)} in {cache_path}.")
+
+
+def ingest_dwca(dwca_dir: str, cache_dir: str) -> dict:
+    """Build or refresh the columnar cache of a Darwin Core Archive.
+
+    ``occurrence.txt`` and ``multimedia.txt`` are each converted once
+    into a zstd-compressed Parquet file holding only the columns the
+    pipeline reads. A cached table is rebuilt automatically whenever
+    the size or modification time of its source file changes.
+
+    Parameters
+    ----------
+    dwca_dir : str
+        Path to the directory containing ``occurrence.txt`` and
+        ``multimedia.txt``, or to the zipped archive.
+    cache_dir : str
+        Directory in which the Parquet files are stored. It is created
+        if it does not exist.
+
+    Returns
+    -------
+    dict
+        Mapping from source file name (``"occurrence.txt"`` or
+        ``"multimedia.txt"``) to the path of its Parquet cache.
+
+    Raises
+    ------
+    ImportError
+        If pyarrow is not installed.
+    FileNotFoundError
+        If either source file cannot be found in ``dwca_dir``.
+    """
+    _require_pyarrow()
+    os.makedirs(cache_dir, exist_ok=True)
+
+    occ_path, mm_path = _dwca_table_paths(dwca_dir)
+    cache_paths = {}
+    for name, usecols, source_path in (("occurrence.txt", OCCURRENCE_COLUMNS, occ_path),
+                                       ("multimedia.txt", MULTIMEDIA_COLUMNS, mm_path)):
+        cache_path = os.path.join(cache_dir, name.replace(".txt", ".parquet"))
+        if _cache_is_fresh(cache_path, source_path):
+            print(f"[info] Columnar cache for {name} is up to date.")
+        else:
+            print(f"[info] Ingesting {name} into the columnar cache...")
+            _write_columnar_cache(source_path, cache_path, usecols)
+        cache_paths[name] = cache_path
+    return cache_paths
+
+
+def _as_text(values: pd.Series) -> pd.Series:
+    """Convert a cache column back to the dtype ``read_csv(dtype=str)`` gives."""
+    text = values.astype(object)
+    return text.where(text.notna(), np.nan).astype(_TEXT_DTYPE)
+
+
+def _iter_cached_chunks(cache_path: str,
+                        usecols: List[str],
+                        nrows: Optional[int],
+                        chunksize: Optional[int],
+                       ) -> Iterator[pd.DataFrame]:
+    """Yield projected rows of a Parquet cache as text DataFrames.
+
+    The file is memory-mapped and only the columns in ``usecols`` are
+    decoded. Dictionary-encoded columns come back as dictionaries (the
+    Arrow schema is stored alongside the data), so each distinct string
+    is materialized once. Columns come back in source-file order and with the same
+    dtype as the TSV reader, so callers cannot tell the two apart. If
+    ``chunksize`` is ``None`` the whole table is yielded at once.
+    """
+    parquet = pq.ParquetFile(cache_path, memory_map=True)
+    columns = [name for name in parquet.schema_arrow.names if name in usecols]
+
+    if chunksize is None:
+        batches = [parquet.read(columns=columns)]
+    else:
+        batches = parquet.iter_batches(batch_size=chunksize, columns=columns)
+
+    remaining = nrows
+    for batch in batches:
+        if remaining is not None:
+            if remaining <= 0:
+                break
+            batch = batch.slice(0, remaining)
+            remaining -= batch.num_rows
+        frame = batch.to_pandas()
+        yield pd.DataFrame({name: _as_text(frame[name]) for name in columns})
+
+
+def _iter_table_chunks(path: TableSource,
+                       usecols: List[str],
+                       nrows: Optional[int],
+                       chunksize: int,
+                       cache_path: Optional[str] = None,
+                      ) -> Iterator[pd.DataFrame]:
+    """Yield a DwC-A table in chunks from its columnar cache or the raw TSV."""
+    if cache_path is not None:
+        return _iter_cached_chunks(cache_path, usecols, nrows, chunksize)
+    return _iter_tsv_chunks(path, usecols, nrows, chunksize)
+
+
+def _sorted_gbif_ids(ids: pd.Series) -> Optional[np.ndarray]:
+    """Return the distinct ``gbifID``\\ s as a sorted int64 array.
+
+    Returns ``None`` if any ID is not an integer, in which case rows
+    cannot be pruned by numeric lookup.
+    """
+    numeric = pd.to_numeric(ids, errors="coerce")
+    if numeric.isna().any() or not pd.api.types.is_integer_dtype(numeric):
+        return None
+    return np.unique(numeric.to_numpy(dtype=np.int64))
+
+
+def _gbif_id_mask(ids: pd.Series, keep_ids: np.ndarray) -> np.ndarray:
+    """Boolean mask of the rows whose ``gbifID`` may be in ``keep_ids``.
+
+    IDs are compared numerically by binary search in the sorted array.
+    The test is conservative: IDs that do not parse as integers are
+    kept, and the string join that follows decides the exact match.
+    """
+    numeric = pd.to_numeric(ids, errors="coerce")
+    valid = numeric.notna().to_numpy()
+    mask = np.ones(len(ids), dtype=bool)
+    if len(keep_ids) == 0:
+        mask[valid] = False
+        return mask
+    values = numeric[valid].to_numpy(dtype=np.int64)
+    pos = np.minimum(np.searchsorted(keep_ids, values), len(keep_ids) - 1)
+    mask[valid] = keep_ids[pos] == values
+    return mask
+
+
+def _label_occurrences(table: pd.DataFrame, label_index: LabelIndex) -> pd.DataFrame:
+    """Keep the occurrences of the classes in ``label_index`` and label them.
+
+    ``scientificName`` is replaced by the matched class label, so every
+    spelling of a class is treated as one species downstream. The GBIF
+    name is kept as ``sourceScientificName`` and the class index is
+    added as ``class_index``.
+    """
+    indices = label_index.match(table["scientificName"])
+    keep = indices >= 0
+    labeled = table[keep].rename(columns={"scientificName": "sourceScientificName"})
+    labeled["scientificName"] = pd.Series(
+        np.asarray(label_index.labels, dtype=object)[indices[keep]],
+        index=labeled.index, dtype=_TEXT_DTYPE,
+    )
+    labeled["class_index"] = indices[keep]
+    return labeled
+
+
+def _prune_rows(table: pd.DataFrame,
+                keep_ids: Optional[np.ndarray],
+                label_index: Optional[LabelIndex],
+               ) -> pd.DataFrame:
+    """Apply the ``keep_ids`` and ``label_index`` filters of :func:`_read_table`."""
+    if keep_ids is not None:
+        table = table[_gbif_id_mask(table["gbifID"], keep_ids)]
+    if label_index is not None:
+        table = _label_occurrences(table, label_index)
+    return table
+
+
+def _read_image_records(path: TableSource,
+                        nrows: Optional[int],
+                        chunksize: int,
+                        cache_path: Optional[str] = None,
+                        keep_ids: Optional[np.ndarray] = None,
+                       ) -> pd.DataFrame:
+    """Read ``multimedia.txt``, keeping only rows that pass the image filter.
+
+    The predicates of :func:`filter_image_records` are applied to every
+    chunk as it is read, so rejected rows are never accumulated. If
+    ``keep_ids`` is given, rows are also pruned with :func:`_gbif_id_mask`.
+    """
+    parts = [
+        _prune_rows(chunk[_image_record_mask(chunk).to_numpy()], keep_ids, None)
+        for chunk in _iter_table_chunks(path, MULTIMEDIA_COLUMNS, nrows, chunksize, cache_path)
+    ]
+    if not parts:
+        return pd.DataFrame({col: pd.Series(dtype=str) for col in MULTIMEDIA_COLUMNS})
+    return pd.concat(parts, ignore_index=True)
+
+
+def _newline_ranges(path: str, workers: int) -> Tuple[bytes, List[Tuple[int, int]]]:
+    """Split a text file into byte ranges that start and end on line breaks.
+
+    Returns the header line and the ``(start, end)`` ranges covering the
+    rest of the file. Ranges are sized so that each worker gets several,
+    which balances uneven parse times.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        header = f.readline()
+        body_start = f.tell()
+        range_bytes = min(_PARSE_RANGE_BYTES,
+                          max(1024 * 1024, (size - body_start) // (workers * 4) + 1))
+
+        bounds = [body_start]
+        while bounds[-1] < size:
+            f.seek(bounds[-1] + range_bytes)
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    return header, list(zip(bounds[:-1], bounds[1:]))
+
+
+def _parse_tsv_range(path: str,
+                     start: int,
+                     end: int,
+                     names: List[str],
+                     usecols: List[str],
+                     keep_ids_path: Optional[str] = None,
+                     label_index: Optional[LabelIndex] = None,
+                    ) -> Optional[pd.DataFrame]:
+    """Parse the rows in bytes ``[start, end)`` of a headered TSV file.
+
+    Returns ``None`` if the range contains a field that starts with a
+    quote, since a quoted field may span a line break and could then be
+    cut in two by the range boundaries. If ``keep_ids_path`` names a
+    ``.npy`` file of sorted IDs, rows are pruned with
+    :func:`_gbif_id_mask`, and with ``label_index`` only labeled
+    occurrences (see :func:`_label_occurrences`) are returned.
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    if data.startswith(b'"') or b'\t"' in data or b'\n"' in data:
+        return None
+    table = pd.read_csv(
+        io.BytesIO(data),
+        sep="\t",
+        dtype=str,
+        low_memory=False,
+        header=None,
+        names=names,
+        usecols=usecols,
+    )
+    keep_ids = None if keep_ids_path is None else np.load(keep_ids_path, mmap_mode="r")
+    return _prune_rows(table, keep_ids, label_index)
+
+
+def _read_tsv_parallel(path: str,
+                       usecols: List[str],
+                       workers: int,
+                       keep_ids: Optional[np.ndarray] = None,
+                       label_index: Optional[LabelIndex] = None,
+                      ) -> Optional[pd.DataFrame]:
+    """Parse a whole TSV table on ``workers`` processes.
+
+    The file is cut into newline-aligned byte ranges that are parsed
+    independently with the same settings as the serial
+    :func:`pandas.read_csv` call and concatenated in file order, so the
+    result is identical to the serial read. Returns ``None`` when that
+    cannot be guaranteed (quoted fields, an unusual header), in which
+    case the caller should read the file serially. ``keep_ids`` is
+    shared with the workers through a memory-mapped ``.npy`` file and,
+    like ``label_index``, prunes rows as in :func:`_read_table`.
+    """
+    header, ranges = _newline_ranges(path, workers)
+    names = header.decode("utf-8-sig").rstrip("\r\n").split("\t")
+    if b'"' in header or len(set(names)) != len(names) or not set(usecols) <= set(names):
+        return None
+    if not ranges:
+        return None
+
+    print(f"[info] Parsing {_source_name(path)} in {len(ranges)} ranges on {workers} processes...")
+    keep_ids_path = None
+    try:
+        if keep_ids is not None:
+            fd, keep_ids_path = tempfile.mkstemp(suffix=".npy", prefix="gbif_ids_")
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, keep_ids)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(
+                _parse_tsv_range,
+                itertools.repeat(path),
+                [start for start, _ in ranges],
+                [end for _, end in ranges],
+                itertools.repeat(names),
+                itertools.repeat(usecols),
+                itertools.repeat(keep_ids_path),
+                itertools.repeat(label_index),
+            ))
+    finally:
+        if keep_ids_path is not None:
+            os.remove(keep_ids_path)
+    if any(part is None for part in parts):
+        print(f"[info] {_source_name(path)} has quoted fields; parsing it serially.")
+        return None
+    return pd.concat(parts, ignore_index=True)
+
+
+def _read_table(path: TableSource,
+                usecols: List[str],
+                nrows: Optional[int],
+                cache_path: Optional[str] = None,
+                workers: int = 1,
+                keep_ids: Optional[np.ndarray] = None,
+                chunksize: int = 100_000,
+                label_index: Optional[LabelIndex] = None,
+               ) -> pd.DataFrame:
+    """Read a whole DwC-A table from its columnar cache or the raw TSV.
+
+    With ``workers > 1``, no row limit and an uncompressed file, the TSV
+    is parsed in parallel by :func:`_read_tsv_parallel`. If ``keep_ids`` (a sorted int64
+    array) or ``label_index`` is given, the table is read in chunks of
+    ``chunksize`` rows and only rows whose ``gbifID`` may be in
+    ``keep_ids`` (see :func:`_gbif_id_mask`) and whose ``scientificName``
+    is one of the classes (see :func:`_label_occurrences`) are kept.
+    """
+    pruned = keep_ids is not None or label_index is not None
+    if cache_path is not None:
+        table = next(_iter_cached_chunks(cache_path, usecols, nrows, None))
+        if pruned:
+            table = _prune_rows(table, keep_ids, label_index).reset_index(drop=True)
+        return table
+    if workers > 1 and nrows is None and isinstance(path, str):
+        table = _read_tsv_parallel(path, usecols, workers, keep_ids, label_index)
+        if table is not None:
+            return table
+    if pruned:
+        parts = [
+            _prune_rows(chunk, keep_ids, label_index)
+            for chunk in _iter_tsv_chunks(path, usecols, nrows, chunksize)
+        ]
+        if parts:
+            return pd.concat(parts, ignore_index=True)
+    with _open_table(path) as (handle, layout):
+        return pd.read_csv(
+            handle,
+            dtype=str,
+            low_memory=False,
+            usecols=usecols,
+            nrows=nrows,
+            **layout,
+        )
+
+
+def _iter_streaming_merge(mm_path: TableSource,
+                          occ_path: TableSource,
+                          max_multimedia_rows: Optional[int],
+                          max_occurrence_rows: Optional[int],
+                          memory_budget_mb: int,
+                          chunksize: int,
+                          spill_dir: Optional[str] = None,
+                          cache_paths: Optional[dict] = None,
+                          image_records_only: bool = False,
+                          label_index: Optional[LabelIndex] = None,
+                         ) -> Iterator[pd.DataFrame]:
+    """Hash-join ``multimedia.txt`` onto ``occurrence.txt`` chunk by chunk.
+
+    The projected occurrence table is the build side of the join. It is
+    kept in memory for as long as it fits in ``memory_budget_mb``. Once
+    it outgrows the budget, both tables are hash-partitioned on
+    ``gbifID`` into spill files under ``spill_dir`` and joined one
+    partition at a time (a grace hash join), so only a single partition
+    has to be resident at once.
+
+    Every yielded chunk carries an extra ``_mm_row`` column holding the
+    row number of the multimedia record, which lets the caller restore
+    the row order :func:`pandas.merge` would have produced. If
+    ``cache_paths`` is given, the tables are read from their columnar
+    cache instead of the raw TSV files. With ``image_records_only``,
+    multimedia rows failing the predicates of
+    :func:`filter_image_records` are dropped before the join. With
+    ``label_index``, occurrences outside the label set are dropped as
+    they are read (see :func:`_label_occurrences`).
+    """
+    cache_paths = cache_paths or {}
+    budget_bytes = max(memory_budget_mb, 1) * 1024 * 1024
+    build_chunks = []
+    build_bytes = 0
+    spill_root = None
+    occ_parts: List[str] = []
+    mm_parts: List[str] = []
+
+    try:
+        for chunk in _iter_table_chunks(occ_path, OCCURRENCE_COLUMNS,
+                                        max_occurrence_rows, chunksize,
+                                        cache_paths.get("occurrence.txt")):
+            if label_index is not None:
+                chunk = _label_occurrences(chunk, label_index)
+            if spill_root is not None:
+                _spill_partitions(chunk, occ_parts)
+                continue
+
+            build_chunks.append(chunk)
+            build_bytes += int(chunk.memory_usage(deep=True).sum())
+            if build_bytes <= budget_bytes:
+                continue
+
+            # The raw file size is a generous upper bound on the size of
+            # the two projected columns, so this partition count keeps
+            # each partition comfortably under the budget.
+            num_partitions = max(8, math.ceil(_source_size(occ_path) / budget_bytes))
+            num_partitions = min(num_partitions, 4096)
+            spill_root = tempfile.mkdtemp(prefix="gbif_join_", dir=spill_dir)
+            occ_parts = [os.path.join(spill_root, f"occ_{i:04d}.pkl")
+                         for i in range(num_partitions)]
+            mm_parts = [os.path.join(spill_root, f"mm_{i:04d}.pkl")
+                        for i in range(num_partitions)]
+            print(
+                f"[info] occurrence.txt exceeds the {memory_budget_mb} MB memory "
+                f"budget; spilling into {num_partitions} partitions under {spill_root}."
+            )
+            for pending in build_chunks:
+                _spill_partitions(pending, occ_parts)
+            build_chunks = []
+
+        row_offset = 0
+        mm_chunks = _iter_table_chunks(mm_path, MULTIMEDIA_COLUMNS,
+                                       max_multimedia_rows, chunksize,
+                                       cache_paths.get("multimedia.txt"))
+
+        if spill_root is None:
+            if build_chunks:
+                build = pd.concat(build_chunks, ignore_index=True)
+            else:
+                build = pd.DataFrame({col: pd.Series(dtype=str) for col in OCCURRENCE_COLUMNS})
+            build_chunks = []
+
+            for chunk in mm_chunks:
+                chunk[_ROW_ORDER] = np.arange(row_offset, row_offset + len(chunk))
+                row_offset += len(chunk)
+                if image_records_only:
+                    chunk = chunk[_image_record_mask(chunk).to_numpy()]
+                merged = pd.merge(chunk, build, on="gbifID", how="inner")
+                if not merged.empty:
+                    yield merged
+            return
+
+        for chunk in mm_chunks:
+            chunk[_ROW_ORDER] = np.arange(row_offset, row_offset + len(chunk))
+            row_offset += len(chunk)
+            if image_records_only:
+                chunk = chunk[_image_record_mask(chunk).to_numpy()]
+            _spill_partitions(chunk, mm_parts)
+
+        for occ_part, mm_part in zip(occ_parts, mm_parts):
+            occ_df = _load_partition(occ_part)
+            mm_df = _load_partition(mm_part)
+            if occ_df is None or mm_df is None:
+                continue
+            merged = pd.merge(mm_df, occ_df, on="gbifID", how="inner")
+            if not merged.empty:
+                yield merged
+    finally:
+        if spill_root is not None:
+            shutil.rmtree(spill_root, ignore_errors=True)
+
+
+def _dwca_table_paths(dwca_dir: str) -> Tuple[TableSource, TableSource]:
+    """Return the sources of ``occurrence.txt`` and ``multimedia.txt``.
+
+    ``dwca_dir`` is either an extracted archive directory or the zipped
+    archive itself (see :func:`read_dwca_meta`).
+
+    Raises
+    ------
+    FileNotFoundError
+        If either file is missing from ``dwca_dir``.
+    """
+    if os.path.isfile(dwca_dir) and zipfile.is_zipfile(dwca_dir):
+        members = read_dwca_meta(dwca_dir)
+        return members["occurrence.txt"], members["multimedia.txt"]
+
+    occ_path = os.path.join(dwca_dir, "occurrence.txt")
+    mm_path = os.path.join(dwca_dir, "multimedia.txt")
+
+    if not os.path.exists(occ_path):
+        raise FileNotFoundError(f"Could not find occurrence file: {occ_path}")
+    if not os.path.exists(mm_path):
+        raise FileNotFoundError(f"Could not find multimedia file: {mm_path}")
+    return occ_path, mm_path
+
+
+def iter_occurrence_and_multimedia(dwca_dir: str,
+                                   max_multimedia_rows: Optional[int] = None,
+                                   max_occurrence_rows: Optional[int] = None,
+                                   memory_budget_mb: int = 1024,
+                                   chunksize: int = 100_000,
+                                   spill_dir: Optional[str] = None,
+                                   cache_dir: Optional[str] = None,
+                                   image_records_only: bool = False,
+                                   label_index: Optional[LabelIndex] = None,
+                                  ) -> Iterator[pd.DataFrame]:
+    """Yield the merged tables chunk by chunk without concatenating them.
+
+    Takes the same arguments as :func:`load_occurrence_and_multimedia`
+    in streaming mode. The chunks come out of the streaming hash join
+    in no particular order and carry its ``_mm_row`` column; their
+    union is the merged table.
+
+    Raises
+    ------
+    FileNotFoundError
+        If either ``occurrence.txt`` or ``multimedia.txt`` cannot be
+        found in ``dwca_dir``.
+    """
+    occ_path, mm_path = _dwca_table_paths(dwca_dir)
+    cache_paths = ingest_dwca(dwca_dir, cache_dir) if cache_dir else {}
+    print(
+        "[info] Streaming join of multimedia.txt and occurrence.txt on gbifID "
+        f"(memory budget {memory_budget_mb} MB)..."
+    )
+    yield from _iter_streaming_merge(
+        mm_path,
+        occ_path,
+        max_multimedia_rows=max_multimedia_rows,
+        max_occurrence_rows=max_occurrence_rows,
+        memory_budget_mb=memory_budget_mb,
+        chunksize=chunksize,
+        spill_dir=spill_dir,
+        cache_paths=cache_paths,
+        image_records_only=image_records_only,
+        label_index=label_index,
+    )
+
+
 def load_occurrence_and_multimedia(dwca_dir: str,
                                    max_multimedia_rows: Optional[int] = None,
                                    max_occurrence_rows: Optional[int] = None,
+                                   streaming: bool = False,
+                                   memory_budget_mb: int = 1024,
+                                   chunksize: int = 100_000,
+                                   spill_dir: Optional[str] = None,
+                                   cache_dir: Optional[str] = None,
+                                   parse_workers: int = 1,
+                                   image_records_only: bool = False,
+                                   label_index: Optional[LabelIndex] = None,
                                   ) -> pd.DataFrame:
     """Load and merge ``occurrence.txt`` and ``multimedia.txt`` using pandas.
 
@@ -97,7 +1032,10 @@ def load_occurrence_and_multimedia(dwca_dir: str,
     ----------
     dwca_dir : str
         Path to the directory containing ``occurrence.txt`` and
-        ``multimedia.txt``.
+        ``multimedia.txt``, or to the zipped archive. A zip is read
+        without extraction: ``meta.xml`` locates the two tables and
+        their column order, and only those members are decompressed, as
+        a stream (see :func:`read_dwca_meta`).
 #must make these match: 
 {
     max_multimedia_rows : int, optional
@@ -109,6 +1047,50 @@ def load_occurrence_and_multimedia(dwca_dir: str,
         ``nrows`` argument of :func:`pandas.read_csv`. If ``None``, all
         rows are read.
 }
+    streaming : bool, optional
+        If ``True``, read both tables in chunks of ``chunksize`` rows
+        and hash-join them on ``gbifID`` under ``memory_budget_mb``,
+        spilling hash partitions to disk when the occurrence side does
+        not fit. The result is identical to the in-memory merge. The
+        default is ``False``.
+    memory_budget_mb : int, optional
+        Memory budget (in megabytes) for the in-memory side of the
+        streaming join. Only used when ``streaming`` is ``True``. The
+        default is 1024.
+    chunksize : int, optional
+        Number of rows per chunk in streaming mode. The default is
+        100000.
+    spill_dir : str, optional
+        Directory in which the streaming join creates its temporary
+        spill files. If ``None``, the system temporary directory is
+        used.
+    cache_dir : str, optional
+        Directory holding the columnar (Parquet) cache built by
+        :func:`ingest_dwca`. If given, the cache is created or refreshed
+        as needed and both tables are read from it through a memory map
+        instead of being parsed from the TSV files. Requires pyarrow.
+    parse_workers : int, optional
+        Number of processes that parse ``occurrence.txt`` in parallel,
+        each taking newline-aligned byte ranges of the file. The result
+        is identical to the serial parse. Only used without streaming,
+        cache or ``max_occurrence_rows``, and for files without quoted
+        fields. The default is 1 (serial).
+    image_records_only : bool, optional
+        If ``True``, apply the predicates of :func:`filter_image_records`
+        while ``multimedia.txt`` is read, and only materialize the
+        occurrences whose ``gbifID`` matches a surviving multimedia row
+        (looked up in a sorted integer array). The result equals
+        ``filter_image_records`` applied to the full merge, except that
+        missing values are not yet filled and the index is not reset. The
+        default is ``False``.
+    label_index : LabelIndex, optional
+        Classes of the app's classifier (see ``label_index.py``). If
+        given, occurrences whose ``scientificName`` matches none of the
+        classes are dropped while ``occurrence.txt`` is read, and with
+        ``image_records_only`` only their multimedia rows are kept.
+        ``scientificName`` then holds the class label, the GBIF name
+        moves to ``sourceScientificName`` and ``class_index`` holds the
+        line number of the class in the label file.
 
     Returns
     -------
@@ -124,38 +1106,76 @@ def load_occurrence_and_multimedia(dwca_dir: str,
         found in ``dwca_dir``.
     RuntimeError
         If the merged DataFrame is empty (e.g., due to too strict
-        ``nrows`` limits or mismatched ``gbifID`` values).
+        ``nrows`` limits, mismatched ``gbifID`` values or no record of
+        any class in ``label_index``).
+    ImportError
+        If ``cache_dir`` is given but pyarrow is not installed.
     """
-    occ_path = os.path.join(dwca_dir, "occurrence.txt")
-    mm_path = os.path.join(dwca_dir, "multimedia.txt")
+    occ_path, mm_path = _dwca_table_paths(dwca_dir)
+    # In streaming mode iter_occurrence_and_multimedia refreshes the cache.
+    cache_paths = ingest_dwca(dwca_dir, cache_dir) if cache_dir and not streaming else {}
 
-    if not os.path.exists(occ_path):
-        raise FileNotFoundError(f"Could not find occurrence file: {occ_path}")
-    if not os.path.exists(mm_path):
-        raise FileNotFoundError(f"Could not find multimedia file: {mm_path}")
+    if streaming:
+        parts = list(iter_occurrence_and_multimedia(
+            dwca_dir,
+            max_multimedia_rows=max_multimedia_rows,
+            max_occurrence_rows=max_occurrence_rows,
+            memory_budget_mb=memory_budget_mb,
+            chunksize=chunksize,
+            spill_dir=spill_dir,
+            cache_dir=cache_dir,
+            image_records_only=image_records_only,
+            label_index=label_index,
+        ))
+        if parts:
+            merged = (
+                pd.concat(parts, ignore_index=True)
+                .sort_values(_ROW_ORDER, kind="stable")
+                .drop(columns=_ROW_ORDER)
+                .reset_index(drop=True)
+            )
+        else:
+            merged = pd.DataFrame()
+    elif image_records_only and label_index is not None:
+        # The label set is the more selective filter, so occurrence.txt
+        # is read first and prunes multimedia.txt by gbifID.
+        print("[info] Reading occurrences of the label set from occurrence.txt with pandas...")
+        occ_df = _read_table(occ_path, OCCURRENCE_COLUMNS, max_occurrence_rows,
+                             cache_paths.get("occurrence.txt"), workers=parse_workers,
+                             chunksize=chunksize, label_index=label_index)
+        keep_ids = _sorted_gbif_ids(occ_df["gbifID"])
 
-    print("[info] Reading multimedia.txt with pandas...")
-    mm_df = pd.read_csv(
-        mm_path,
-        sep="\t",
-        dtype=str,
-        low_memory=False,
-        usecols=["gbifID", "type", "format", "identifier"],
-        nrows=max_multimedia_rows,
-    )
+        print("[info] Reading matching image records from multimedia.txt with pandas...")
+        mm_df = _read_image_records(mm_path, max_multimedia_rows, chunksize,
+                                    cache_paths.get("multimedia.txt"), keep_ids)
 
-    print("[info] Reading occurrence.txt with pandas...")
-    occ_df = pd.read_csv(
-        occ_path,
-        sep="\t",
-        dtype=str,
-        low_memory=False,
-        usecols=["gbifID", "scientificName"],
-        nrows=max_occurrence_rows,
-    )
+        print("[info] Merging multimedia and occurrence on gbifID...")
+        merged = pd.merge(mm_df, occ_df, on="gbifID", how="inner")
+    elif image_records_only:
+        print("[info] Reading image records from multimedia.txt with pandas...")
+        mm_df = _read_image_records(mm_path, max_multimedia_rows, chunksize,
+                                    cache_paths.get("multimedia.txt"))
+        keep_ids = _sorted_gbif_ids(mm_df["gbifID"])
+
+        print("[info] Reading matching rows of occurrence.txt with pandas...")
+        occ_df = _read_table(occ_path, OCCURRENCE_COLUMNS, max_occurrence_rows,
+                             cache_paths.get("occurrence.txt"), workers=parse_workers,
+                             keep_ids=keep_ids, chunksize=chunksize)
+
+        print("[info] Merging multimedia and occurrence on gbifID...")
+        merged = pd.merge(mm_df, occ_df, on="gbifID", how="inner")
+    else:
+        print("[info] Reading multimedia.txt with pandas...")
+        mm_df = _read_table(mm_path, MULTIMEDIA_COLUMNS, max_multimedia_rows,
+                            cache_paths.get("multimedia.txt"))
 
-    print("[info] Merging multimedia and occurrence on gbifID...")
-    merged = pd.merge(mm_df, occ_df, on="gbifID", how="inner")
+        print("[info] Reading occurrence.txt with pandas...")
+        occ_df = _read_table(occ_path, OCCURRENCE_COLUMNS, max_occurrence_rows,
+                             cache_paths.get("occurrence.txt"), workers=parse_workers,
+                             chunksize=chunksize, label_index=label_index)
+
+        print("[info] Merging multimedia and occurrence on gbifID...")
+        merged = pd.merge(mm_df, occ_df, on="gbifID", how="inner")
 
     if merged.empty:
         raise RuntimeError(
@@ -164,9 +1184,29 @@ def load_occurrence_and_multimedia(dwca_dir: str,
         )
 
     print(f"[info] Merged dataframe has {len(merged)} rows.")
+    if label_index is not None:
+        print(
+            f"[info] {merged['class_index'].nunique()} of {len(label_index)} classes "
+            "have records in the archive."
+        )
     return merged
 
 
+def _image_record_mask(df: pd.DataFrame) -> pd.Series:
+    """Boolean mask of the rows :func:`filter_image_records` keeps.
+
+    Missing values count as empty strings.
+    """
+    identifier = df["identifier"].fillna("")
+    fmt = df["format"].fillna("").str.lower()
+    type_lower = df["type"].fillna("").str.lower()
+
+    mask_has_url = identifier.str.startswith("http")
+    mask_image_format = fmt.str.startswith("image/")
+    mask_type = (type_lower == "stillimage") | (type_lower == "image") | (type_lower == "")
+    return mask_has_url & mask_image_format & mask_type
+
+
 def filter_image_records(df: pd.DataFrame) -> pd.DataFrame:
     """Filter merged records down to rows that look like valid images.
 
@@ -199,15 +1239,8 @@ def filter_image_records(df: pd.DataFrame) -> pd.DataFrame:
     if missing:
         raise ValueError(f"Input DataFrame is missing required columns: {missing}")
 
-    df = df.copy()
-    df = df.fillna("")
-
-    mask_has_url = df["identifier"].str.startswith("http")
-    mask_image_format = df["format"].str.lower().str.startswith("image/")
-    type_lower = df["type"].str.lower()
-    mask_type = (type_lower == "stillimage") | (type_lower == "image") | (type_lower == "")
-
-    filtered = df[mask_has_url & mask_image_format & mask_type].reset_index(drop=True)
+    # Only the surviving rows are copied and have missing values filled.
+    filtered = df[_image_record_mask(df).to_numpy()].fillna("").reset_index(drop=True)
 
     if filtered.empty:
         raise ValueError(
@@ -219,7 +1252,45 @@ def filter_image_records(df: pd.DataFrame) -> pd.DataFrame:
     return filtered
 
 
-def select_balanced_subset(df: pd.DataFrame, max_images: int) -> pd.DataFrame:
+def _within_group_shuffle_rank(keys: pd.Series, random_state: int = 42) -> np.ndarray:
+    """Rank rows within their group as ``group.sample(frac=1.0)`` would order them.
+
+    For every group of equal ``keys`` (taken in the current row order),
+    the returned array holds each row's position in the shuffled group
+    that ``group.sample(frac=1.0, random_state=random_state)`` produces.
+    The shuffle only depends on the group size, so one permutation is
+    drawn per distinct size instead of one ``sample`` call per group.
+
+    Parameters
+    ----------
+    keys : pandas.Series
+        Group labels, one per row. Must not contain missing values.
+    random_state : int, optional
+        Seed passed to :class:`numpy.random.RandomState`, matching the
+        ``random_state`` argument of :meth:`pandas.DataFrame.sample`.
+
+    Returns
+    -------
+    numpy.ndarray
+        Integer rank of each row within its group, starting at zero.
+    """
+    position = keys.groupby(keys, sort=False).cumcount().to_numpy()
+    sizes = keys.map(keys.value_counts()).to_numpy()
+
+    rank = np.empty(len(keys), dtype=np.int64)
+    for size, rows in pd.Series(sizes).groupby(sizes).indices.items():
+        size = int(size)
+        perm = np.random.RandomState(random_state).choice(size, size=size, replace=False)
+        inverse = np.empty(size, dtype=np.int64)
+        inverse[perm] = np.arange(size)
+        rank[rows] = inverse[position[rows]]
+    return rank
+
+
+def select_balanced_subset(df: pd.DataFrame,
+                           max_images: int,
+                           max_per_species: Optional[int] = None,
+                          ) -> pd.DataFrame:
     """Select a subset where all species have enough images for splitting.
 
     The goal of this function is to construct a subset of the data in
@@ -237,6 +1308,11 @@ def select_balanced_subset(df: pd.DataFrame, max_images: int) -> pd.DataFrame:
     has exactly three images. Some species may have more images than
     others, as long as they have at least three.
 
+    Species are visited in sorted-name order and each takes as many of
+    its (shuffled) images as the remaining budget allows. The selection
+    is computed with a single group-wise ranking of the shuffled table
+    rather than one boolean scan per species.
+
     Parameters
     ----------
     df : pandas.DataFrame
@@ -246,6 +1322,10 @@ def select_balanced_subset(df: pd.DataFrame, max_images: int) -> pd.DataFrame:
         Maximum total number of images to include in the final subset.
         Because each species must contribute at least three images,
         the function can include at most ``max_images // 3`` species.
+    max_per_species : int, optional
+        Maximum number of images any single species may contribute. Use
+        this to keep species with very many images from taking the whole
+        budget. If ``None`` (the default), species are not capped.
 
     Returns
     -------
@@ -257,8 +1337,8 @@ def select_balanced_subset(df: pd.DataFrame, max_images: int) -> pd.DataFrame:
     Raises
     ------
     ValueError
-        If ``max_images`` is less than 3 or if no species have at least
-        three images.
+        If ``max_images`` or ``max_per_species`` is less than 3 or if no
+        species have at least three images.
     ValueError
         If input df does not contain a ``"scientificName"`` column.
     """
@@ -267,64 +1347,49 @@ def select_balanced_subset(df: pd.DataFrame, max_images: int) -> pd.DataFrame:
             "max_images must be at least 3 so each selected species can "
             "contribute one image to train, val, and test."
         )
+    if max_per_species is not None and max_per_species < 3:
+        raise ValueError(
+            "max_per_species must be at least 3 so each selected species can "
+            "contribute one image to train, val, and test."
+        )
 
     if "scientificName" not in df.columns:
         raise ValueError("Input DataFrame must contain a 'scientificName' column.")
 
-    df = df.copy()
     # Global shuffle for reproducibility and to avoid always picking
     # the same rows when you change nrows or max_images.
     df = df.sample(frac=1.0, random_state=42).reset_index(drop=True)
 
     # Count how many images each species has.
     species_counts = df["scientificName"].value_counts()
-    # Only species with at least 3 images are eligible.
-    # eligible_species is a list of the scientific names of plants with >=3 occurences with images
-    eligible_species = species_counts[species_counts >= 3].index.tolist()
+    # Only species with at least 3 images are eligible, visited in
+    # sorted-name order.
+    eligible = species_counts[species_counts >= 3].sort_index()
 
-    if not eligible_species:
+    if eligible.empty:
         raise ValueError(
             "No species have at least three images. Cannot create splits "
             "where every species appears in train/val/test."
         )
 
-    selected_groups = []
-    total_selected = 0
-
-    # Iterate deterministically by sorted species name.
-    for species in sorted(eligible_species):
-        # All rows for this species in the shuffled df.
-        group = df[df["scientificName"] == species]
-
-        remaining_capacity = max_images - total_selected
-        # If we can't fit at least 3 more images, we can't add a new species.
-        if remaining_capacity < 3:
-            break
-
-        # We can take up to all images for this species, but we must
-        # not exceed remaining_capacity.
-        take_n = min(len(group), remaining_capacity)
-        if take_n < 3:
-            # This shouldn't happen given species_counts >= 3 and
-            # remaining_capacity >= 3, but guard just in case.
-            continue
-
-        # Shuffle within the species to avoid always picking the
-        # same first N rows.
-        group_shuffled = group.sample(frac=1.0, random_state=42)
-        selected_groups.append(group_shuffled.head(take_n))
-        total_selected += take_n
-
-        if total_selected >= max_images:
-            break
+    take = _allocate_image_budget(eligible, max_images, max_per_species)
 
-    if not selected_groups:
+    if take.empty:
         raise ValueError(
             "Could not select any species under the given max_images "
             "constraint. Try increasing max_images or nrows."
         )
 
-    subset = pd.concat(selected_groups, ignore_index=True)
+    selected = df[df["scientificName"].isin(take.index)]
+    species = selected["scientificName"]
+    # Shuffle within the species (as group.sample would) and keep the
+    # first take_n images of each.
+    rank = _within_group_shuffle_rank(species, random_state=42)
+    keep = rank < species.map(take).to_numpy()
+    species_order = species.map(pd.Series(np.arange(len(take)), index=take.index)).to_numpy()
+    order = np.lexsort((rank[keep], species_order[keep]))
+
+    subset = selected[keep].iloc[order].reset_index(drop=True)
     num_species = subset["scientificName"].nunique()
 
     print(
@@ -334,8 +1399,179 @@ def select_balanced_subset(df: pd.DataFrame, max_images: int) -> pd.DataFrame:
     return subset
 
 
+def _allocate_image_budget(counts: pd.Series,
+                           max_images: int,
+                           max_per_species: Optional[int] = None,
+                          ) -> pd.Series:
+    """Decide how many images each species contributes under ``max_images``.
+
+    Species are considered in the order of ``counts``. Each one takes
+    all of its images (up to ``max_per_species``) while they fit in the
+    remaining budget. The first species that does not fit takes what is
+    left if that is at least three images, and allocation stops there.
+
+    Parameters
+    ----------
+    counts : pandas.Series
+        Number of available images per species, indexed by species name,
+        in the order species should be considered. Every count must be
+        at least three.
+    max_images : int
+        Total image budget.
+    max_per_species : int, optional
+        Cap on the number of images any species may take.
+
+    Returns
+    -------
+    pandas.Series
+        Number of images to take per selected species, in the order of
+        ``counts``. Species that receive nothing are omitted.
+    """
+    available = counts if max_per_species is None else counts.clip(upper=max_per_species)
+    available = available.to_numpy()
+    remaining = max_images - (np.cumsum(available) - available)
+    take = np.minimum(available, remaining)
+    # If we can't fit at least 3 more images, we can't add a new species.
+    take[remaining < 3] = 0
+    take = pd.Series(take, index=counts.index)
+    return take[take > 0]
+
+
+def select_streaming_subset(chunks: Iterable[pd.DataFrame],
+                            max_images: int,
+                            max_per_species: int,
+                            random_state: int = 42,
+                           ) -> pd.DataFrame:
+    """Select a balanced subset from a stream of merged chunks in one pass.
+
+    This is the streaming counterpart of :func:`filter_image_records`
+    followed by :func:`select_balanced_subset`. Every chunk is filtered
+    to image records, and each row gets a pseudo-random key hashed from
+    its ``gbifID`` and ``identifier``. For every species only the
+    ``max_per_species`` rows with the smallest keys are kept (a
+    bottom-k reservoir sample), so memory scales with the number of
+    species times ``max_per_species`` rather than with the archive
+    size. Because the keys depend only on the row contents, the sample
+    does not depend on the chunk size or the chunk order.
+
+    After the last chunk, species with at least three sampled images are
+    visited in sorted-name order and take their images under
+    ``max_images`` exactly as :func:`select_balanced_subset` does. The
+    images drawn differ from that function's global shuffle, but every
+    selected species has at least three images.
+
+    Parameters
+    ----------
+    chunks : iterable of pandas.DataFrame
+        Merged record chunks, e.g. from :func:`iter_occurrence_and_multimedia`,
+        with the columns ``gbifID``, ``identifier``, ``format``, ``type``
+        and ``scientificName``.
+    max_images : int
+        Maximum total number of images in the subset.
+    max_per_species : int
+        Maximum number of images per species; also the reservoir size.
+    random_state : int, optional
+        Seed mixed into the row hashes. The default is 42.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Selected image records, grouped by species in sorted-name order,
+        with a fresh index.
+
+    Raises
+    ------
+    ValueError
+        If ``max_images`` or ``max_per_species`` is less than 3, or if no
+        species has at least three images.
+    """
+    if max_images < 3 or max_per_species < 3:
+        raise ValueError(
+            "max_images and max_per_species must be at least 3 so each selected "
+            "species can contribute one image to train, val, and test."
+        )
+
+    hash_key = f"{random_state:016d}"[-16:]
+    reservoir = None
+    pending: List[pd.DataFrame] = []
+    pending_rows = 0
+    rows_seen = 0
+
+    def compact(frames: List[pd.DataFrame]) -> pd.DataFrame:
+        combined = pd.concat(frames, ignore_index=True)
+        combined = combined.sort_values("_key", kind="stable")
+        return combined.groupby("scientificName", sort=False).head(max_per_species)
+
+    for chunk in chunks:
+        rows_seen += len(chunk)
+        chunk = chunk.drop(columns=_ROW_ORDER, errors="ignore")
+        chunk = chunk[_image_record_mask(chunk)].fillna("")
+        if chunk.empty:
+            continue
+        chunk["_key"] = pd.util.hash_pandas_object(
+            chunk[["gbifID", "identifier"]], index=False, hash_key=hash_key
+        ).to_numpy()
+        pending.append(chunk)
+        pending_rows += len(chunk)
+        # Compact once the buffered rows match the reservoir, so every row
+        # is sorted a bounded number of times.
+        if pending_rows >= max(len(reservoir) if reservoir is not None else 0, 1_000_000):
+            reservoir = compact(([reservoir] if reservoir is not None else []) + pending)
+            pending, pending_rows = [], 0
+
+    if pending or reservoir is None:
+        frames = ([reservoir] if reservoir is not None else []) + pending
+        if not frames:
+            raise ValueError("No valid image records found in the streamed records.")
+        reservoir = compact(frames)
+
+    counts = reservoir["scientificName"].value_counts()
+    eligible = counts[counts >= 3].sort_index()
+    if eligible.empty:
+        raise ValueError(
+            "No species have at least three images. Cannot create splits "
+            "where every species appears in train/val/test."
+        )
+    take = _allocate_image_budget(eligible, max_images, max_per_species)
+
+    species = reservoir["scientificName"]
+    rank = species.groupby(species, sort=False).cumcount().to_numpy()
+    subset = reservoir[rank < species.map(take).fillna(0).to_numpy()]
+    subset = (
+        subset.sort_values(["scientificName", "_key"], kind="stable")
+        .drop(columns="_key")
+        .reset_index(drop=True)
+    )
+
+    print(
+        f"[info] Sampled {subset['scientificName'].nunique()} species with a total of "
+        f"{len(subset)} images from {rows_seen} streamed records "
+        f"(max_images={max_images}, max_per_species={max_per_species})."
+    )
+    return subset
+
+
+def _split_counts(sizes: np.ndarray, split_ratios: Sequence[float]) -> np.ndarray:
+    """Turn train/val/test ratios into per-species image counts.
+
+    Each row of the result holds the number of train, val and test
+    images for the species of the same position in ``sizes``. Val and
+    test get their rounded share but at least one image each, and train
+    receives the remainder (also at least one image, since every size is
+    at least three).
+    """
+    ratios = np.asarray(split_ratios, dtype=float)
+    ratios = ratios / ratios.sum()
+
+    n_val = np.clip(np.rint(sizes * ratios[1]), 1, sizes - 2).astype(np.int64)
+    n_test = np.clip(np.rint(sizes * ratios[2]), 1, sizes - 1 - n_val).astype(np.int64)
+    n_train = sizes - n_val - n_test
+    return np.stack([n_train, n_val, n_test], axis=1)
 
-def assign_splits_per_species(df: pd.DataFrame) -> pd.DataFrame:
+
+def assign_splits_per_species(df: pd.DataFrame,
+                              split_ratios: Optional[Sequence[float]] = None,
+                             ) -> pd.DataFrame:
     """Assign train/validation/test splits for each species.
 
     This function ensures that:
@@ -350,12 +1586,23 @@ def assign_splits_per_species(df: pd.DataFrame) -> pd.DataFrame:
     three rows for every species. If any species has fewer than three
     rows, a :class:`ValueError` is raised.
 
+    The rows of each species are shuffled and the first three receive
+    one split each. By default the remaining rows are distributed
+    round-robin across train, val and test. If ``split_ratios`` is
+    given, each species is instead cut into train/val/test blocks sized
+    by those ratios (still with at least one image per split). All
+    species are labelled in one vectorized pass.
+
     Parameters
     ----------
     df : pandas.DataFrame
         DataFrame containing at least the column ``"scientificName"``.
         Typically this is the subset returned by
         :func:`select_balanced_subset`.
+    split_ratios : sequence of float, optional
+        Relative sizes of the train, val and test splits, for example
+        ``(0.8, 0.1, 0.1)``. The values are normalized to sum to one. If
+        ``None`` (the default), the round-robin distribution is used.
 
     Returns
     -------
@@ -367,46 +1614,51 @@ def assign_splits_per_species(df: pd.DataFrame) -> pd.DataFrame:
     Raises
     ------
     ValueError
-        If any species has fewer than three rows.
+        If any species has fewer than three rows, or if ``split_ratios``
+        does not contain three positive values.
     RuntimeError
         If any row fails to receive a split label (indicating a logic
         error in the implementation).
     """
     if "scientificName" not in df.columns:
         raise ValueError("Input DataFrame must contain a 'scientificName' column.")
+    if split_ratios is not None and (
+        len(split_ratios) != 3 or any(r <= 0 for r in split_ratios)
+    ):
+        raise ValueError(
+            "split_ratios must contain three positive values for train, val and test."
+        )
 
     df = df.copy()
-    df["split"] = ""
+    species = df["scientificName"]
+    has_species = species.notna().to_numpy()
 
-    # We will assign splits species by species.
-    for species, group in df.groupby("scientificName"):
-        idxs = list(group.index)
-        n = len(idxs)
-
-        if n < 3:
-            raise ValueError(
-                f"Species '{species}' has only {n} rows; at least 3 are required "
-                "to allocate one image to each of train, val, and test."
-            )
+    species_counts = species.value_counts()
+    too_small = species_counts[species_counts < 3].sort_index()
+    if not too_small.empty:
+        raise ValueError(
+            f"Species '{too_small.index[0]}' has only {too_small.iloc[0]} rows; "
+            "at least 3 are required to allocate one image to each of train, "
+            "val, and test."
+        )
 
-        # Shuffle indices for this species so we don't always pick the same
-        # rows for each split.
-        group_shuffled = group.sample(frac=1.0, random_state=42)
-        shuffled_idxs = list(group_shuffled.index)
+    splits = np.array(["train", "val", "test"], dtype=object)
+    labels = np.full(len(df), "", dtype=object)
 
-        # Start by guaranteeing one image per split.
-        splits_for_group = ["train", "val", "test"]
+    # Position of each row in its species' shuffled order, matching
+    # group.sample(frac=1.0, random_state=42).
+    rank = _within_group_shuffle_rank(species[has_species], random_state=42)
 
-        # Distribute remaining images (if any) in a round-robin fashion
-        # across the three splits to keep things roughly balanced.
-        remaining = n - 3
-        extra_cycle = ["train", "val", "test"]
-        for i in range(remaining):
-            splits_for_group.append(extra_cycle[i % 3])
+    if split_ratios is None:
+        # The first three shuffled rows get train, val, test and the rest
+        # continue the same round-robin cycle.
+        labels[has_species] = splits[rank % 3]
+    else:
+        sizes = species[has_species].map(species_counts).to_numpy()
+        bounds = np.cumsum(_split_counts(sizes, split_ratios), axis=1)
+        labels[has_species] = splits[(rank[:, None] >= bounds).sum(axis=1)]
 
-        # Now assign the computed split labels to the shuffled indices.
-        for idx, split_label in zip(shuffled_idxs, splits_for_group):
-            df.loc[idx, "split"] = split_label
+    df["split"] = pd.Series(labels, index=df.index, dtype=_TEXT_DTYPE)
 
     # Safety check: no row should be left unlabeled.
     if (df["split"] == "").any():
@@ -418,190 +1670,2597 @@ def assign_splits_per_species(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
+def _split_bounds(split_ratios: Optional[Sequence[float]]) -> np.ndarray:
+    """Return the upper ends of the train/val/test intervals of ``[0, 1)``."""
+    ratios = np.ones(3) if split_ratios is None else np.asarray(split_ratios, dtype=float)
+    bounds = np.cumsum(ratios / ratios.sum())
+    bounds[-1] = 1.0
+    return bounds
 
-def download_and_save_images(
-    df: pd.DataFrame,
-    output_dir: str,
-    timeout: int = 30,
-) -> None:
-    """Download images and save them in a ``model_training_data`` folder structure.
 
-    Given a DataFrame with assigned splits and species names, this
-    function downloads each image and writes it under::
+def _hash_unit_interval(values: pd.Series, salt: str) -> np.ndarray:
+    """Map every value to a stable pseudo-random number in ``[0, 1)``.
 
-        <output_dir>/model_training_data/<split>/<species_folder>/<filename>
+    The number is derived from a 64-bit SipHash of the value's text,
+    keyed by ``salt``, so it never depends on the other rows, the row
+    order or the process.
+    """
+    hash_key = hashlib.sha256(salt.encode("utf-8")).hexdigest()[:16]
+    text = np.asarray(values.astype(str), dtype=object)
+    hashes = pd.util.hash_array(text, hash_key=hash_key, categorize=False)
+    return (hashes >> np.uint64(11)).astype(np.float64) / float(2 ** 53)
 
-    where ``<split>`` is one of ``"train"``, ``"val"`` or ``"test"``
-    and ``<species_folder>`` is derived from the scientific name.
+
+def hash_splits(gbif_ids: pd.Series,
+                split_ratios: Optional[Sequence[float]] = None,
+                salt: str = DEFAULT_SPLIT_SALT,
+               ) -> np.ndarray:
+    """Derive the split of every row from a salted hash of its ``gbifID``.
+
+    Each row is labelled on its own, so this works chunk by chunk in a
+    streaming pipeline, and a record keeps its split across reruns and
+    archive refreshes as long as ``salt`` and ``split_ratios`` stay the
+    same. Unlike :func:`assign_splits_by_hash`, it does not guarantee that
+    every species reaches all three splits.
+
+    Parameters
+    ----------
+    gbif_ids : pandas.Series
+        ``gbifID`` of every row.
+    split_ratios : sequence of float, optional
+        Relative sizes of the train, val and test splits. The default
+        gives each split a third.
+    salt : str, optional
+        Key of the hash. A different salt draws an independent split.
+
+    Returns
+    -------
+    numpy.ndarray
+        ``"train"``, ``"val"`` or ``"test"`` for every row.
+    """
+    splits = np.array(["train", "val", "test"], dtype=object)
+    position = _hash_unit_interval(gbif_ids, salt)
+    return splits[np.searchsorted(_split_bounds(split_ratios)[:-1], position, side="right")]
+
+
+def _fix_up_empty_splits(species: np.ndarray,
+                         labels: np.ndarray,
+                         position: np.ndarray,
+                         bounds: np.ndarray,
+                         movable: Optional[np.ndarray] = None,
+                         tiebreak: Optional[np.ndarray] = None,
+                        ) -> int:
+    """Move rows in place so every species reaches all three splits.
+
+    ``species`` holds integer species codes and ``labels`` split indices.
+    For every species without a row in split ``s``, the movable row
+    whose hash ``position`` lies closest to the interval of ``s`` is
+    moved there, taken from a split that keeps at least one row. Rows
+    at the same distance (images of one occurrence) are ordered by
+    ``tiebreak``. The choice only depends on the species' own rows, so
+    it is as stable as the hash itself. Returns the number of rows moved.
+    """
+    if movable is None:
+        movable = np.ones(len(labels), dtype=bool)
+    if tiebreak is None:
+        tiebreak = np.zeros(len(labels))
+    lower = np.concatenate([[0.0], bounds[:-1]])
+    num_species = int(species.max()) + 1 if len(species) else 0
+    moved = 0
+    for split in range(3):
+        counts = np.zeros((num_species, 3), dtype=np.int64)
+        np.add.at(counts, (species, labels), 1)
+        missing = counts[:, split] == 0
+        eligible = missing[species] & movable & (counts[species, labels] >= 2)
+        if not eligible.any():
+            continue
+        rows = np.flatnonzero(eligible)
+        distance = np.maximum(lower[split] - position[rows], position[rows] - bounds[split])
+        order = np.lexsort((tiebreak[rows], distance, species[rows]))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = species[rows][order][1:] != species[rows][order][:-1]
+        chosen = rows[order[first]]
+        labels[chosen] = split
+        moved += len(chosen)
+    return moved
+
+
+def assign_splits_by_hash(df: pd.DataFrame,
+                          split_ratios: Optional[Sequence[float]] = None,
+                          salt: str = DEFAULT_SPLIT_SALT,
+                         ) -> pd.DataFrame:
+    """Assign train/validation/test splits from a salted hash of ``gbifID``.
+
+    Alternative to :func:`assign_splits_per_species` whose result does
+    not depend on the other rows of a species: every row gets the split
+    :func:`hash_splits` derives from its ``gbifID``, ``salt`` and
+    ``split_ratios``. Adding or removing records therefore leaves the
+    split of every other record unchanged, and the images of one
+    occurrence share a split. A per-species fix-up then
+    moves the fewest rows needed so each species appears in train, val
+    and test, see :func:`_fix_up_empty_splits`.
 
     Parameters
     ----------
     df : pandas.DataFrame
-        DataFrame that must contain the columns ``gbifID``,
-        ``scientificName``, ``identifier``, ``format`` and ``split``.
-    output_dir : str
-        Base directory under which the ``model_training_data`` folder
-        will be created.
-    timeout : int, optional
-        Timeout (in seconds) for HTTP requests when downloading images.
-        The default is 30 seconds.
+        DataFrame containing at least the columns ``"gbifID"`` and
+        ``"scientificName"``, with at least three rows per species.
+    split_ratios : sequence of float, optional
+        Relative sizes of the train, val and test splits. The default
+        gives each split a third.
+    salt : str, optional
+        Key of the hash. The default is ``"identiflora"``.
 
     Returns
     -------
-    None
+    pandas.DataFrame
+        Copy of the input DataFrame with an additional column
+        ``"split"``.
 
-    Notes
-    -----
-    Network errors during download are reported as warnings and the
-    corresponding images are skipped. As a result, it is possible for a
-    species to be missing from one or more splits if all downloads for
-    that species/split combination fail. The script prints the total
-    number of successful downloads at the end.
+    Raises
+    ------
+    ValueError
+        If a required column is missing, any species has fewer than three
+        rows, or ``split_ratios`` does not contain three positive values.
     """
-    required_cols = {"gbifID", "scientificName", "identifier", "format", "split"}
-    missing = required_cols.difference(df.columns)
+    missing = {"gbifID", "scientificName"}.difference(df.columns)
     if missing:
         raise ValueError(f"Input DataFrame is missing required columns: {missing}")
+    if split_ratios is not None and (
+        len(split_ratios) != 3 or any(r <= 0 for r in split_ratios)
+    ):
+        raise ValueError(
+            "split_ratios must contain three positive values for train, val and test."
+        )
+    species_counts = df["scientificName"].value_counts(dropna=False)
+    too_small = species_counts[species_counts < 3].sort_index()
+    if not too_small.empty:
+        raise ValueError(
+            f"Species '{too_small.index[0]}' has only {too_small.iloc[0]} rows; "
+            "at least 3 are required to allocate one image to each of train, "
+            "val, and test."
+        )
 
-    base_root = os.path.join(output_dir, "model_training_data")
-    splits = ["train", "val", "test"]
+    df = df.copy()
+    bounds = _split_bounds(split_ratios)
+    position = _hash_unit_interval(df["gbifID"], salt)
+    labels = np.searchsorted(bounds[:-1], position, side="right")
+    species, _ = pd.factorize(df["scientificName"], use_na_sentinel=False)
+    tiebreak = _hash_unit_interval(df["identifier"], salt) if "identifier" in df.columns else None
+    moved = _fix_up_empty_splits(species, labels, position, bounds, tiebreak=tiebreak)
 
-    for split in splits:
-        split_dir = os.path.join(base_root, split)
-        os.makedirs(split_dir, exist_ok=True)
+    splits = np.array(["train", "val", "test"], dtype=object)
+    df["split"] = pd.Series(splits[labels], index=df.index, dtype=_TEXT_DTYPE)
+    print(
+        f"[info] Assigned splits by hash of gbifID ({moved} rows moved so every "
+        "species reaches all three splits)."
+    )
+    return df
 
-    success_count = 0
-    total_rows = len(df)
 
-    for idx, row in df.iterrows():
-        gbif_id = str(row["gbifID"])
-        species = row["scientificName"]
-        url = row["identifier"]
-        fmt = row["format"]
-        split = row["split"]
+def _spread_top_up(current: pd.Series, available: pd.Series, budget: int) -> pd.Series:
+    """Share ``budget`` new images among species already in a subset.
 
-        species_folder = sanitize_species_name(species)
-        split_dir = os.path.join(base_root, split, species_folder)
-        os.makedirs(split_dir, exist_ok=True)
+    ``current`` holds each species' image count and ``available`` how
+    many new images it can take. The smallest species are raised first,
+    to a common level that the budget allows; the images left over then
+    go one each to species at that level, in the order of the index.
+    """
+    have = current.to_numpy(dtype=np.int64)
+    room = available.to_numpy(dtype=np.int64)
+    if room.sum() <= budget:
+        return available.copy()
 
-        ext = extension_from_format(fmt)
-        filename = f"{gbif_id}_{split}_{idx}{ext}"
-        out_path = os.path.join(split_dir, filename)
+    def taken(level: int) -> np.ndarray:
+        return np.minimum(room, np.clip(level - have, 0, None))
 
-        if os.path.exists(out_path):
-            print(f"[skip] File already exists, skipping: {out_path}")
-            continue
+    # Highest level every species below it can be raised to.
+    low, high = int(have.min()), int((have + room).max())
+    while low < high:
+        middle = (low + high + 1) // 2
+        if taken(middle).sum() <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    take = taken(low)
+    can_grow = np.flatnonzero((have + take == low) & (take < room))
+    take[can_grow[:budget - int(take.sum())]] += 1
+    return pd.Series(take, index=available.index)
 
-        try:
-            print(f"[download] ({idx + 1}/{total_rows}) [{split}] {url}")
-            response = requests.get(url, timeout=timeout)
-            response.raise_for_status()
-        except Exception as exc:  # noqa: BLE001
-            print(f"[warning] Failed to download {url}: {exc}")
-            continue
 
-        with open(out_path, "wb") as f:
-            f.write(response.content)
+def _top_up_split_labels(counts: np.ndarray,
+                         n_new: int,
+                         split_ratios: Optional[Sequence[float]] = None,
+                        ) -> np.ndarray:
+    """Pick splits for ``n_new`` images joining a species already split.
 
-        success_count += 1
+    ``counts`` holds the species' current train/val/test image counts.
+    Each new image goes to the split furthest below its share of the
+    growing total, so the round-robin (or ``split_ratios``) proportions
+    are kept and splits that lost images are refilled first.
+    """
+    ratios = np.ones(3) if split_ratios is None else np.asarray(split_ratios, dtype=float)
+    ratios = ratios / ratios.sum()
+    counts = counts.astype(float)
+    labels = np.empty(n_new, dtype=np.int64)
+    for i in range(n_new):
+        split = int(np.argmax(ratios * (counts.sum() + 1) - counts))
+        counts[split] += 1
+        labels[i] = split
+    return labels
 
-    print(
-        f"[done] Successfully downloaded {success_count} images "
-        f"into {base_root}."
-    )
 
+def load_snapshot(snapshot_dir: str) -> Optional[Tuple[np.ndarray, pd.DataFrame]]:
+    """Load the state :func:`save_snapshot` wrote after the previous run.
 
-def parse_args() -> argparse.Namespace:
-    """Parse command-line arguments for the data preparation script.
+    Parameters
+    ----------
+    snapshot_dir : str
+        Directory holding the snapshot.
 
     Returns
     -------
-    argparse.Namespace
-        Namespace containing the parsed command-line options.
+    tuple of (numpy.ndarray, pandas.DataFrame) or None
+        The sorted ``gbifID``\\ s of every record seen by previous
+        runs and the labeled subset selected from it,
+        indexed by the row number used in its file names. ``None`` if no
+        snapshot exists yet.
     """
-    parser = argparse.ArgumentParser(
-        description=(
-            "Prepare a small, balanced GBIF/Pl@ntNet sample for model training. "
-            "The script merges occurrence and multimedia tables, filters image "
-            "records, selects a balanced subset with equal species across "
-            "train/val/test splits, and downloads the corresponding images."
-        )
-    )
-    parser.add_argument(
-        "--dwca_dir",
-        required=True,
-        help=(
-            "Path to the directory containing 'occurrence.txt' and "
-            "'multimedia.txt'."
-        ),
-    )
-    parser.add_argument(
-        "--output_dir",
-        default=".",
-        help=(
-            "Base directory where the 'model_training_data' folder will "
-            "be created. Default is the current directory."
-        ),
-    )
-    parser.add_argument(
-        "--max_images",
-        type=int,
-        default=100,
-        help=(
-            "Maximum total number of images to include. Because each species "
-            "contributes exactly three images (one per split), the script can "
-            "include at most floor(max_images / 3) species."
-        ),
-    )
-    parser.add_argument(
-        "--max_multimedia_rows",
-        type=int,
-        default=50000,
-        help=(
-            "Maximum number of rows to read from 'multimedia.txt' using the "
-            "nrows argument of pandas.read_csv. Use a smaller value for quick "
-            "testing or a larger value to see more of the dataset."
-        ),
-    )
-    parser.add_argument(
-        "--max_occurrence_rows",
-        type=int,
-        default=50000,
-        help=(
-            "Maximum number of rows to read from 'occurrence.txt' using the "
-            "nrows argument of pandas.read_csv."
-        ),
+    ids_path = os.path.join(snapshot_dir, "gbif_ids.npy")
+    labeled_path = os.path.join(snapshot_dir, "labeled_subset.csv")
+    if not (os.path.exists(ids_path) and os.path.exists(labeled_path)):
+        return None
+
+    seen_ids = np.load(ids_path)
+    labeled = pd.read_csv(labeled_path, dtype=str, keep_default_na=False)
+    labeled.index = labeled.pop("row_id").astype(np.int64).to_numpy()
+    print(
+        f"[info] Loaded snapshot of {len(seen_ids)} records and "
+        f"{len(labeled)} labeled images from {snapshot_dir}."
     )
-    return parser.parse_args()
+    return seen_ids, labeled
 
 
-def main() -> None:
-    """Run the data preparation pipeline.
+def _unique_gbif_ids(table: pd.DataFrame) -> np.ndarray:
+    """Return the sorted distinct integer ``gbifID``\\ s of ``table``."""
+    ids = pd.to_numeric(table["gbifID"], errors="coerce").dropna()
+    return np.unique(ids.to_numpy(dtype=np.int64))
 
-    This high-level function performs the following steps:
 
-    1. Load and merge the occurrence and multimedia tables.
-    2. Filter the merged table to keep only plausible image records.
-    3. Select a balanced subset with one image per split for each species.
-    4. Assign explicit train/validation/test split labels.
-    5. Download all selected images into a ``model_training_data`` folder
-       structure under the requested output directory.
+def save_snapshot(snapshot_dir: str, ids: np.ndarray, labeled: pd.DataFrame) -> None:
+    """Record the processed archive and its labeled subset for the next run.
+
+    Parameters
+    ----------
+    snapshot_dir : str
+        Directory the snapshot is written to. Created if missing.
+    ids : numpy.ndarray
+        Sorted integer ``gbifID``\\ s of every record seen so far, the
+        ``current_ids`` given to :func:`extend_labeled_subset`.
+    labeled : pandas.DataFrame
+        Labeled subset that was downloaded. Its index, which appears in
+        the image file names, is stored as ``row_id``.
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    ids_path = os.path.join(snapshot_dir, "gbif_ids.npy")
+    labeled_path = os.path.join(snapshot_dir, "labeled_subset.csv")
+    # Write both files before replacing either, so a crash leaves the
+    # previous snapshot (or a labeled subset ahead of the ID list, which
+    # extend_labeled_subset tolerates) rather than torn files.
+    with open(ids_path + ".tmp", "wb") as f:
+        np.save(f, ids)
+    labeled.rename_axis("row_id").reset_index().to_csv(labeled_path + ".tmp", index=False)
+    os.replace(labeled_path + ".tmp", labeled_path)
+    os.replace(ids_path + ".tmp", ids_path)
+    print(f"[info] Saved snapshot of {len(ids)} records and {len(labeled)} labeled images.")
+
+
+def extend_labeled_subset(previous: pd.DataFrame,
+                          current_ids: np.ndarray,
+                          new_records: pd.DataFrame,
+                          max_images: int,
+                          max_per_species: Optional[int] = None,
+                          split_ratios: Optional[Sequence[float]] = None,
+                          split_method: str = "shuffle",
+                          split_salt: str = DEFAULT_SPLIT_SALT,
+                         ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Apply the difference between two archive snapshots to a labeled subset.
+
+    Rows of ``previous`` whose ``gbifID`` is no longer in the archive
+    are retired. All other rows keep their split and row number, so
+    their files stay where they are. The freed and any remaining
+    ``max_images`` budget is then filled from ``new_records``:
+
+    * Species already in the subset are topped up first, up to
+      ``max_per_species`` images in total. The budget goes to the
+      species with the fewest images first (see :func:`_spread_top_up`),
+      so species that lost images are refilled before others grow. Each
+      new image goes to the split furthest below its share, see
+      :func:`_top_up_split_labels`.
+    * New species with at least three new images are added as
+      :func:`select_balanced_subset` would and split with
+      :func:`assign_splits_per_species`.
+
+    Retiring rows can leave a kept species without an image in a split.
+    Such cells are reported; :func:`backfill_missing_cells` refills them
+    from the species' unselected images after the download.
+
+    With ``split_method="hash"``, new images instead take the split
+    :func:`hash_splits` derives from their ``gbifID``; for known species
+    only new images are moved to fill a split the species lacks, and new
+    species are split with :func:`assign_splits_by_hash`.
+
+    Parameters
+    ----------
+    previous : pandas.DataFrame
+        Labeled subset of the previous run, as returned by
+        :func:`load_snapshot`.
+    current_ids : numpy.ndarray
+        Sorted integer ``gbifID``\\ s of every record that may still be in
+        the archive. Rows of ``previous`` whose ID is missing are retired,
+        so after a read capped by ``max_*_rows`` this must include every
+        ID seen before.
+    new_records : pandas.DataFrame
+        Filtered image records that were not part of the previous
+        archive.
+    max_images : int
+        Maximum total number of images in the updated subset.
+    max_per_species : int, optional
+        Maximum number of images per species in the updated subset.
+    split_ratios : sequence of float, optional
+        Train/val/test ratios, as for :func:`assign_splits_per_species`.
+    split_method : str, optional
+        ``"shuffle"`` (the default) or ``"hash"``, see above.
+    split_salt : str, optional
+        Key of the hash used with ``split_method="hash"``.
 
     Returns
     -------
-    None
+    tuple of pandas.DataFrame
+        The updated labeled subset and the retired rows of ``previous``.
+        New rows are numbered after the highest previous row number.
     """
-    args = parse_args()
+    previous_ids = pd.to_numeric(previous["gbifID"], errors="coerce").to_numpy()
+    present = np.isin(previous_ids, current_ids)
+    retired = previous[~present]
+    kept = previous[present]
+
+    # Rows already in the subset can come back as "new" if the previous
+    # run stopped between writing the subset and the ID list.
+    already_labeled = pd.MultiIndex.from_frame(previous[["gbifID", "identifier"]])
+    candidates = new_records[
+        ~pd.MultiIndex.from_frame(new_records[["gbifID", "identifier"]]).isin(already_labeled)
+    ]
+    candidates = candidates.sample(frac=1.0, random_state=42).reset_index(drop=True)
+    species = candidates["scientificName"]
+    available = species.value_counts().sort_index()
+    kept_counts = kept["scientificName"].value_counts()
+    known = available.index.isin(kept_counts.index)
+    budget = max(max_images - len(kept), 0)
+
+    # Top up species that are already in the subset.
+    top_up = available[known]
+    if max_per_species is not None:
+        room = (max_per_species - kept_counts.reindex(top_up.index)).clip(lower=0)
+        top_up = np.minimum(top_up, room)
+    top_up = _spread_top_up(kept_counts.reindex(top_up.index), top_up, budget)
+    top_up = top_up[top_up > 0]
+    budget -= int(top_up.sum())
+
+    # Add new species under what is left of the budget.
+    fresh = available[~known]
+    fresh = fresh[fresh >= 3]
+    take_fresh = _allocate_image_budget(fresh, budget, max_per_species) if budget >= 3 else fresh[:0]
+
+    take = pd.concat([top_up, take_fresh])
+    rank = _within_group_shuffle_rank(species, random_state=42)
+    chosen = candidates[rank < species.map(take).fillna(0).to_numpy()]
+
+    added_species = chosen[chosen["scientificName"].isin(take_fresh.index)]
+    if not added_species.empty:
+        if split_method == "hash":
+            added_species = assign_splits_by_hash(added_species, split_ratios, split_salt)
+        else:
+            added_species = assign_splits_per_species(added_species, split_ratios=split_ratios)
+
+    splits = np.array(["train", "val", "test"], dtype=object)
+    topped_up = chosen[chosen["scientificName"].isin(top_up.index)].copy()
+    if split_method == "hash":
+        # Kept rows never move; new rows take their hash split unless a
+        # species needs one of them to fill an empty split.
+        known_rows = kept[kept["scientificName"].isin(top_up.index)]
+        bounds = _split_bounds(split_ratios)
+        position = np.concatenate([
+            np.zeros(len(known_rows)),
+            _hash_unit_interval(topped_up["gbifID"], split_salt),
+        ])
+        labels = np.concatenate([
+            pd.Index(splits).get_indexer(known_rows["split"]),
+            np.searchsorted(bounds[:-1], position[len(known_rows):], side="right"),
+        ])
+        species, _ = pd.factorize(pd.concat([known_rows["scientificName"],
+                                             topped_up["scientificName"]]))
+        movable = np.arange(len(labels)) >= len(known_rows)
+        tiebreak = np.concatenate([
+            np.zeros(len(known_rows)),
+            _hash_unit_interval(topped_up["identifier"], split_salt),
+        ])
+        _fix_up_empty_splits(species, labels, position, bounds, movable, tiebreak)
+        topped_up["split"] = pd.Series(splits[labels[len(known_rows):]],
+                                       index=topped_up.index, dtype=_TEXT_DTYPE)
+    else:
+        split_counts = pd.crosstab(kept["scientificName"], kept["split"]).reindex(
+            columns=splits, fill_value=0)
+        labels = pd.Series("", index=topped_up.index, dtype=object)
+        for name, rows in topped_up.groupby("scientificName").groups.items():
+            labels[rows] = splits[_top_up_split_labels(
+                split_counts.loc[name].to_numpy(), len(rows), split_ratios)]
+        topped_up["split"] = labels.astype(_TEXT_DTYPE)
 
-    merged = load_occurrence_and_multimedia(
-        dwca_dir=args.dwca_dir,
-        max_multimedia_rows=args.max_multimedia_rows,
-        max_occurrence_rows=args.max_occurrence_rows,
+    added = pd.concat([topped_up, added_species])
+    first_row = int(previous.index.max()) + 1 if len(previous) else 0
+    added.index = pd.RangeIndex(first_row, first_row + len(added))
+    labeled = pd.concat([kept, added])
+
+    print(
+        f"[delta] Kept {len(kept)} images, retired {len(retired)}, added {len(added)} "
+        f"({len(topped_up)} to {len(top_up)} known species, {len(added_species)} for "
+        f"{len(take_fresh)} new species)."
     )
-    image_records = filter_image_records(merged)
-    balanced_subset = select_balanced_subset(image_records, max_images=args.max_images)
-    labeled_subset = assign_splits_per_species(balanced_subset)
-    download_and_save_images(labeled_subset, output_dir=args.output_dir)
+    cells = pd.crosstab(labeled["scientificName"], labeled["split"]).reindex(
+        columns=splits, fill_value=0)
+    empty = int((cells == 0).to_numpy().sum())
+    if empty:
+        print(f"[delta] {empty} species/split cells lost their last image; "
+              "the backfill refills them unless --no_backfill is given.")
+    return labeled, retired
+
+
+@dataclass
+class DownloadTask:
+    """One image to fetch and where to store it."""
+
+    row_index: int
+    gbif_id: str
+    url: str
+    split: str
+    out_path: str
+    host: str
+    attempts: int = 0
+
+
+@dataclass
+class DownloadResult:
+    """Outcome of a single :class:`DownloadTask`."""
+
+    ok: bool
+    http_status: Optional[int] = None
+    num_bytes: int = 0
+    sha256: Optional[str] = None
+    error: Optional[str] = None
+    retriable: bool = False
+    deduplicated: bool = False
+    seconds: float = 0.0
+    retry_after: Optional[float] = None
+    attempted: bool = True
+    quarantined: bool = False
+
+
+# HTTP statuses worth retrying; other 4xx responses are permanent.
+_RETRIABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+
+# Upper bounds in seconds on a single retry delay and on the
+# Retry-After wait a host can ask for.
+_MAX_BACKOFF = 60.0
+_MAX_RETRY_AFTER = 300.0
+
+# Size of the pieces response bodies are streamed to disk in.
+_DOWNLOAD_CHUNK_BYTES = 64 * 1024
+
+# When the same image lands in several splits, the copy in the earliest
+# split of this list is kept.
+_SPLIT_PRIORITY = ["train", "val", "test"]
+
+
+class DownloadManifest:
+    """Persistent SQLite journal of download attempts keyed by ``gbifID``/URL.
+
+    Each row records the latest status of one image (``"ok"``,
+    ``"retry"`` for retriable failures, ``"failed"`` for permanent ones,
+    ``"duplicate"`` for copies dropped from a later split,
+    ``"invalid"`` for files that failed validation or ``"retired"`` for
+    records removed from the archive), together
+    with its output path, byte size, SHA-256 checksum, last HTTP status
+    and the number of attempts made so far. The checksum column is
+    indexed and doubles as the content-hash index used to find
+    duplicate images. The
+    manifest is the source of truth for what has been downloaded, so
+    resuming never needs to probe the output tree.
+
+    The connection is used from a single thread only.
+
+    Parameters
+    ----------
+    path : str
+        Location of the SQLite database. It is created if missing.
+    commit_every : int, optional
+        Number of recorded attempts between commits. The default is 200.
+    """
+
+    def __init__(self, path: str, commit_every: int = 200) -> None:
+        self.path = path
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS downloads (
+                gbif_id TEXT NOT NULL,
+                url TEXT NOT NULL,
+                split TEXT,
+                out_path TEXT,
+                status TEXT NOT NULL,
+                http_status INTEGER,
+                num_bytes INTEGER,
+                sha256 TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL,
+                PRIMARY KEY (gbif_id, url)
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS downloads_sha256 ON downloads (sha256)"
+        )
+        self._conn.commit()
+        self._commit_every = commit_every
+        self._uncommitted = 0
+
+    def load_states(self) -> Dict[Tuple[str, str], Tuple[str, str]]:
+        """Return ``{(gbif_id, url): (status, out_path)}`` for every recorded image."""
+        rows = self._conn.execute("SELECT gbif_id, url, status, out_path FROM downloads")
+        return {(gbif_id, url): (status, out_path) for gbif_id, url, status, out_path in rows}
+
+    def record(self, task: DownloadTask, result: DownloadResult, status: str) -> None:
+        """Store the outcome of one attempt at ``task``.
+
+        ``attempts`` only counts requests that were sent, so a task the
+        circuit breaker turned away leaves it unchanged.
+        """
+        self._conn.execute(
+            """
+            INSERT INTO downloads (gbif_id, url, split, out_path, status,
+                                   http_status, num_bytes, sha256, attempts,
+                                   error, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (gbif_id, url) DO UPDATE SET
+                split = excluded.split,
+                out_path = excluded.out_path,
+                status = excluded.status,
+                http_status = excluded.http_status,
+                num_bytes = excluded.num_bytes,
+                sha256 = excluded.sha256,
+                attempts = downloads.attempts + excluded.attempts,
+                error = excluded.error,
+                updated_at = excluded.updated_at
+            """,
+            (task.gbif_id, task.url, task.split, task.out_path, status,
+             result.http_status, result.num_bytes, result.sha256,
+             int(result.attempted), result.error, time.time()),
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= self._commit_every:
+            self.commit()
+
+    def summary(self) -> pd.DataFrame:
+        """Return image counts and bytes per split and status."""
+        return pd.read_sql_query(
+            "SELECT split, status, COUNT(*) AS images, "
+            "COALESCE(SUM(num_bytes), 0) AS bytes "
+            "FROM downloads GROUP BY split, status ORDER BY split, status",
+            self._conn,
+        )
+
+    def quarantined_hashes(self) -> Set[str]:
+        """Return the SHA-256 digests of images that failed validation."""
+        rows = self._conn.execute(
+            "SELECT DISTINCT sha256 FROM downloads WHERE status = 'invalid' AND sha256 IS NOT NULL")
+        return {sha256 for (sha256,) in rows}
+
+    def cross_split_duplicates(self) -> pd.DataFrame:
+        """Return downloaded images whose content appears in more than one split.
+
+        The result has one row per affected download with the columns
+        ``sha256``, ``gbif_id``, ``url``, ``split`` and ``out_path``.
+        """
+        self.commit()
+        return pd.read_sql_query(
+            """
+            SELECT sha256, gbif_id, url, split, out_path FROM downloads
+            WHERE status = 'ok' AND sha256 IN (
+                SELECT sha256 FROM downloads WHERE status = 'ok'
+                GROUP BY sha256 HAVING COUNT(DISTINCT split) > 1
+            )
+            ORDER BY sha256, split
+            """,
+            self._conn,
+        )
+
+    def rows(self) -> pd.DataFrame:
+        """Return every row of the manifest."""
+        self.commit()
+        return pd.read_sql_query("SELECT * FROM downloads", self._conn)
+
+    def import_rows(self, rows: pd.DataFrame) -> None:
+        """Insert rows read with :meth:`rows` from another manifest.
+
+        A row already present is only replaced by a successful download
+        or by a newer attempt that did not overwrite a successful one.
+        """
+        self._conn.executemany(
+            """
+            INSERT INTO downloads (gbif_id, url, split, out_path, status,
+                                   http_status, num_bytes, sha256, attempts,
+                                   error, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (gbif_id, url) DO UPDATE SET
+                split = excluded.split,
+                out_path = excluded.out_path,
+                status = excluded.status,
+                http_status = excluded.http_status,
+                num_bytes = excluded.num_bytes,
+                sha256 = excluded.sha256,
+                attempts = excluded.attempts,
+                error = excluded.error,
+                updated_at = excluded.updated_at
+            WHERE (excluded.status = 'ok' AND downloads.status != 'ok')
+               OR ((excluded.status = 'ok') = (downloads.status = 'ok')
+                   AND excluded.updated_at > downloads.updated_at)
+            """,
+            rows[["gbif_id", "url", "split", "out_path", "status", "http_status",
+                  "num_bytes", "sha256", "attempts", "error", "updated_at"]]
+            .astype(object).where(rows.notna(), None).itertuples(index=False, name=None),
+        )
+        self.commit()
+
+    def mark(self, gbif_id: str, url: str, status: str) -> None:
+        """Overwrite the status of an already recorded image."""
+        self._conn.execute(
+            "UPDATE downloads SET status = ?, updated_at = ? WHERE gbif_id = ? AND url = ?",
+            (status, time.time(), gbif_id, url),
+        )
+        self._uncommitted += 1
+
+    def mark_paths(self, out_paths: Sequence[str], status: str) -> int:
+        """Overwrite the status of the images stored at ``out_paths``.
+
+        Returns the number of manifest rows updated.
+        """
+        now = time.time()
+        updated = 0
+        for out_path in out_paths:
+            cursor = self._conn.execute(
+                "UPDATE downloads SET status = ?, updated_at = ? WHERE out_path = ?",
+                (status, now, out_path),
+            )
+            updated += cursor.rowcount
+        self.commit()
+        return updated
+
+    def commit(self) -> None:
+        """Flush recorded attempts to disk."""
+        self._conn.commit()
+        self._uncommitted = 0
+
+    def close(self) -> None:
+        """Commit and close the underlying connection."""
+        self.commit()
+        self._conn.close()
+
+    def __enter__(self) -> "DownloadManifest":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class DownloadScheduler:
+    """Run download tasks on a thread pool with global and per-host limits.
+
+    Tasks are queued per host. At most ``workers`` tasks are in flight
+    overall and at most ``max_per_host`` against any single host, so a
+    slow host cannot occupy every worker. Hosts with queued work are
+    served round-robin. Results are handed back to the calling thread
+    as they complete, and new tasks may be added while :meth:`run` is
+    being iterated, optionally with a delay (used for retry backoff).
+
+    Every host has a circuit breaker. After ``breaker_threshold``
+    consecutive retriable failures (timeouts, connection errors, HTTP
+    429/5xx) the host is parked: its queue is left alone for
+    ``breaker_cooldown`` seconds, doubled on every further trip, while
+    the other hosts keep the workers busy. A response with
+    ``Retry-After`` parks the host for that long without counting as a
+    failure. A parked host
+    comes back with a single probe request in flight; a success restores
+    its full concurrency, a failure parks it again. After
+    ``breaker_max_trips`` trips in a row the host is given up for this
+    run, and its remaining tasks are yielded as unattempted, retriable
+    failures.
+
+    Parameters
+    ----------
+    fetch : callable
+        Function called on a worker thread with a :class:`DownloadTask`
+        and returning its result.
+    workers : int
+        Maximum number of tasks in flight at once.
+    max_per_host : int
+        Maximum number of tasks in flight against a single host.
+    breaker_threshold : int, optional
+        Consecutive retriable failures that trip a host's breaker. ``0``
+        disables the breakers. The default is 5.
+    breaker_cooldown : float, optional
+        Seconds a host is parked after its first trip. The default is 15.
+    breaker_max_trips : int, optional
+        Trips in a row after which a host is given up. The default is 4.
+    """
+
+    def __init__(self,
+                 fetch: Callable[[DownloadTask], DownloadResult],
+                 workers: int,
+                 max_per_host: int,
+                 breaker_threshold: int = 5,
+                 breaker_cooldown: float = 15.0,
+                 breaker_max_trips: int = 4,
+                ) -> None:
+        if workers < 1 or max_per_host < 1:
+            raise ValueError("workers and max_per_host must both be at least 1.")
+        self._fetch = fetch
+        self._workers = workers
+        self._max_per_host = max_per_host
+        self._breaker_threshold = breaker_threshold
+        self._breaker_cooldown = breaker_cooldown
+        self._breaker_max_trips = breaker_max_trips
+        self._queues: Dict[str, Deque[DownloadTask]] = {}
+        self._inflight: Dict[str, int] = {}
+        # Hosts that have queued tasks and spare per-host capacity.
+        self._ready: Deque[str] = deque()
+        self._is_ready: Set[str] = set()
+        # Heap of (due time, tie-breaker, task) for delayed tasks.
+        self._delayed: List[Tuple[float, int, DownloadTask]] = []
+        self._sequence = itertools.count()
+        # Circuit breaker state per host: consecutive failures, trips in
+        # a row, the time parked hosts come back, hosts allowed a single
+        # probe request and hosts given up for this run.
+        self._failures: Counter = Counter()
+        self._trips: Counter = Counter()
+        self._parked_until: Dict[str, float] = {}
+        self._probing: Set[str] = set()
+        self._given_up: Set[str] = set()
+        # Tasks of given-up hosts, yielded without being fetched.
+        self._rejected: Deque[DownloadTask] = deque()
+        self.hosts_parked = 0
+
+    def add(self, task: DownloadTask, delay: float = 0.0) -> None:
+        """Queue ``task`` behind any other work for the same host.
+
+        If ``delay`` is positive, the task only becomes eligible to run
+        after that many seconds.
+        """
+        if delay > 0:
+            due = time.monotonic() + delay
+            heapq.heappush(self._delayed, (due, next(self._sequence), task))
+            return
+        if task.host in self._given_up:
+            self._rejected.append(task)
+            return
+        self._queues.setdefault(task.host, deque()).append(task)
+        self._mark_ready(task.host)
+
+    def _release_due(self) -> Optional[float]:
+        """Queue due tasks and unpark due hosts; return seconds until the next event."""
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, task = heapq.heappop(self._delayed)
+            self.add(task)
+        for host, until in list(self._parked_until.items()):
+            if until <= now:
+                del self._parked_until[host]
+                self._probing.add(host)
+                self._mark_ready(host)
+        due = [self._delayed[0][0]] if self._delayed else []
+        # Parked hosts without queued work need no wake-up.
+        due += [until for host, until in self._parked_until.items() if self._queues.get(host)]
+        if due:
+            return max(0.0, min(due) - now)
+        return None
+
+    def _capacity(self, host: str) -> int:
+        if host in self._parked_until:
+            return 0
+        if host in self._probing:
+            return 1
+        return self._max_per_host
+
+    def _mark_ready(self, host: str) -> None:
+        if (host not in self._is_ready
+                and self._queues.get(host)
+                and self._inflight.get(host, 0) < self._capacity(host)):
+            self._ready.append(host)
+            self._is_ready.add(host)
+
+    def _park(self, host: str, seconds: float) -> None:
+        self._parked_until[host] = max(self._parked_until.get(host, 0.0),
+                                       time.monotonic() + seconds)
+
+    def _observe(self, host: str, result: DownloadResult) -> None:
+        """Update the circuit breaker of ``host`` with a finished request."""
+        if result.ok or not result.retriable:
+            # The host answered, even if only with a permanent error.
+            self._failures[host] = 0
+            self._trips[host] = 0
+            self._probing.discard(host)
+            return
+        if result.retry_after:
+            # The host is up and said when to come back.
+            self._park(host, result.retry_after)
+            return
+        if self._breaker_threshold <= 0 or host in self._parked_until:
+            # Requests that were in flight when the host was parked.
+            return
+        self._failures[host] += 1
+        if host not in self._probing and self._failures[host] < self._breaker_threshold:
+            return
+
+        self._failures[host] = 0
+        self._probing.discard(host)
+        self._trips[host] += 1
+        if self._trips[host] > self._breaker_max_trips:
+            self._given_up.add(host)
+            self._parked_until.pop(host, None)
+            self._rejected.extend(self._queues.pop(host, ()))
+            print(f"[warning] Giving up on {host} for this run after "
+                  f"{self._breaker_max_trips} pauses; its remaining images stay queued "
+                  "for the next run.")
+            return
+        cooldown = self._breaker_cooldown * 2 ** (self._trips[host] - 1)
+        self._park(host, cooldown)
+        self.hosts_parked += 1
+        print(f"[warning] Pausing {host} for {cooldown:.0f}s after repeated failures.")
+
+    def _dispatch(self, pool: ThreadPoolExecutor, pending: dict) -> None:
+        while len(pending) < self._workers and self._ready:
+            host = self._ready.popleft()
+            self._is_ready.discard(host)
+            task = self._queues[host].popleft()
+            self._inflight[host] = self._inflight.get(host, 0) + 1
+            pending[pool.submit(self._fetch, task)] = task
+            self._mark_ready(host)
+
+    def run(self) -> Iterator[Tuple[DownloadTask, DownloadResult]]:
+        """Execute queued tasks and yield ``(task, result)`` pairs as they finish."""
+        pending: dict = {}
+        with ThreadPoolExecutor(max_workers=self._workers) as pool:
+            while True:
+                next_due = self._release_due()
+                while self._rejected:
+                    task = self._rejected.popleft()
+                    yield task, DownloadResult(
+                        ok=False, retriable=True, attempted=False,
+                        error=f"Circuit breaker open: gave up on {task.host} for this run")
+                self._dispatch(pool, pending)
+                if not pending:
+                    if next_due is None:
+                        break
+                    time.sleep(next_due)
+                    continue
+                done, _ = wait(pending, timeout=next_due, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task = pending.pop(future)
+                    result = future.result()
+                    self._inflight[task.host] -= 1
+                    self._observe(task.host, result)
+                    self._mark_ready(task.host)
+                    yield task, result
+
+
+def _make_session(workers: int, max_per_host: int) -> requests.Session:
+    """Create an HTTP session whose keep-alive pools match the download limits."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=max(workers, 10),
+        pool_maxsize=max_per_host,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _is_image_content_type(content_type: str) -> bool:
+    """Return ``True`` unless ``content_type`` clearly is not an image."""
+    main = content_type.split(";", 1)[0].strip().lower()
+    return main in ("", "application/octet-stream") or main.startswith("image/")
+
+
+def _link_into_place(blob_path: str, out_path: str) -> None:
+    """Atomically make ``out_path`` a hard link to ``blob_path``.
+
+    Falls back to a copy on file systems without hard links.
+    """
+    # Renaming a link over another link to the same file is a no-op
+    # that would leave the temporary link behind.
+    if os.path.exists(out_path) and os.path.samefile(blob_path, out_path):
+        return
+    tmp_path = f"{out_path}.{threading.get_ident()}.link"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(blob_path, tmp_path)
+    except OSError:
+        shutil.copyfile(blob_path, tmp_path)
+    os.replace(tmp_path, out_path)
+
+
+def _stream_to_file(response: requests.Response,
+                    out_path: str,
+                    max_bytes: Optional[int],
+                    store_dir: Optional[str] = None,
+                    rejected_hashes: Optional[Set[str]] = None,
+                   ) -> DownloadResult:
+    """Stream a response body to ``out_path`` through a temporary file.
+
+    The body is written in :data:`_DOWNLOAD_CHUNK_BYTES` pieces to a
+    hidden ``.part`` file, fsynced and then renamed into place, so the
+    final path only ever holds a complete file. The transfer is aborted
+    once it exceeds ``max_bytes``.
+
+    If ``store_dir`` is given, the file is stored once under its SHA-256
+    digest in that content-addressed store and hard-linked to
+    ``out_path``. A body whose digest is already stored is discarded
+    and the existing copy is linked instead.
+
+    Bodies whose digest is in ``rejected_hashes`` (images quarantined
+    by an earlier validation) are discarded and reported as
+    ``quarantined`` failures.
+    """
+    digest = hashlib.sha256()
+    num_bytes = 0
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=f".{os.path.basename(out_path)}.",
+        suffix=".part",
+        dir=store_dir or os.path.dirname(out_path),
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in response.iter_content(chunk_size=_DOWNLOAD_CHUNK_BYTES):
+                num_bytes += len(chunk)
+                if max_bytes is not None and num_bytes > max_bytes:
+                    os.remove(tmp_path)
+                    return DownloadResult(
+                        ok=False,
+                        http_status=response.status_code,
+                        error=f"Body exceeds the {max_bytes} byte limit",
+                    )
+                digest.update(chunk)
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if num_bytes == 0:
+            os.remove(tmp_path)
+            return DownloadResult(ok=False, http_status=response.status_code,
+                                  error="Empty response body")
+
+        hexdigest = digest.hexdigest()
+        if rejected_hashes and hexdigest in rejected_hashes:
+            os.remove(tmp_path)
+            return DownloadResult(ok=False, http_status=response.status_code,
+                                  sha256=hexdigest, quarantined=True,
+                                  error="Body matches an image quarantined as invalid")
+
+        deduplicated = False
+        if store_dir is None:
+            os.replace(tmp_path, out_path)
+        else:
+            blob_dir = os.path.join(store_dir, hexdigest[:2])
+            blob_path = os.path.join(blob_dir, hexdigest + os.path.splitext(out_path)[1])
+            if os.path.exists(blob_path):
+                os.remove(tmp_path)
+                deduplicated = True
+            else:
+                os.makedirs(blob_dir, exist_ok=True)
+                os.replace(tmp_path, blob_path)
+            _link_into_place(blob_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return DownloadResult(ok=True, http_status=response.status_code,
+                          num_bytes=num_bytes, sha256=digest.hexdigest(),
+                          deduplicated=deduplicated)
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait per a ``Retry-After`` header (delay or HTTP date).
+
+    Returns ``None`` for missing or malformed values and caps the wait
+    at :data:`_MAX_RETRY_AFTER`.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        seconds = float(value)
+    else:
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        seconds = (when - datetime.now(timezone.utc)).total_seconds()
+    return min(max(seconds, 0.0), _MAX_RETRY_AFTER)
+
+
+def _fetch_image(session: requests.Session,
+                 task: DownloadTask,
+                 timeout: Union[float, Tuple[float, float]],
+                 max_bytes: Optional[int] = None,
+                 store_dir: Optional[str] = None,
+                 rejected_hashes: Optional[Set[str]] = None,
+                ) -> DownloadResult:
+    """Download ``task.url`` and atomically write the body to ``task.out_path``.
+
+    See :func:`_stream_to_file` for how ``store_dir`` deduplicates
+    identical images and ``rejected_hashes`` refuses quarantined ones.
+
+    Responses whose ``Content-Type`` is not an image (for example HTML
+    error pages) and bodies larger than ``max_bytes`` are rejected
+    before anything reaches ``task.out_path``. Connection problems,
+    timeouts, broken transfers and the HTTP statuses in
+    :data:`_RETRIABLE_STATUS` are reported as retriable failures, with
+    the host's ``Retry-After`` if it sent one. ``timeout`` is passed to
+    ``requests``: one value, or a ``(connect, read)`` pair where the
+    read timeout bounds every wait for the next bytes of the response.
+    """
+    try:
+        with session.get(task.url, timeout=timeout, stream=True) as response:
+            response.raise_for_status()
+
+            content_type = response.headers.get("Content-Type", "")
+            if not _is_image_content_type(content_type):
+                return DownloadResult(ok=False, http_status=response.status_code,
+                                      error=f"Unexpected Content-Type {content_type!r}")
+
+            declared = response.headers.get("Content-Length", "")
+            if max_bytes is not None and declared.isdigit() and int(declared) > max_bytes:
+                return DownloadResult(
+                    ok=False,
+                    http_status=response.status_code,
+                    error=f"Content-Length {declared} exceeds the {max_bytes} byte limit",
+                )
+
+            return _stream_to_file(response, task.out_path, max_bytes, store_dir,
+                                   rejected_hashes)
+    except requests.HTTPError as exc:
+        status = exc.response.status_code
+        retriable = status in _RETRIABLE_STATUS
+        retry_after = _parse_retry_after(exc.response.headers.get("Retry-After")) \
+            if retriable else None
+        return DownloadResult(ok=False, http_status=status, error=str(exc),
+                              retriable=retriable, retry_after=retry_after)
+    except (requests.ConnectionError, requests.Timeout,
+            requests.exceptions.ChunkedEncodingError) as exc:
+        return DownloadResult(ok=False, error=str(exc), retriable=True)
+    except Exception as exc:  # noqa: BLE001
+        return DownloadResult(ok=False, error=str(exc))
+
+
+def _error_kind(result: DownloadResult) -> str:
+    """Short label grouping failed downloads in the end-of-run summary.
+
+    The full error of each image is kept in the download manifest.
+    """
+    if result.http_status is not None and result.http_status >= 400:
+        return f"HTTP {result.http_status}"
+    return (result.error or "unknown error").split(":")[0][:80]
+
+
+def _retry_delay(attempt: int, backoff: float, retry_after: Optional[float] = None) -> float:
+    """Jittered exponential backoff delay before retry number ``attempt``.
+
+    The delay is drawn uniformly from the upper half of
+    ``backoff * 2 ** (attempt - 1)`` (capped at :data:`_MAX_BACKOFF`),
+    so a burst of failures is not retried in lockstep, and is never
+    shorter than the host's ``retry_after``.
+    """
+    delay = min(backoff * (2 ** (attempt - 1)), _MAX_BACKOFF)
+    delay = random.uniform(delay / 2, delay)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def _report_cross_split_duplicates(manifest: DownloadManifest, drop: bool) -> None:
+    """Report images shared between splits and optionally drop the extra copies.
+
+    For every duplicated image the copy in the earliest split of
+    :data:`_SPLIT_PRIORITY` is kept. With ``drop`` set, copies in later
+    splits are deleted and marked ``"duplicate"`` in the manifest, so
+    the val and test splits never contain a training image.
+    """
+    duplicates = manifest.cross_split_duplicates()
+    if duplicates.empty:
+        return
+
+    priority = duplicates["split"].map({s: i for i, s in enumerate(_SPLIT_PRIORITY)})
+    keep_priority = priority.groupby(duplicates["sha256"]).transform("min")
+    extra = duplicates[priority > keep_priority]
+
+    per_split = extra["split"].value_counts().sort_index()
+    details = ", ".join(f"{count} in {split}" for split, count in per_split.items())
+    print(
+        f"[dedup] {duplicates['sha256'].nunique()} images appear in more than "
+        f"one split; extra copies: {details}."
+    )
+    if not drop:
+        return
+
+    for row in extra.itertuples():
+        if os.path.exists(row.out_path):
+            os.remove(row.out_path)
+        manifest.mark(row.gbif_id, row.url, "duplicate")
+    manifest.commit()
+    print(f"[dedup] Dropped {len(extra)} cross-split duplicate files.")
+
+
+def _print_manifest_summary(manifest: DownloadManifest) -> None:
+    """Print per-split totals recorded in the download manifest."""
+    summary = manifest.summary()
+    for split, rows in summary.groupby("split", sort=True):
+        parts = [f"{int(r.images)} {r.status}" for r in rows.itertuples()]
+        ok_bytes = int(rows.loc[rows["status"] == "ok", "bytes"].sum())
+        print(
+            f"[manifest] {split}: {', '.join(parts)} "
+            f"({ok_bytes / 1e6:.1f} MB downloaded)"
+        )
+
+
+def _build_download_tasks(df: pd.DataFrame, base_root: str) -> List[DownloadTask]:
+    """Work out the output path and host of every row, creating folders once."""
+    species_folders: Dict[str, str] = {}
+    created_dirs: Set[str] = set()
+    tasks = []
+    class_indices = df["class_index"] if "class_index" in df.columns else itertools.repeat(None)
+
+    for idx, gbif_id, species, url, fmt, split, class_index in zip(
+        df.index, df["gbifID"], df["scientificName"],
+        df["identifier"], df["format"], df["split"], class_indices,
+    ):
+        if species not in species_folders:
+            species_folders[species] = (
+                sanitize_species_name(species) if class_index is None
+                else class_folder_name(int(class_index), species)
+            )
+        split_dir = os.path.join(base_root, split, species_folders[species])
+        if split_dir not in created_dirs:
+            os.makedirs(split_dir, exist_ok=True)
+            created_dirs.add(split_dir)
+
+        filename = f"{gbif_id}_{split}_{idx}{extension_from_format(fmt)}"
+        tasks.append(DownloadTask(
+            row_index=idx,
+            gbif_id=str(gbif_id),
+            url=url,
+            split=split,
+            out_path=os.path.join(split_dir, filename),
+            host=urlsplit(str(url)).netloc.lower(),
+        ))
+    return tasks
+
+
+def download_and_save_images(
+    df: pd.DataFrame,
+    output_dir: str,
+    connect_timeout: float = 5.0,
+    read_timeout: float = 30.0,
+    workers: int = 16,
+    max_per_host: int = 4,
+    manifest_path: Optional[str] = None,
+    max_retries: int = 3,
+    retry_backoff: float = 1.0,
+    retry_failed: bool = False,
+    max_bytes: Optional[int] = 50 * 1024 * 1024,
+    deduplicate: bool = True,
+    drop_cross_split_duplicates: bool = False,
+    metrics: Optional[PipelineMetrics] = None,
+    progress_interval: float = 10.0,
+    breaker_threshold: int = 5,
+    breaker_cooldown: float = 15.0,
+) -> None:
+    """Download images and save them in a ``model_training_data`` folder structure.
+
+    Given a DataFrame with assigned splits and species names, this
+    function downloads each image and writes it under::
+
+        <output_dir>/model_training_data/<split>/<species_folder>/<filename>
+
+    where ``<split>`` is one of ``"train"``, ``"val"`` or ``"test"``
+    and ``<species_folder>`` is derived from the scientific name, and
+    prefixed with the class index if ``df`` has a ``class_index``
+    column (see :func:`class_folder_name`).
+
+    Downloads run concurrently on a thread pool that shares one pooled
+    HTTP session, so connections to the same host are kept alive and
+    reused. ``workers`` bounds the total number of requests in flight
+    and ``max_per_host`` bounds the requests against any single host.
+    Connecting and waiting for response bytes have separate timeouts,
+    and a host that keeps failing is paused by a circuit breaker (see
+    :class:`DownloadScheduler`) so it does not hold up the others.
+
+    Every attempt is journaled in a SQLite download manifest keyed by
+    ``gbifID`` and URL. On a rerun, images the manifest records as
+    downloaded to the same path are skipped without touching the file
+    system, retriable failures (connection errors, timeouts, HTTP 408,
+    429 and 5xx) are tried again, and permanent failures are skipped
+    unless ``retry_failed`` is set. Within a run, retriable failures are
+    retried up to ``max_retries`` times with jittered exponential
+    backoff, waiting at least as long as a ``Retry-After`` header asks.
+
+    Response bodies are streamed to a temporary file in fixed-size
+    chunks, fsynced and renamed into place, so an interrupted write
+    never leaves a truncated image under its final name. Responses that
+    are not images or exceed ``max_bytes`` are rejected.
+
+    With ``deduplicate`` enabled, every distinct image (by SHA-256) is
+    stored once under ``model_training_data/.objects/`` and hard-linked
+    into the split folders, so the same photo published under several
+    ``gbifID``\\ s only takes disk space once. Images that end up in more
+    than one split are reported at the end, and dropped from the later
+    split if ``drop_cross_split_duplicates`` is set.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        DataFrame that must contain the columns ``gbifID``,
+        ``scientificName``, ``identifier``, ``format`` and ``split``.
+    output_dir : str
+        Base directory under which the ``model_training_data`` folder
+        will be created.
+    connect_timeout : float, optional
+        Seconds allowed for establishing a connection. The default is 5.
+    read_timeout : float, optional
+        Seconds allowed between two reads of a response, including the
+        wait for its headers. The default is 30.
+    workers : int, optional
+        Maximum number of concurrent downloads. The default is 16.
+    max_per_host : int, optional
+        Maximum number of concurrent downloads from a single host. The
+        default is 4.
+    manifest_path : str, optional
+        Path of the SQLite download manifest. The default is
+        ``<output_dir>/model_training_data/download_manifest.sqlite``.
+    max_retries : int, optional
+        Number of times a retriable failure is retried within this run.
+        The default is 3.
+    retry_backoff : float, optional
+        Upper bound in seconds of the jittered delay before the first
+        retry; each further retry doubles it. The default is 1.0.
+    retry_failed : bool, optional
+        If ``True``, also retry images whose previous failure was
+        permanent (e.g. HTTP 404). The default is ``False``.
+    max_bytes : int, optional
+        Largest accepted image size in bytes. Larger responses are
+        discarded and recorded as failures. ``None`` disables the limit.
+        The default is 50 MB.
+    deduplicate : bool, optional
+        Store identical images once and hard-link them into place. The
+        default is ``True``.
+    drop_cross_split_duplicates : bool, optional
+        Delete copies of an image from later splits (val, then test) when
+        the same image is already present in an earlier split. The
+        default is ``False``, which only reports them.
+    metrics : PipelineMetrics, optional
+        Receives the latency of every request per host and the number
+        of bytes downloaded.
+    progress_interval : float, optional
+        Seconds between two aggregated progress lines. The default is 10.
+    breaker_threshold : int, optional
+        Consecutive retriable failures after which a host is paused.
+        ``0`` disables the circuit breakers. The default is 5.
+    breaker_cooldown : float, optional
+        Seconds a host is first paused for; repeated pauses double it.
+        The default is 15.
+
+    Returns
+    -------
+    None
+
+    Notes
+    -----
+    Failed downloads are skipped. As a result, it is possible for a
+    species to be missing from one or more splits if all downloads for
+    that species/split combination fail; :func:`backfill_missing_cells`
+    refills such splits from the species' unselected images. Progress is printed as one
+    aggregated line every ``progress_interval`` seconds rather than per
+    image. At the end the script prints the number of successful
+    downloads of this run, the most common failure causes (the error of
+    every image is kept in the manifest) and the per-split totals stored
+    in the manifest.
+    """
+    required_cols = {"gbifID", "scientificName", "identifier", "format", "split"}
+    missing = required_cols.difference(df.columns)
+    if missing:
+        raise ValueError(f"Input DataFrame is missing required columns: {missing}")
+
+    base_root = os.path.join(output_dir, "model_training_data")
+    splits = ["train", "val", "test"]
+
+    for split in splits:
+        split_dir = os.path.join(base_root, split)
+        os.makedirs(split_dir, exist_ok=True)
+
+    store_dir = None
+    if deduplicate:
+        store_dir = os.path.join(base_root, ".objects")
+        os.makedirs(store_dir, exist_ok=True)
+
+    session = _make_session(workers, max_per_host)
+    # Digests of quarantined images, filled from the manifest below.
+    quarantined: Set[str] = set()
+
+    def fetch(task: DownloadTask) -> DownloadResult:
+        start = time.perf_counter()
+        result = _fetch_image(session, task, (connect_timeout, read_timeout),
+                              max_bytes, store_dir, quarantined)
+        result.seconds = time.perf_counter() - start
+        return result
+
+    scheduler = DownloadScheduler(
+        fetch,
+        workers=workers,
+        max_per_host=max_per_host,
+        breaker_threshold=breaker_threshold,
+        breaker_cooldown=breaker_cooldown,
+    )
+
+    if manifest_path is None:
+        manifest_path = os.path.join(base_root, "download_manifest.sqlite")
+
+    with DownloadManifest(manifest_path) as manifest, session:
+        known = manifest.load_states()
+        quarantined.update(manifest.quarantined_hashes())
+        tasks = _build_download_tasks(df, base_root)
+        total_rows = len(tasks)
+        already_done = 0
+        known_failed = 0
+        for task in tasks:
+            status, out_path = known.get((task.gbif_id, task.url), (None, None))
+            if status in ("ok", "duplicate") and out_path == task.out_path:
+                already_done += 1
+                continue
+            if status in ("failed", "invalid") and not retry_failed:
+                known_failed += 1
+                continue
+            scheduler.add(task)
+
+        if already_done or known_failed:
+            print(
+                f"[skip] {already_done} images already downloaded and "
+                f"{known_failed} known permanent failures, per {manifest_path}."
+            )
+
+        success_count = 0
+        failure_count = 0
+        dedup_count = 0
+        errors: Counter = Counter()
+        progress = ProgressReporter("download", total_rows - already_done - known_failed,
+                                    interval=progress_interval)
+        for task, result in scheduler.run():
+            task.attempts += result.attempted
+            if metrics is not None and result.attempted:
+                metrics.observe_download(task.host, result.seconds, result.ok, result.num_bytes)
+            if result.ok:
+                manifest.record(task, result, status="ok")
+                success_count += 1
+                dedup_count += result.deduplicated
+                progress.update(done=1, num_bytes=result.num_bytes)
+                continue
+
+            if result.retriable and result.attempted and task.attempts <= max_retries:
+                manifest.record(task, result, status="retry")
+                scheduler.add(task, delay=_retry_delay(task.attempts, retry_backoff,
+                                                       result.retry_after))
+                continue
+
+            manifest.record(task, result, status="invalid" if result.quarantined
+                            else "retry" if result.retriable else "failed")
+            failure_count += 1
+            errors[_error_kind(result)] += 1
+            progress.update(failed=1)
+
+        manifest.commit()
+        progress.finish()
+        print(
+            f"[done] Successfully downloaded {success_count} images "
+            f"into {base_root} ({already_done} already present, "
+            f"{failure_count} failed)."
+        )
+        if dedup_count:
+            print(f"[dedup] {dedup_count} downloads matched an already stored image.")
+        if scheduler.hosts_parked:
+            print(f"[warning] Image hosts were paused {scheduler.hosts_parked} times "
+                  "by their circuit breakers.")
+        for kind, count in errors.most_common(5):
+            print(f"[warning] {count} downloads failed with {kind}.")
+        _report_cross_split_duplicates(manifest, drop=drop_cross_split_duplicates)
+        _print_manifest_summary(manifest)
+
+
+def retire_images(retired: pd.DataFrame,
+                  output_dir: str,
+                  manifest_path: Optional[str] = None,
+                 ) -> int:
+    """Delete the images of records that disappeared from the archive.
+
+    The files of ``retired`` are removed from ``model_training_data``
+    and from any resized ``model_training_data_<size>px`` copy next to
+    it, and their manifest rows are marked ``"retired"``.
+
+    Parameters
+    ----------
+    retired : pandas.DataFrame
+        Rows of a previous labeled subset, indexed by their row number,
+        as returned by :func:`extend_labeled_subset`.
+    output_dir : str
+        Output directory the images were downloaded under.
+    manifest_path : str, optional
+        Path of the download manifest. The default is
+        ``<output_dir>/model_training_data/download_manifest.sqlite``.
+
+    Returns
+    -------
+    int
+        Number of files deleted.
+    """
+    if retired.empty:
+        return 0
+
+    base_root = os.path.join(output_dir, "model_training_data")
+    if manifest_path is None:
+        manifest_path = os.path.join(base_root, "download_manifest.sqlite")
+    resized_roots = [
+        os.path.join(output_dir, name) for name in os.listdir(output_dir)
+        if re.fullmatch(r"model_training_data_\d+px", name)
+    ]
+
+    removed = 0
+    out_paths = []
+    for task in _build_download_tasks(retired, base_root):
+        out_paths.append(task.out_path)
+        relative = os.path.relpath(task.out_path, base_root)
+        candidates = [task.out_path] + [
+            os.path.join(root, os.path.splitext(relative)[0] + ".jpg") for root in resized_roots
+        ]
+        for path in candidates:
+            if os.path.exists(path):
+                os.remove(path)
+                removed += 1
+
+    with DownloadManifest(manifest_path) as manifest:
+        manifest.mark_paths(out_paths, "retired")
+    print(f"[delta] Retired {len(retired)} images ({removed} files deleted).")
+    return removed
+
+
+def select_reserve(records: pd.DataFrame, subset: pd.DataFrame) -> pd.DataFrame:
+    """Return the unselected images of the species in ``subset``.
+
+    These are the rows of ``records`` (the filtered table the subset
+    was drawn from) whose species is in ``subset`` but whose image is
+    not, each image once. They are sorted by species and then by a
+    salted hash of their URL, so the reserve order is stable across
+    runs and machines.
+
+    Parameters
+    ----------
+    records : pandas.DataFrame
+        Filtered image records, as returned by
+        :func:`filter_image_records`.
+    subset : pandas.DataFrame
+        Labeled subset with a ``scientificName`` and an ``identifier``
+        column.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Reserve rows in order, with a fresh index.
+    """
+    candidates = records[
+        records["scientificName"].isin(subset["scientificName"].unique())
+        & ~records["identifier"].isin(subset["identifier"])
+    ].drop_duplicates("identifier")
+    position = _hash_unit_interval(candidates["identifier"], _RESERVE_SALT)
+    species_codes, _ = pd.factorize(candidates["scientificName"], sort=True)
+    return candidates.iloc[np.lexsort((position, species_codes))].reset_index(drop=True)
+
+
+def find_missing_cells(df: pd.DataFrame,
+                       output_dir: str,
+                       manifest_path: Optional[str] = None,
+                      ) -> pd.DataFrame:
+    """Return the (species, split) cells of ``df`` without a downloaded image.
+
+    Every species of ``df`` should have an image in each of train, val
+    and test. A cell counts as missing if the download manifest records
+    none of the species' images in that split as ``"ok"``: they failed,
+    were quarantined as invalid or were dropped as cross-split
+    duplicates, or ``df`` has none there at all, e.g. because
+    :func:`extend_labeled_subset` retired them.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per missing cell, with ``scientificName`` and ``split``
+        columns.
+    """
+    base_root = os.path.join(output_dir, "model_training_data")
+    if manifest_path is None:
+        manifest_path = os.path.join(base_root, "download_manifest.sqlite")
+    with DownloadManifest(manifest_path) as manifest:
+        states = manifest.load_states()
+    ok = [states.get((task.gbif_id, task.url), (None, None))[0] == "ok"
+          for task in _build_download_tasks(df, base_root)]
+    downloaded = pd.Series(ok, index=df.index).groupby(
+        [df["scientificName"], df["split"]], sort=True).any()
+    cells = pd.MultiIndex.from_product(
+        [np.unique(df["scientificName"].to_numpy(dtype=object)), ["train", "val", "test"]],
+        names=["scientificName", "split"])
+    downloaded = downloaded.reindex(cells, fill_value=False).sort_index()
+    return downloaded[~downloaded].reset_index()[["scientificName", "split"]]
+
+
+def backfill_missing_cells(labeled_subset: pd.DataFrame,
+                           reserve_source: Callable[[], pd.DataFrame],
+                           download: Callable[[pd.DataFrame], None],
+                           output_dir: str,
+                           manifest_path: Optional[str] = None,
+                           validate: Optional[Callable[[], None]] = None,
+                          ) -> pd.DataFrame:
+    """Replace failed downloads from a reserve until every cell has an image.
+
+    A species loses a split when every download assigned to it fails,
+    is quarantined or is dropped as a cross-split duplicate. For each
+    such (species, split) cell (see :func:`find_missing_cells`), the
+    next image of that species from the reserve is assigned to the
+    split and downloaded. This repeats, one replacement per missing cell
+    and round, until no cell is missing or the reserve of every species
+    that still misses a cell is used up. Replacements keep the split of
+    the cell they fill, even with ``--split_method hash``.
+
+    Parameters
+    ----------
+    labeled_subset : pandas.DataFrame
+        Subset that was just downloaded, with a ``split`` column.
+    reserve_source : callable
+        Returns the reserve rows in the order they should be used, as
+        :func:`select_reserve` does. Only called if a cell is missing.
+    download : callable
+        Downloads a DataFrame of replacements into ``output_dir``, as
+        :func:`download_and_save_images` does.
+    output_dir : str
+        Output directory of the downloads.
+    manifest_path : str, optional
+        Path of the download manifest. The default is
+        ``<output_dir>/model_training_data/download_manifest.sqlite``.
+    validate : callable, optional
+        Validates the downloads and marks broken files in the manifest,
+        called after each round of replacements.
+
+    Returns
+    -------
+    pandas.DataFrame
+        ``labeled_subset`` with the replacement rows appended. Their
+        index continues after the largest index of ``labeled_subset``.
+    """
+    missing = find_missing_cells(labeled_subset, output_dir, manifest_path)
+    if missing.empty:
+        return labeled_subset
+    initially_missing = set(zip(missing["scientificName"], missing["split"]))
+    print(f"[backfill] {len(initially_missing)} species/split cells have no downloaded image.")
+
+    reserve = reserve_source().drop(columns=["split"], errors="ignore")
+    reserve["_rank"] = reserve.groupby("scientificName", sort=False).cumcount()
+    available = reserve["scientificName"].value_counts()
+    used: Counter = Counter()
+    result = labeled_subset
+    rounds = 0
+    replaced = 0
+    while True:
+        # Only cells whose species has reserve images left can be filled.
+        left = np.array([available.get(name, 0) - used[name]
+                         for name in missing["scientificName"]], dtype=np.int64)
+        fillable = missing[left > 0]
+        if fillable.empty:
+            break
+        # Successive missing cells of one species take successive
+        # reserve images.
+        offset = np.array([used[name] for name in fillable["scientificName"]], dtype=np.int64)
+        fillable = fillable.assign(
+            _rank=fillable.groupby("scientificName").cumcount().to_numpy() + offset)
+        replacements = fillable.merge(reserve, on=["scientificName", "_rank"])
+        used.update(replacements["scientificName"].tolist())
+        first_index = int(result.index.max()) + 1
+        replacements = replacements.reindex(columns=labeled_subset.columns)
+        replacements.index = pd.RangeIndex(first_index, first_index + len(replacements))
+
+        rounds += 1
+        replaced += len(replacements)
+        print(f"[backfill] Round {rounds}: downloading {len(replacements)} replacement images.")
+        download(replacements)
+        if validate is not None:
+            validate()
+        result = pd.concat([result, replacements])
+        missing = find_missing_cells(result, output_dir, manifest_path)
+
+    filled = initially_missing.difference(zip(missing["scientificName"], missing["split"]))
+    print(f"[backfill] {len(filled)} of {len(initially_missing)} cells "
+          f"filled with {replaced} replacement images in {rounds} rounds.")
+    if len(missing):
+        print(f"[warning] {len(missing)} species/split cells stay empty; their species "
+              "have no reserve images left.")
+    return result
+
+
+def _parse_shard(text: str) -> Tuple[int, int]:
+    """Parse a ``--shard`` value such as ``"0/4"`` into ``(index, count)``."""
+    match = re.fullmatch(r"\s*(\d+)\s*/\s*(\d+)\s*", text)
+    if not match or not 0 <= int(match.group(1)) < int(match.group(2)):
+        raise argparse.ArgumentTypeError(
+            f"Invalid shard {text!r}; expected INDEX/COUNT with 0 <= INDEX < COUNT, e.g. 0/4."
+        )
+    return int(match.group(1)), int(match.group(2))
+
+
+def select_shard(df: pd.DataFrame, index: int, count: int) -> pd.DataFrame:
+    """Return the rows of ``df`` that belong to shard ``index`` of ``count``.
+
+    Rows are assigned by a salted hash of their ``gbifID``, so every
+    machine that computes the same labeled subset takes a disjoint slice
+    of it without any coordination, the slices cover the whole subset,
+    and the images of one occurrence stay on one machine. The index of
+    ``df`` (which appears in file names) is kept.
+    """
+    position = _hash_unit_interval(df["gbifID"], _SHARD_SALT)
+    shard = np.minimum((position * count).astype(np.int64), count - 1)
+    selected = df[shard == index]
+    print(f"[info] Shard {index}/{count} takes {len(selected)} of {len(df)} images.")
+    return selected
+
+
+def _shard_manifest_name(index: int, count: int) -> str:
+    return f"download_manifest.shard-{index}-of-{count}.sqlite"
+
+
+def merge_shard_outputs(sources: Sequence[str],
+                        output_dir: str,
+                        deduplicate: bool = True,
+                        drop_cross_split_duplicates: bool = False,
+                       ) -> int:
+    """Combine the output trees and manifests of sharded runs into one dataset.
+
+    Every source is the ``--output_dir`` of one or more ``--shard``
+    runs, either on a shared file system or copied from the machines.
+    All download manifests found in their ``model_training_data``
+    folders are merged into the single manifest of ``output_dir``, and
+    the downloaded images are hard-linked (or copied) into its
+    ``<split>/<species>/`` tree. With ``deduplicate``, identical images
+    from different machines share one file in the ``.objects`` store.
+    Finally the merged manifest is checked for images that landed in
+    more than one split and its per-split totals are printed.
+
+    Parameters
+    ----------
+    sources : sequence of str
+        Output directories of the sharded runs. ``output_dir`` itself may
+        be one of them.
+    output_dir : str
+        Output directory of the merged dataset.
+    deduplicate : bool, optional
+        Store identical images once in the merged tree. The default is
+        ``True``.
+    drop_cross_split_duplicates : bool, optional
+        Delete later-split copies of images found in an earlier split,
+        as in :func:`download_and_save_images`.
+
+    Returns
+    -------
+    int
+        Number of downloaded images in the merged dataset.
+
+    Raises
+    ------
+    FileNotFoundError
+        If a source contains no shard manifest.
+    """
+    base_root = os.path.join(output_dir, "model_training_data")
+    manifest_path = os.path.join(base_root, "download_manifest.sqlite")
+    store_dir = os.path.join(base_root, ".objects") if deduplicate else None
+    os.makedirs(base_root, exist_ok=True)
+
+    shards_seen: Dict[int, Set[int]] = {}
+    linked = 0
+    missing = 0
+    with DownloadManifest(manifest_path) as manifest:
+        for source in sources:
+            source_root = os.path.join(source, "model_training_data")
+            names = sorted(name for name in os.listdir(source_root)
+                           if re.fullmatch(r"download_manifest\.shard-\d+-of-\d+\.sqlite", name)) \
+                if os.path.isdir(source_root) else []
+            if not names:
+                raise FileNotFoundError(f"No shard manifest found in {source_root}.")
+
+            for name in names:
+                index, count = map(int, re.findall(r"\d+", name))
+                shards_seen.setdefault(count, set()).add(index)
+                with DownloadManifest(os.path.join(source_root, name)) as shard_manifest:
+                    rows = shard_manifest.rows()
+
+                # Paths are rebuilt from their last three components
+                # (split, species folder, file name), so trees copied
+                # from other machines merge as well.
+                relative = rows["out_path"].fillna("").map(
+                    lambda path: os.path.join(*path.replace("\\", "/").split("/")[-3:])
+                    if path else "")
+                rows["out_path"] = [os.path.join(base_root, rel) if rel else None
+                                    for rel in relative]
+                for row_id in np.flatnonzero((rows["status"] == "ok").to_numpy()):
+                    src = os.path.join(source_root, relative.iloc[row_id])
+                    dst = rows["out_path"].iloc[row_id]
+                    if not os.path.exists(src):
+                        rows.loc[rows.index[row_id], ["status", "error"]] = ["retry", "Missing from shard output"]
+                        missing += 1
+                        continue
+                    if os.path.abspath(src) == os.path.abspath(dst):
+                        continue
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    digest = rows["sha256"].iloc[row_id]
+                    if store_dir is not None and isinstance(digest, str):
+                        blob_dir = os.path.join(store_dir, digest[:2])
+                        blob_path = os.path.join(blob_dir, digest + os.path.splitext(dst)[1])
+                        if not os.path.exists(blob_path):
+                            os.makedirs(blob_dir, exist_ok=True)
+                            _link_into_place(src, blob_path)
+                        _link_into_place(blob_path, dst)
+                    else:
+                        _link_into_place(src, dst)
+                    linked += 1
+
+                manifest.import_rows(rows)
+                print(f"[merge] {source}: {name} with {int((rows['status'] == 'ok').sum())} "
+                      f"images of {len(rows)} records.")
+
+        for count, indices in sorted(shards_seen.items()):
+            absent = sorted(set(range(count)) - indices)
+            if absent:
+                print(f"[warning] Shards {absent} of {count} are missing from the merge.")
+        if missing:
+            print(f"[warning] {missing} images recorded as downloaded were missing and "
+                  "are marked for retry.")
+        print(f"[done] Merged {len(sources)} shard outputs into {base_root} "
+              f"({linked} images linked or copied).")
+        _report_cross_split_duplicates(manifest, drop=drop_cross_split_duplicates)
+        _print_manifest_summary(manifest)
+        downloaded = int((manifest.rows()["status"] == "ok").sum())
+    return downloaded
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse command-line arguments for the data preparation script.
+
+    Returns
+    -------
+    argparse.Namespace
+        Namespace containing the parsed command-line options.
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Prepare a small, balanced GBIF/Pl@ntNet sample for model training. "
+            "The script merges occurrence and multimedia tables, filters image "
+            "records, selects a balanced subset with equal species across "
+            "train/val/test splits, and downloads the corresponding images."
+        )
+    )
+    parser.add_argument(
+        "--dwca_dir",
+        default=None,
+        help=(
+            "Path to the directory containing 'occurrence.txt' and "
+            "'multimedia.txt', or to the GBIF download .zip, which is read "
+            "without extracting it. Required unless --merge_shards is given."
+        ),
+    )
+    parser.add_argument(
+        "--output_dir",
+        default=".",
+        help=(
+            "Base directory where the 'model_training_data' folder will "
+            "be created. Default is the current directory."
+        ),
+    )
+    parser.add_argument(
+        "--max_images",
+        type=int,
+        default=100,
+        help=(
+            "Maximum total number of images to include. Because each species "
+            "contributes exactly three images (one per split), the script can "
+            "include at most floor(max_images / 3) species."
+        ),
+    )
+    parser.add_argument(
+        "--max_per_species",
+        type=int,
+        default=None,
+        help=(
+            "Maximum number of images a single species may contribute "
+            "(at least 3). Default is no cap."
+        ),
+    )
+    parser.add_argument(
+        "--split_ratios",
+        type=float,
+        nargs=3,
+        default=None,
+        metavar=("TRAIN", "VAL", "TEST"),
+        help=(
+            "Relative sizes of the train, val and test splits, e.g. "
+            "'0.8 0.1 0.1'. Every species still gets at least one image per "
+            "split. Default is a round-robin distribution."
+        ),
+    )
+    parser.add_argument(
+        "--split_method",
+        choices=["shuffle", "hash"],
+        default="shuffle",
+        help=(
+            "'shuffle' shuffles each species and deals its images into the "
+            "splits. 'hash' derives every image's split from a salted hash "
+            "of its gbifID, so it does not change when other records are "
+            "added or removed; a few images are moved so every species "
+            "still reaches all three splits. Default is 'shuffle'."
+        ),
+    )
+    parser.add_argument(
+        "--split_salt",
+        default=DEFAULT_SPLIT_SALT,
+        help=(
+            "Salt of the hash used by --split_method hash. Changing it draws "
+            f"a different split. Default is '{DEFAULT_SPLIT_SALT}'."
+        ),
+    )
+    parser.add_argument(
+        "--labels",
+        default=None,
+        help=(
+            "Label file of the app's classifier, one class per line (e.g. "
+            "'assets/model/labels.txt'). Only records of these classes are "
+            "read, matched by name regardless of authorship, and class "
+            "folders are numbered by line. Default is every species."
+        ),
+    )
+    parser.add_argument(
+        "--max_multimedia_rows",
+        type=int,
+        default=50000,
+        help=(
+            "Maximum number of rows to read from 'multimedia.txt' using the "
+            "nrows argument of pandas.read_csv. Use a smaller value for quick "
+            "testing or a larger value to see more of the dataset. A value of "
+            "0 or less reads every row."
+        ),
+    )
+    parser.add_argument(
+        "--max_occurrence_rows",
+        type=int,
+        default=50000,
+        help=(
+            "Maximum number of rows to read from 'occurrence.txt' using the "
+            "nrows argument of pandas.read_csv. A value of 0 or less reads "
+            "every row."
+        ),
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help=(
+            "Read both tables in chunks and hash-join them on gbifID under "
+            "--memory_budget_mb, spilling to disk when needed. Use this to "
+            "process the full archive without row caps."
+        ),
+    )
+    parser.add_argument(
+        "--memory_budget_mb",
+        type=int,
+        default=1024,
+        help=(
+            "Memory budget in megabytes for the in-memory side of the "
+            "streaming join. Default is 1024."
+        ),
+    )
+    parser.add_argument(
+        "--chunk_rows",
+        type=int,
+        default=100_000,
+        help="Number of rows per chunk when --streaming is set. Default is 100000.",
+    )
+    parser.add_argument(
+        "--spill_dir",
+        default=None,
+        help=(
+            "Directory for temporary spill files of the streaming join. "
+            "Default is the system temporary directory."
+        ),
+    )
+    parser.add_argument(
+        "--parse_workers",
+        type=int,
+        default=None,
+        help=(
+            "Number of processes parsing occurrence.txt when it is read whole "
+            "(no --streaming, --cache_dir or row limit). Default is the CPU count."
+        ),
+    )
+    parser.add_argument(
+        "--cache_dir",
+        default=None,
+        help=(
+            "Directory for a columnar (Parquet) cache of the archive. The "
+            "cache is built on first use, rebuilt whenever the source files "
+            "change, and read through a memory map on later runs. Requires "
+            "pyarrow."
+        ),
+    )
+    parser.add_argument(
+        "--ingest_only",
+        action="store_true",
+        help="Build or refresh the --cache_dir cache, then exit.",
+    )
+    parser.add_argument(
+        "--stage_cache_dir",
+        default=None,
+        help=(
+            "Directory in which the results of the load, filter, select and "
+            "split stages are cached, keyed by the source files and the "
+            "parameters of each stage. A rerun resumes after the last stage "
+            "whose inputs did not change. Default is no caching."
+        ),
+    )
+    parser.add_argument(
+        "--stage_cache_mb",
+        type=int,
+        default=4096,
+        help=(
+            "Size limit of --stage_cache_dir in megabytes; the least recently "
+            "used results are evicted beyond it. Default is 4096."
+        ),
+    )
+    parser.add_argument(
+        "--download_workers",
+        type=int,
+        default=16,
+        help="Maximum number of concurrent image downloads. Default is 16.",
+    )
+    parser.add_argument(
+        "--max_per_host",
+        type=int,
+        default=4,
+        help=(
+            "Maximum number of concurrent downloads from a single image host. "
+            "Default is 4."
+        ),
+    )
+    parser.add_argument(
+        "--max_retries",
+        type=int,
+        default=3,
+        help=(
+            "Number of times a retriable download failure (connection error, "
+            "timeout, HTTP 408/429/5xx) is retried with backoff. Default is 3."
+        ),
+    )
+    parser.add_argument(
+        "--connect_timeout",
+        type=float,
+        default=5.0,
+        help="Seconds allowed for connecting to an image host. Default is 5.",
+    )
+    parser.add_argument(
+        "--read_timeout",
+        type=float,
+        default=30.0,
+        help=(
+            "Seconds allowed between two reads of a response, including the wait "
+            "for its headers. Default is 30."
+        ),
+    )
+    parser.add_argument(
+        "--breaker_threshold",
+        type=int,
+        default=5,
+        help=(
+            "Consecutive retriable failures after which an image host is paused "
+            "while the other hosts keep downloading. 0 disables this. Default is 5."
+        ),
+    )
+    parser.add_argument(
+        "--breaker_cooldown",
+        type=float,
+        default=15.0,
+        help=(
+            "Seconds a failing host is first paused for; every further pause "
+            "doubles it, and a host is given up for the run after 4. Default is 15."
+        ),
+    )
+    parser.add_argument(
+        "--retry_failed",
+        action="store_true",
+        help=(
+            "Also retry images the download manifest records as permanent "
+            "failures (e.g. HTTP 404)."
+        ),
+    )
+    parser.add_argument(
+        "--max_image_mb",
+        type=float,
+        default=50,
+        help=(
+            "Largest accepted image size in megabytes; larger downloads are "
+            "discarded. 0 disables the limit. Default is 50."
+        ),
+    )
+    parser.add_argument(
+        "--no_dedup",
+        action="store_true",
+        help=(
+            "Write every download as its own file instead of storing identical "
+            "images once and hard-linking them into the split folders."
+        ),
+    )
+    parser.add_argument(
+        "--drop_cross_split_duplicates",
+        action="store_true",
+        help=(
+            "Delete copies of an image from val/test when the same image is "
+            "already in an earlier split, keeping the evaluation splits clean."
+        ),
+    )
+    parser.add_argument(
+        "--shard",
+        type=_parse_shard,
+        default=None,
+        metavar="INDEX/COUNT",
+        help=(
+            "Only download slice INDEX (0-based) of COUNT disjoint slices of the "
+            "selected images, assigned by a hash of gbifID, into a per-shard "
+            "manifest. Run one node per slice with otherwise identical options, "
+            "then combine the outputs with --merge_shards."
+        ),
+    )
+    parser.add_argument(
+        "--merge_shards",
+        nargs="+",
+        default=None,
+        metavar="DIR",
+        help=(
+            "Instead of downloading, merge the --output_dir trees of --shard runs "
+            "into --output_dir (manifests, images and a single summary), then "
+            "validate, backfill, resize and pack the merged dataset as requested. "
+            "The backfill recomputes the labeled subset, so pass the --dwca_dir "
+            "and selection options of the shard runs, or --no_backfill."
+        ),
+    )
+    parser.add_argument(
+        "--no_backfill",
+        action="store_true",
+        help=(
+            "Do not replace failed, quarantined or dropped downloads. By default, "
+            "a species left without images in a split gets replacement images "
+            "from its unselected images in the same run."
+        ),
+    )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help=(
+            "After downloading, check every image (magic bytes, truncation, "
+            "header dimensions) in a process pool and move broken files to "
+            "'<output_dir>/quarantine'. Results are cached by file size and "
+            "modification time. Requires Pillow."
+        ),
+    )
+    parser.add_argument(
+        "--validate_workers",
+        type=int,
+        default=None,
+        help="Number of processes used for validation. Default is the CPU count.",
+    )
+    parser.add_argument(
+        "--resize_size",
+        type=int,
+        default=0,
+        help=(
+            "After downloading, write a copy of every image resized to "
+            "SIZE x SIZE pixels and re-encoded as JPEG into "
+            "'model_training_data_<SIZE>px' (same split/species layout). "
+            f"The app's model uses {MODEL_INPUT_SIZE}. Default 0 skips this step. "
+            "Requires Pillow."
+        ),
+    )
+    parser.add_argument(
+        "--resize_quality",
+        type=int,
+        default=90,
+        help="JPEG quality of the resized images. Default is 90.",
+    )
+    parser.add_argument(
+        "--resize_workers",
+        type=int,
+        default=None,
+        help="Number of processes used for resizing. Default is the CPU count.",
+    )
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help=(
+            "Also pack the images (the resized copy if --resize_size is set) "
+            "into sequential tar shards plus an index.csv mapping each sample "
+            "to (shard, offset, length, class_index, split), written to "
+            "'<dataset folder>_packed'."
+        ),
+    )
+    parser.add_argument(
+        "--pack_shard_mb",
+        type=int,
+        default=256,
+        help="Target size of each packed shard in megabytes. Default is 256.",
+    )
+    parser.add_argument(
+        "--reservoir",
+        action="store_true",
+        help=(
+            "Select the subset in one streaming pass with per-species reservoir "
+            "sampling, so memory scales with species x --max_per_species instead "
+            "of the archive size. Requires --max_per_species."
+        ),
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help=(
+            "Only process records added since the last run's snapshot: keep "
+            "existing split assignments, retire images of removed records and "
+            "fill the max_images budget from the new records. With --max_*_rows "
+            "limits nothing is retired, since records beyond the cap may still exist."
+        ),
+    )
+    parser.add_argument(
+        "--snapshot_dir",
+        type=str,
+        default=None,
+        help=(
+            "Where --incremental keeps its snapshot. Default is "
+            "<output_dir>/model_training_data/snapshot."
+        ),
+    )
+    parser.add_argument(
+        "--metrics_report",
+        type=str,
+        default=None,
+        help=(
+            "Path of the JSON metrics report with per-stage timings, memory "
+            "and download latencies. Default is <output_dir>/pipeline_metrics.json."
+        ),
+    )
+    parser.add_argument(
+        "--progress_interval",
+        type=float,
+        default=10.0,
+        help="Seconds between two aggregated download progress lines. Default is 10.",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=PROFILERS,
+        action="append",
+        default=[],
+        help=(
+            "Profile the run with cProfile (statistics dumped to "
+            "<output_dir>/pipeline.prof) and/or tracemalloc (top allocation "
+            "sites added to the metrics report). Can be given twice."
+        ),
+    )
+    return parser.parse_args()
+
+
+def _discard_blobs(store_dir: str, hashes: Iterable[str]) -> int:
+    """Delete the stored copies of ``hashes`` from a ``.objects`` store."""
+    removed = 0
+    for digest in hashes:
+        blob_dir = os.path.join(store_dir, digest[:2])
+        if not os.path.isdir(blob_dir):
+            continue
+        for name in os.listdir(blob_dir):
+            if os.path.splitext(name)[0] == digest:
+                os.remove(os.path.join(blob_dir, name))
+                removed += 1
+    return removed
+
+
+def _validate_downloads(args: argparse.Namespace,
+                        manifest_path: Optional[str] = None,
+                       ) -> pd.DataFrame:
+    """Validate the downloaded images and mark broken ones in the manifest.
+
+    With ``--shard``, only the images of this shard's manifest are
+    checked, since other shards writing into the same tree record their
+    images in their own manifests.
+    """
+    dataset_root = os.path.join(args.output_dir, "model_training_data")
+    manifest_path = manifest_path or os.path.join(dataset_root, "download_manifest.sqlite")
+    paths = None
+    if args.shard:
+        with DownloadManifest(manifest_path) as manifest:
+            paths = manifest.rows()["out_path"].dropna().tolist()
+    validation = validate_dataset(
+        dataset_root,
+        quarantine_dir=os.path.join(args.output_dir, "quarantine"),
+        workers=args.validate_workers,
+        paths=paths,
+    )
+    invalid_paths = validation.loc[~validation["ok"], "path"].tolist()
+    if invalid_paths:
+        with DownloadManifest(manifest_path) as manifest:
+            manifest.mark_paths(invalid_paths, "invalid")
+            quarantined = manifest.quarantined_hashes()
+        # Quarantining moved the split-tree links; drop the stored copy
+        # too, so no later download links the broken file back in.
+        _discard_blobs(os.path.join(dataset_root, ".objects"), quarantined)
+    return validation
+
+
+def _validate_stage(args: argparse.Namespace,
+                    metrics: PipelineMetrics,
+                    manifest_path: Optional[str] = None,
+                   ) -> None:
+    """Run :func:`_validate_downloads` as the ``validate`` metrics stage."""
+    with metrics.stage("validate") as stage:
+        validation = _validate_downloads(args, manifest_path)
+        stage.rows_in = len(validation)
+        stage.rows_out = int(validation["ok"].sum())
+
+
+def _finish_dataset(args: argparse.Namespace,
+                    metrics: PipelineMetrics,
+                    label_index: Optional[LabelIndex],
+                    manifest_path: Optional[str] = None,
+                    validated: bool = False,
+                   ) -> None:
+    """Run the steps after downloading or merging and write the metrics report.
+
+    Validation is skipped if ``validated`` says it already ran.
+    """
+    dataset_root = os.path.join(args.output_dir, "model_training_data")
+    class_index = write_class_table(label_index, dataset_root) if label_index else None
+    if args.validate and not validated:
+        _validate_stage(args, metrics, manifest_path)
+
+    if args.resize_size > 0:
+        resized_root = os.path.join(args.output_dir, f"model_training_data_{args.resize_size}px")
+        with metrics.stage("resize") as stage:
+            stage.rows_out = resize_dataset(
+                dataset_root,
+                resized_root,
+                size=args.resize_size,
+                quality=args.resize_quality,
+                workers=args.resize_workers,
+            )
+        dataset_root = resized_root
+
+    if args.pack:
+        with metrics.stage("pack") as stage:
+            index = pack_dataset(
+                dataset_root,
+                dataset_root + "_packed",
+                shard_bytes=args.pack_shard_mb * 1024 * 1024,
+                class_index=class_index,
+            )
+            stage.rows_out = len(index)
+
+    metrics.write_report(
+        args.metrics_report or os.path.join(args.output_dir, "pipeline_metrics.json")
+    )
+
+
+def main() -> None:
+    """Run the data preparation pipeline.
+
+    This high-level function performs the following steps:
+
+    1. Load and merge the occurrence and multimedia tables, restricted
+       to the classes of ``--labels`` if given (see ``label_index.py``).
+       With ``--incremental`` and a snapshot from an earlier run, steps 2-4
+       only consider the records added since then (see
+       :func:`extend_labeled_subset`). With ``--reservoir``, steps 1-3
+       run as a single streaming pass (see
+       :func:`select_streaming_subset`).
+    2. Filter the merged table to keep only plausible image records.
+    3. Select a balanced subset with one image per split for each species.
+    4. Assign explicit train/validation/test split labels, per species
+       or by hash of ``gbifID`` (``--split_method``).
+    5. Download all selected images into a ``model_training_data`` folder
+       structure under the requested output directory. With ``--shard``
+       only a hash-assigned slice of them is downloaded, and
+       ``--merge_shards`` later replaces step 5 by merging the slices
+       (see :func:`merge_shard_outputs`).
+    6. Optionally validate the downloaded files and quarantine broken
+       ones. Then, unless ``--no_backfill`` is given, refill every
+       species/split cell left without an image from the species'
+       unselected images (see :func:`backfill_missing_cells`). Shard
+       nodes skip the backfill; it runs once on the merged dataset.
+    7. Optionally resize the downloaded images into a parallel
+       ``model_training_data_<size>px`` folder.
+    8. Optionally pack the (resized) images into tar shards with a
+       random-access index.
+    9. Write a JSON metrics report with the timings, row counts and
+       memory use of every stage (see ``pipeline_metrics.py``).
+
+    Steps 1-4 are memoized in ``--stage_cache_dir`` if given (see
+    ``stage_cache.py``): a rerun resumes after the last stage whose
+    source files and parameters are unchanged.
+
+    Returns
+    -------
+    None
+    """
+    args = parse_args()
+
+    if args.dwca_dir is None and not (args.merge_shards and args.no_backfill):
+        raise ValueError(
+            "--dwca_dir is required; only --merge_shards with --no_backfill runs without it."
+        )
+    if args.shard and args.merge_shards:
+        raise ValueError("--shard cannot be combined with --merge_shards.")
+    if args.merge_shards and args.incremental:
+        raise ValueError("--merge_shards cannot be combined with --incremental.")
+    if args.shard and (args.incremental or args.resize_size > 0 or args.pack):
+        raise ValueError(
+            "--shard cannot be combined with --incremental, --resize_size or --pack; "
+            "resize and pack the dataset after --merge_shards."
+        )
+
+    if args.ingest_only:
+        if not args.cache_dir:
+            raise ValueError("--ingest_only requires --cache_dir.")
+        ingest_dwca(args.dwca_dir, args.cache_dir)
+        return
+
+    if args.reservoir and args.max_per_species is None:
+        raise ValueError("--reservoir requires --max_per_species.")
+    if args.reservoir and args.incremental:
+        raise ValueError("--reservoir cannot be combined with --incremental.")
+
+    metrics = PipelineMetrics(
+        profile=args.profile,
+        profile_path=os.path.join(args.output_dir, "pipeline.prof"),
+    )
+    label_index = LabelIndex.from_file(args.labels) if args.labels else None
+
+    if args.merge_shards:
+        with metrics.stage("merge") as stage:
+            stage.rows_out = merge_shard_outputs(
+                args.merge_shards,
+                args.output_dir,
+                deduplicate=not args.no_dedup,
+                drop_cross_split_duplicates=args.drop_cross_split_duplicates,
+            )
+        if args.dwca_dir is None:
+            _finish_dataset(args, metrics, label_index)
+            return
+        # Otherwise recompute the labeled subset the shards split between
+        # them, so the merged dataset is validated and backfilled as a
+        # whole, exactly as a single-node run would be.
+
+    max_multimedia_rows = args.max_multimedia_rows if args.max_multimedia_rows > 0 else None
+    max_occurrence_rows = args.max_occurrence_rows if args.max_occurrence_rows > 0 else None
+    snapshot_dir = args.snapshot_dir or os.path.join(
+        args.output_dir, "model_training_data", "snapshot")
+    snapshot = load_snapshot(snapshot_dir) if args.incremental else None
+
+    occ_path, mm_path = _dwca_table_paths(args.dwca_dir)
+    source = {
+        "dwca_dir": os.path.abspath(args.dwca_dir),
+        "occurrence": _source_fingerprint(occ_path),
+        "multimedia": _source_fingerprint(mm_path),
+        "max_multimedia_rows": max_multimedia_rows,
+        "max_occurrence_rows": max_occurrence_rows,
+        "labels": _file_digest(args.labels) if args.labels else None,
+    }
+    def read_chunks() -> Iterator[pd.DataFrame]:
+        return iter_occurrence_and_multimedia(
+            dwca_dir=args.dwca_dir,
+            max_multimedia_rows=max_multimedia_rows,
+            max_occurrence_rows=max_occurrence_rows,
+            memory_budget_mb=args.memory_budget_mb,
+            chunksize=args.chunk_rows,
+            spill_dir=args.spill_dir,
+            cache_dir=args.cache_dir,
+            image_records_only=True,
+            label_index=label_index,
+        )
+
+    if args.reservoir:
+        stages = [Stage(
+            "select",
+            lambda _: select_streaming_subset(
+                read_chunks(),
+                max_images=args.max_images,
+                max_per_species=args.max_per_species,
+            ),
+            dict(source, reservoir=True, max_images=args.max_images,
+                 max_per_species=args.max_per_species),
+        )]
+    else:
+        # The reader settings (streaming, cache, parse workers) do not
+        # change the merged table, so they are not part of the key.
+        stages = [Stage(
+            "load",
+            lambda _: load_occurrence_and_multimedia(
+                dwca_dir=args.dwca_dir,
+                max_multimedia_rows=max_multimedia_rows,
+                max_occurrence_rows=max_occurrence_rows,
+                streaming=args.streaming,
+                memory_budget_mb=args.memory_budget_mb,
+                chunksize=args.chunk_rows,
+                spill_dir=args.spill_dir,
+                cache_dir=args.cache_dir,
+                parse_workers=args.parse_workers or os.cpu_count() or 1,
+                image_records_only=True,
+                label_index=label_index,
+            ),
+            source,
+        )]
+        if snapshot is None:
+            stages += [
+                Stage("filter", filter_image_records),
+                Stage(
+                    "select",
+                    lambda df: select_balanced_subset(
+                        df, max_images=args.max_images, max_per_species=args.max_per_species),
+                    {"max_images": args.max_images, "max_per_species": args.max_per_species},
+                ),
+            ]
+    if snapshot is None and args.split_method == "hash":
+        stages.append(Stage(
+            "split",
+            lambda df: assign_splits_by_hash(df, args.split_ratios, args.split_salt),
+            {"split_ratios": args.split_ratios, "method": "hash", "salt": args.split_salt},
+        ))
+    elif snapshot is None:
+        stages.append(Stage(
+            "split",
+            lambda df: assign_splits_per_species(df, split_ratios=args.split_ratios),
+            {"split_ratios": args.split_ratios},
+        ))
+    stage_cache = None
+    if args.stage_cache_dir:
+        stage_cache = StageCache(args.stage_cache_dir, args.stage_cache_mb * 1024 * 1024)
+    results = run_stages(stages, stage_cache, metrics)
+    merged = results.get("load")
+    if merged is None and args.incremental:
+        # The snapshot needs the merged table even when a later stage was cached.
+        merged = run_stages(stages[:1], stage_cache, metrics)["load"]
+    archive_ids = _unique_gbif_ids(merged) if args.incremental else None
+
+    if snapshot is not None:
+        seen_ids, previous = snapshot
+        if max_multimedia_rows is not None or max_occurrence_rows is not None:
+            # A capped read cannot tell a record that left the archive
+            # from one beyond the cap, so every record seen before counts
+            # as present and nothing is retired.
+            print("[delta] The archive was read with --max_*_rows limits; "
+                  "no image is retired.")
+            archive_ids = np.union1d(seen_ids, archive_ids)
+        with metrics.stage("delta", rows_in=len(merged)) as stage:
+            merged_ids = pd.to_numeric(merged["gbifID"], errors="coerce").to_numpy()
+            added = merged[~np.isin(merged_ids, seen_ids)]
+            new_records = added[_image_record_mask(added)].fillna("")
+            print(f"[delta] {len(added)} new records, {len(new_records)} of them images.")
+            labeled_subset, retired = extend_labeled_subset(
+                previous,
+                current_ids=archive_ids,
+                new_records=new_records,
+                max_images=args.max_images,
+                max_per_species=args.max_per_species,
+                split_ratios=args.split_ratios,
+                split_method=args.split_method,
+                split_salt=args.split_salt,
+            )
+            retire_images(retired, args.output_dir)
+            stage.rows_out = len(labeled_subset)
+    else:
+        labeled_subset = results["split"]
+    full_subset = labeled_subset
+
+    def reserve_source() -> pd.DataFrame:
+        """Unselected images of the subset's species, for backfilling."""
+        if args.reservoir:
+            # A second streaming pass, keeping only the subset's species.
+            species = set(full_subset["scientificName"])
+            records = filter_image_records(pd.concat(
+                chunk[chunk["scientificName"].isin(species)] for chunk in read_chunks()))
+        elif snapshot is not None:
+            records = filter_image_records(merged)
+        elif "filter" in results:
+            records = results["filter"]
+        else:
+            records = run_stages(stages[:2], stage_cache, metrics)["filter"]
+        return select_reserve(records, full_subset)
+
+    manifest_path = None
+    if args.shard:
+        labeled_subset = select_shard(labeled_subset, *args.shard)
+        manifest_path = os.path.join(
+            args.output_dir, "model_training_data", _shard_manifest_name(*args.shard))
+
+    download_options = dict(
+        output_dir=args.output_dir,
+        manifest_path=manifest_path,
+        workers=args.download_workers,
+        max_per_host=args.max_per_host,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+        max_retries=args.max_retries,
+        retry_failed=args.retry_failed,
+        max_bytes=int(args.max_image_mb * 1024 * 1024) if args.max_image_mb > 0 else None,
+        deduplicate=not args.no_dedup,
+        drop_cross_split_duplicates=args.drop_cross_split_duplicates,
+        metrics=metrics,
+        progress_interval=args.progress_interval,
+        breaker_threshold=args.breaker_threshold,
+        breaker_cooldown=args.breaker_cooldown,
+    )
+    if not args.merge_shards:
+        with metrics.stage("download", rows_in=len(labeled_subset)) as stage:
+            images_before = metrics.images_downloaded
+            bytes_before = metrics.bytes_downloaded
+            download_and_save_images(labeled_subset, **download_options)
+            stage.rows_out = metrics.images_downloaded - images_before
+            stage.extra["bytes_downloaded"] = metrics.bytes_downloaded - bytes_before
+    # Validate before backfilling, so quarantined images are replaced too.
+    if args.validate:
+        _validate_stage(args, metrics, manifest_path)
+    # A cell's images are spread over several shards, so no shard can
+    # tell which cells are empty; the merge backfills instead.
+    if args.shard and not args.no_backfill:
+        print("[info] Skipping backfill on this shard; it runs after --merge_shards.")
+    elif not args.no_backfill:
+        with metrics.stage("backfill", rows_in=len(labeled_subset)) as stage:
+            images_before = metrics.images_downloaded
+            labeled_subset = backfill_missing_cells(
+                labeled_subset,
+                reserve_source,
+                download=lambda df: download_and_save_images(df, **download_options),
+                output_dir=args.output_dir,
+                manifest_path=manifest_path,
+                validate=(lambda: _validate_downloads(args, manifest_path)) if args.validate else None,
+            )
+            stage.rows_out = metrics.images_downloaded - images_before
+    if args.incremental:
+        save_snapshot(snapshot_dir, archive_ids, labeled_subset)
+
+    _finish_dataset(args, metrics, label_index, manifest_path, validated=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,537 @@
+"""
+Post-download image stages for the GBIF/Pl@ntNet training data.
+
+The functions in this module operate on the folder tree written by
+``format_gbif_data.py``::
+
+    <root>/<split>/<species_folder>/<filename>
+
+and are called from its ``main()`` when the corresponding command-line
+options are given. Heavy per-image work runs in a process pool sized to
+the number of CPUs.
+"""
+
+import os
+import mmap
+import sqlite3
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Collection, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is only needed for the image stages.
+    Image = None
+
+
+SPLITS = ["train", "val", "test"]
+
+# Matches OfflinePlantService.INPUT_SIZE in lib/model.dart.
+MODEL_INPUT_SIZE = 224
+
+# Leading bytes identifying each supported image format.
+_MAGIC_BYTES = [
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"II*\x00", "TIFF"),
+    (b"MM\x00*", "TIFF"),
+]
+
+# End-of-image markers a complete file contains after the first
+# _DATA_MARKERS entry; their absence means the file was truncated.
+# Complete files may carry trailing data (e.g. MPF preview images
+# appended by cameras), so the marker is not necessarily at the end.
+_END_MARKERS = {
+    "JPEG": b"\xff\xd9",
+    "PNG": b"IEND\xaeB`\x82",
+}
+# Start of the image data: the first JPEG start-of-scan marker, so an
+# EXIF thumbnail's end marker in the header does not count, and the
+# PNG chunk after the signature.
+_DATA_MARKERS = {
+    "JPEG": b"\xff\xda",
+    "PNG": b"IHDR",
+}
+
+
+def _require_pillow() -> None:
+    """Raise a helpful error if Pillow is not installed."""
+    if Image is None:
+        raise ImportError(
+            "This stage requires Pillow. Install it with 'pip install Pillow'."
+        )
+
+
+def iter_split_images(root: str) -> Iterator[Tuple[str, str, str, str]]:
+    """Yield every image file of a ``<split>/<species>/`` tree.
+
+    Hidden files (such as in-progress ``.part`` downloads) are skipped.
+
+    Parameters
+    ----------
+    root : str
+        Folder containing the ``train``, ``val`` and ``test`` splits.
+
+    Yields
+    ------
+    tuple of str
+        ``(split, species_folder, filename, path)`` for each image, in
+        sorted order.
+    """
+    for split in SPLITS:
+        split_dir = os.path.join(root, split)
+        if not os.path.isdir(split_dir):
+            continue
+        for species_folder in sorted(os.listdir(split_dir)):
+            species_dir = os.path.join(split_dir, species_folder)
+            if species_folder.startswith(".") or not os.path.isdir(species_dir):
+                continue
+            for filename in sorted(os.listdir(species_dir)):
+                if filename.startswith("."):
+                    continue
+                yield split, species_folder, filename, os.path.join(species_dir, filename)
+
+
+def nearest_resize(pixels: np.ndarray, size: int = MODEL_INPUT_SIZE) -> np.ndarray:
+    """Resize an ``(H, W, C)`` array to ``size`` x ``size`` as the app does.
+
+    ``copyResize`` of the Dart ``image`` package, used by ``predict`` in
+    ``lib/model.dart``, defaults to nearest-neighbour sampling that
+    takes source pixel ``floor(x * width / size)``. The same pixels are
+    gathered here, so training, evaluation and the app see identical
+    inputs.
+    """
+    height, width = pixels.shape[:2]
+    ys = (np.arange(size) * (height / size)).astype(np.int64)
+    xs = (np.arange(size) * (width / size)).astype(np.int64)
+    return pixels[ys[:, None], xs[None, :]]
+
+
+def _resize_one(src: str, dst: str, size: int, quality: int) -> Optional[str]:
+    """Decode ``src``, resize it to ``size`` x ``size`` and save it as JPEG.
+
+    Runs in a worker process. Returns an error message, or ``None`` on
+    success.
+    """
+    tmp_path = dst + ".tmp"
+    try:
+        # Decoded at full size: draft-mode downscaling or a smoothing
+        # filter would give pixels the app never sees.
+        with Image.open(src) as image:
+            resized = Image.fromarray(nearest_resize(np.asarray(image.convert("RGB")), size))
+
+        resized.save(tmp_path, format="JPEG", quality=quality)
+        os.replace(tmp_path, dst)
+    except Exception as exc:  # noqa: BLE001
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return f"{type(exc).__name__}: {exc}"
+    return None
+
+
+def resize_dataset(src_root: str,
+                   dst_root: str,
+                   size: int = MODEL_INPUT_SIZE,
+                   quality: int = 90,
+                   workers: Optional[int] = None,
+                  ) -> int:
+    """Write a resized JPEG copy of every image in a split tree.
+
+    Each image under ``src_root/<split>/<species>/`` is decoded, resized
+    to ``size`` x ``size`` pixels (the square input the app's model
+    expects, see ``predict`` in ``lib/model.dart``) with the app's
+    nearest-neighbour sampling (:func:`nearest_resize`) and re-encoded as
+    JPEG to the same relative folder under ``dst_root``, with the file
+    extension changed to ``.jpg``. Pixel values are kept as 8-bit RGB;
+    the ``MEAN``/``STD`` normalization is applied at training or
+    evaluation time. Images whose resized copy is already newer than
+    the original are skipped, so the stage can be rerun cheaply.
+
+    Parameters
+    ----------
+    src_root : str
+        Folder containing the downloaded ``train``/``val``/``test``
+        splits, usually ``<output_dir>/model_training_data``.
+    dst_root : str
+        Folder in which the resized tree is written.
+    size : int, optional
+        Width and height of the output images in pixels. The default is
+        224, matching ``INPUT_SIZE`` in ``lib/model.dart``.
+    quality : int, optional
+        JPEG quality of the re-encoded images. The default is 90.
+    workers : int, optional
+        Number of worker processes. The default is the CPU count.
+
+    Returns
+    -------
+    int
+        Number of images resized in this call.
+
+    Raises
+    ------
+    ImportError
+        If Pillow is not installed.
+    """
+    _require_pillow()
+
+    jobs = []
+    skipped = 0
+    for split, species_folder, filename, src in iter_split_images(src_root):
+        out_dir = os.path.join(dst_root, split, species_folder)
+        dst = os.path.join(out_dir, os.path.splitext(filename)[0] + ".jpg")
+        if os.path.exists(dst) and os.path.getmtime(dst) >= os.path.getmtime(src):
+            skipped += 1
+            continue
+        os.makedirs(out_dir, exist_ok=True)
+        jobs.append((src, dst))
+
+    print(
+        f"[info] Resizing {len(jobs)} images to {size}x{size} into {dst_root} "
+        f"({skipped} already up to date)..."
+    )
+    if not jobs:
+        return 0
+
+    workers = workers or os.cpu_count() or 1
+    resized = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        errors = pool.map(
+            _resize_one,
+            [src for src, _ in jobs],
+            [dst for _, dst in jobs],
+            [size] * len(jobs),
+            [quality] * len(jobs),
+            chunksize=max(1, min(256, len(jobs) // (workers * 4))),
+        )
+        for (src, _), error in zip(jobs, errors):
+            if error is not None:
+                print(f"[warning] Could not resize {src}: {error}")
+                continue
+            resized += 1
+
+    print(f"[done] Resized {resized} images into {dst_root}.")
+    return resized
+
+
+def pack_dataset(src_root: str,
+                 dst_dir: str,
+                 shard_bytes: int = 256 * 1024 * 1024,
+                 class_index: Optional[Dict[str, int]] = None,
+                ) -> pd.DataFrame:
+    """Pack a split tree into sequential tar shards with a random-access index.
+
+    Every image under ``src_root/<split>/<species>/`` is appended,
+    uncompressed, to ``dst_dir/<split>-NNNNNN.tar`` as the member
+    ``<species>/<filename>``. A shard is closed once it reaches
+    ``shard_bytes``. Because members are stored uncompressed, each
+    sample is one contiguous byte range of its shard: training code can
+    stream the shards sequentially, or memory-map them and slice a
+    sample out without copying.
+
+    Two small files describe the pack:
+
+    * ``index.csv`` with one row per sample and the columns ``sample``,
+      ``split``, ``shard``, ``offset``, ``length``, ``class_index`` and
+      ``species``.
+    * ``classes.csv`` mapping ``class_index`` to the species folder.
+
+    Parameters
+    ----------
+    src_root : str
+        Folder containing the ``train``/``val``/``test`` splits, for
+        example the resized tree written by :func:`resize_dataset`.
+    dst_dir : str
+        Folder in which the shards and index files are written.
+    shard_bytes : int, optional
+        Target shard size in bytes. The default is 256 MB.
+    class_index : dict, optional
+        Mapping from species folder to class index. The default numbers
+        the species folders in sorted order, as
+        ``torchvision.datasets.ImageFolder`` does.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The index that was written to ``index.csv``.
+
+    Raises
+    ------
+    ValueError
+        If ``src_root`` contains no images.
+    """
+    images = list(iter_split_images(src_root))
+    if not images:
+        raise ValueError(f"No images found under {src_root}.")
+
+    if class_index is None:
+        species_folders = sorted({species for _, species, _, _ in images})
+        class_index = {species: i for i, species in enumerate(species_folders)}
+
+    os.makedirs(dst_dir, exist_ok=True)
+    records = []
+    tar = None
+    shard_name = None
+    shard_numbers = {split: 0 for split in SPLITS}
+
+    try:
+        for split, species_folder, filename, path in images:
+            size = os.path.getsize(path)
+            if (tar is None or not shard_name.startswith(split)
+                    or (tar.offset > 0 and tar.offset + size > shard_bytes)):
+                if tar is not None:
+                    tar.close()
+                shard_name = f"{split}-{shard_numbers[split]:06d}.tar"
+                shard_numbers[split] += 1
+                tar = tarfile.open(os.path.join(dst_dir, shard_name), "w",
+                                   format=tarfile.GNU_FORMAT)
+
+            info = tarfile.TarInfo(f"{species_folder}/{filename}")
+            info.size = size
+            header_bytes = len(info.tobuf(tar.format, tar.encoding, tar.errors))
+            offset = tar.offset + header_bytes
+            with open(path, "rb") as f:
+                tar.addfile(info, f)
+
+            records.append({
+                "sample": f"{split}/{species_folder}/{filename}",
+                "split": split,
+                "shard": shard_name,
+                "offset": offset,
+                "length": size,
+                "class_index": class_index[species_folder],
+                "species": species_folder,
+            })
+    finally:
+        if tar is not None:
+            tar.close()
+
+    index = pd.DataFrame.from_records(records)
+    index.to_csv(os.path.join(dst_dir, "index.csv"), index=False)
+    classes = pd.DataFrame(
+        sorted(((i, species) for species, i in class_index.items())),
+        columns=["class_index", "species"],
+    )
+    classes.to_csv(os.path.join(dst_dir, "classes.csv"), index=False)
+
+    num_shards = sum(shard_numbers.values())
+    print(f"[done] Packed {len(index)} images into {num_shards} shards in {dst_dir}.")
+    return index
+
+
+def read_packed_sample(pack_dir: str, shard: str, offset: int, length: int) -> bytes:
+    """Return the encoded bytes of one sample listed in a pack's ``index.csv``.
+
+    Parameters
+    ----------
+    pack_dir : str
+        Folder written by :func:`pack_dataset`.
+    shard, offset, length
+        Values of the ``shard``, ``offset`` and ``length`` columns of the
+        sample's index row.
+
+    Returns
+    -------
+    bytes
+        The original image file contents.
+    """
+    with open(os.path.join(pack_dir, shard), "rb") as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def _sniff_format(head: bytes) -> Optional[str]:
+    """Return the image format identified by the first bytes of a file."""
+    for magic, fmt in _MAGIC_BYTES:
+        if head.startswith(magic):
+            return fmt
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+
+def _inspect_image(path: str) -> Tuple[bool, Optional[str], Optional[int], Optional[int], Optional[str]]:
+    """Check one file without decoding its pixels.
+
+    Runs in a worker process. Confirms the magic bytes, looks for the
+    end-of-image marker of formats that have one anywhere after the
+    start of the image data, and reads the width and height from the
+    header.
+
+    Returns
+    -------
+    tuple
+        ``(ok, format, width, height, error)``.
+    """
+    fmt = None
+    try:
+        size = os.path.getsize(path)
+        if size == 0:
+            return False, None, None, None, "empty file"
+
+        with open(path, "rb") as f:
+            fmt = _sniff_format(f.read(16))
+            if fmt is None:
+                return False, None, None, None, "unrecognized magic bytes"
+            end_marker = _END_MARKERS.get(fmt)
+            if end_marker is not None:
+                # Searched through a memory map, without reading the
+                # whole file into memory.
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    start = data.find(_DATA_MARKERS[fmt])
+                    if start < 0 or data.find(end_marker, start) < 0:
+                        return False, fmt, None, None, "truncated (no end-of-image marker)"
+
+        # Image.open only parses the header; pixel data is not decoded.
+        with Image.open(path) as image:
+            width, height = image.size
+        if width <= 0 or height <= 0:
+            return False, fmt, width, height, "invalid dimensions"
+    except Exception as exc:  # noqa: BLE001
+        return False, fmt, None, None, f"{type(exc).__name__}: {exc}"
+    return True, fmt, width, height, None
+
+
+def _open_validation_cache(cache_path: str) -> sqlite3.Connection:
+    """Open (and create if needed) the validation result cache."""
+    conn = sqlite3.connect(cache_path)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS validations (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            ok INTEGER NOT NULL,
+            format TEXT,
+            width INTEGER,
+            height INTEGER,
+            error TEXT
+        )
+        """
+    )
+    return conn
+
+
+def validate_dataset(root: str,
+                     quarantine_dir: str,
+                     cache_path: Optional[str] = None,
+                     workers: Optional[int] = None,
+                     paths: Optional[Collection[str]] = None,
+                    ) -> pd.DataFrame:
+    """Check every image of a split tree and quarantine the broken ones.
+
+    Each file is checked in a process pool: its magic bytes must match a
+    known image format, formats with an end-of-image marker (JPEG, PNG)
+    must not be truncated, and the header must decode to positive
+    dimensions. This catches HTML error pages, truncated transfers and
+    empty files before they reach a training run.
+
+    Results are cached in SQLite keyed on each file's relative path,
+    size and modification time, so re-verifying an unchanged dataset
+    only costs one ``stat`` per file. Files that fail are moved to the
+    same ``<split>/<species>/`` location under ``quarantine_dir``.
+
+    Parameters
+    ----------
+    root : str
+        Folder containing the ``train``/``val``/``test`` splits.
+    quarantine_dir : str
+        Folder that receives the files that fail validation.
+    cache_path : str, optional
+        Location of the SQLite result cache. The default is
+        ``<root>/validation_cache.sqlite``.
+    workers : int, optional
+        Number of worker processes. The default is the CPU count.
+    paths : collection of str, optional
+        Only check the files of the tree at these paths, e.g. the images
+        one machine downloaded into a shared tree. The default checks
+        every file.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per checked file with the columns ``path``, ``split``,
+        ``species``, ``ok``, ``format``, ``width``, ``height`` and
+        ``error``. ``path`` is the file's location before any
+        quarantine move.
+
+    Raises
+    ------
+    ImportError
+        If Pillow is not installed.
+    """
+    _require_pillow()
+    if cache_path is None:
+        cache_path = os.path.join(root, "validation_cache.sqlite")
+
+    conn = _open_validation_cache(cache_path)
+    cached = {
+        path: (size, mtime_ns, (bool(ok), fmt, width, height, error))
+        for path, size, mtime_ns, ok, fmt, width, height, error
+        in conn.execute("SELECT * FROM validations")
+    }
+
+    if paths is not None:
+        paths = {os.path.abspath(path) for path in paths}
+
+    rows: List[dict] = []
+    to_check = []
+    for split, species_folder, filename, path in iter_split_images(root):
+        if paths is not None and os.path.abspath(path) not in paths:
+            continue
+        rel_path = os.path.relpath(path, root)
+        stat = os.stat(path)
+        row = {"path": path, "split": split, "species": species_folder}
+        rows.append(row)
+        hit = cached.get(rel_path)
+        if hit is not None and hit[0] == stat.st_size and hit[1] == stat.st_mtime_ns:
+            row["result"] = hit[2]
+        else:
+            to_check.append((row, rel_path, stat))
+
+    print(
+        f"[info] Validating {len(to_check)} images "
+        f"({len(rows) - len(to_check)} unchanged since the last check)..."
+    )
+    if to_check:
+        workers = workers or os.cpu_count() or 1
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(
+                _inspect_image,
+                [row["path"] for row, _, _ in to_check],
+                chunksize=max(1, min(256, len(to_check) // (workers * 4))),
+            )
+            for (row, rel_path, stat), result in zip(to_check, results):
+                row["result"] = result
+                conn.execute(
+                    "INSERT OR REPLACE INTO validations VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (rel_path, stat.st_size, stat.st_mtime_ns, int(result[0]), *result[1:]),
+                )
+        conn.commit()
+
+    quarantined = 0
+    for row in rows:
+        ok, fmt, width, height, error = row.pop("result")
+        row.update(ok=ok, format=fmt, width=width, height=height, error=error)
+        if ok:
+            continue
+        target_dir = os.path.join(quarantine_dir, row["split"], row["species"])
+        os.makedirs(target_dir, exist_ok=True)
+        os.replace(row["path"], os.path.join(target_dir, os.path.basename(row["path"])))
+        conn.execute("DELETE FROM validations WHERE path = ?",
+                     (os.path.relpath(row["path"], root),))
+        quarantined += 1
+        print(f"[warning] Quarantined {row['path']}: {error}")
+    conn.commit()
+    conn.close()
+
+    print(
+        f"[done] Validated {len(rows)} images; {quarantined} quarantined "
+        f"into {quarantine_dir}."
+    )
+    return pd.DataFrame(rows, columns=["path", "split", "species", "ok",
+                                       "format", "width", "height", "error"])
@@ -0,0 +1,172 @@
+"""
+Map GBIF scientific names onto the classes of the app's classifier.
+
+The app (``lib/model.dart``) predicts the classes listed, one per line,
+in ``assets/model/labels.txt``; the line number is the class index it
+reports. GBIF records spell the same taxon in several ways (with or
+without authorship, ``T. Anderson`` vs ``T.Anderson``, ``×`` vs ``x``),
+so :class:`LabelIndex` matches names in four tiers:
+
+1. the label itself, character for character,
+2. the full name after normalizing case, whitespace and the hybrid sign,
+3. the canonical name (genus, hybrid marker, specific epithet and an
+   optional infraspecific rank and epithet) without authorship,
+4. the genus, for genus-level classes such as ``Lithops spp.``.
+
+``labels.txt`` lists a few taxa several times with different
+authorships, and some of them only differ in spelling
+(``(L.) T. Anderson`` and ``(L.) T.Anderson`` are classes 21 and 643).
+Such a class only receives records spelled exactly like its label;
+every other spelling of the name goes to the lowest of those class
+indices, which :attr:`LabelIndex.duplicate_of` records.
+"""
+
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+# Infraspecific rank markers kept in canonical names, with their
+# normalized spelling.
+_RANKS = {
+    "subsp.": "subsp.",
+    "ssp.": "subsp.",
+    "var.": "var.",
+    "subvar.": "subvar.",
+    "f.": "f.",
+    "forma": "f.",
+}
+
+# Specific and infraspecific epithets, e.g. "arvense" or "filix-mas".
+_EPITHET = re.compile(r"[a-z]+(?:-[a-z]+)*")
+
+
+def _full_key(name: str) -> str:
+    """Normalize a full scientific name, authorship included."""
+    name = name.replace("×", " x ").lower()
+    name = re.sub(r"\s+", " ", name).strip()
+    # "T. Anderson" and "T.Anderson" name the same author.
+    return re.sub(r"\.\s+", ".", name)
+
+
+def canonical_name(name: str) -> Optional[str]:
+    """Return the canonical form of a scientific name, without authorship.
+
+    For example ``"Cirsium arvense (L.) Scop."`` becomes
+    ``"cirsium arvense"``, ``"Fragaria × ananassa Duchesne"`` becomes
+    ``"fragaria x ananassa"`` and ``"Acer campestre ssp. leiocarpum Pax"``
+    becomes ``"acer campestre subsp. leiocarpum"``. Returns ``None`` for
+    names without a genus.
+    """
+    if not isinstance(name, str):
+        return None
+    tokens = name.replace("×", " x ").split()
+    parts: List[str] = []
+    i = 0
+    if i < len(tokens) and tokens[i].lower() == "x":
+        parts.append("x")
+        i += 1
+    if i >= len(tokens) or not tokens[i][:1].isalpha():
+        return None
+    parts.append(tokens[i].lower())
+    i += 1
+    if i < len(tokens) and tokens[i] == "x":
+        parts.append("x")
+        i += 1
+    if i < len(tokens) and _EPITHET.fullmatch(tokens[i]):
+        parts.append(tokens[i])
+        i += 1
+        if (i + 1 < len(tokens) and tokens[i].lower() in _RANKS
+                and _EPITHET.fullmatch(tokens[i + 1])):
+            parts.extend([_RANKS[tokens[i].lower()], tokens[i + 1]])
+    return " ".join(parts)
+
+
+def _genus(canonical: str) -> str:
+    """Return the genus of a canonical name, keeping a hybrid marker."""
+    parts = canonical.split()
+    return " ".join(parts[:2]) if parts[0] == "x" else parts[0]
+
+
+class LabelIndex:
+    """Precomputed lookup from scientific names to class indices.
+
+    Parameters
+    ----------
+    labels : list of str
+        Class names in class-index order, as in ``labels.txt``.
+
+    Attributes
+    ----------
+    duplicate_of : list of int
+        For each class, the lower class index whose label has the same
+        normalized full name, or ``-1``. Those classes only match their
+        exact label.
+    """
+
+    def __init__(self, labels: List[str]) -> None:
+        self.labels = list(labels)
+        self.duplicate_of: List[int] = []
+        self._by_label: Dict[str, int] = {}
+        self._by_full: Dict[str, int] = {}
+        self._by_canonical: Dict[str, int] = {}
+        self._by_genus: Dict[str, int] = {}
+        for index, label in enumerate(self.labels):
+            self._by_label.setdefault(label, index)
+            first = self._by_full.setdefault(_full_key(label), index)
+            self.duplicate_of.append(first if first != index else -1)
+            canonical = canonical_name(label)
+            if canonical:
+                self._by_canonical.setdefault(canonical, index)
+                if " " not in canonical:
+                    self._by_genus.setdefault(canonical, index)
+        # Names already looked up; archives repeat the same few
+        # thousand names millions of times.
+        self._cache: Dict[str, int] = {}
+
+    @classmethod
+    def from_file(cls, path: str) -> "LabelIndex":
+        """Load a label file with one class name per line.
+
+        Lines are split as the app splits them, so class ``i`` is line
+        ``i`` of the file.
+        """
+        with open(path, encoding="utf-8-sig") as f:
+            labels = f.read().split("\n")
+        if labels and labels[-1] == "":
+            labels.pop()
+        print(f"[info] Loaded {len(labels)} class labels from {path}.")
+        return cls([label.strip() for label in labels])
+
+    def lookup(self, name: str) -> int:
+        """Return the class index of ``name``, or ``-1`` if it is not a class."""
+        if name in self._cache:
+            return self._cache[name]
+        index = -1
+        if isinstance(name, str):
+            index = self._by_label.get(name.strip(), -1)
+            if index < 0:
+                index = self._by_full.get(_full_key(name), -1)
+            canonical = canonical_name(name)
+            if index < 0 and canonical:
+                index = self._by_canonical.get(canonical, -1)
+            if index < 0 and canonical:
+                index = self._by_genus.get(_genus(canonical), -1)
+        self._cache[name] = index
+        return index
+
+    def match(self, names: pd.Series) -> np.ndarray:
+        """Vectorized :meth:`lookup` over a column of names.
+
+        Every distinct name is looked up once; missing values map to
+        ``-1``.
+        """
+        codes, uniques = pd.factorize(names)
+        indices = np.fromiter((self.lookup(name) for name in uniques),
+                              dtype=np.int64, count=len(uniques))
+        return np.where(codes >= 0, indices[codes] if len(indices) else -1, -1)
+
+    def __len__(self) -> int:
+        return len(self.labels)
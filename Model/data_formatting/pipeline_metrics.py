@@ -0,0 +1,355 @@
+"""
+Instrumentation for the GBIF/Pl@ntNet data preparation pipeline.
+
+``format_gbif_data.py`` wraps each stage of ``main()`` in
+:meth:`PipelineMetrics.stage` to record its wall time, rows in/out and
+memory use, feeds download sizes and per-host latencies
+into the same object, and writes everything as one JSON report at the
+end of the run. :class:`ProgressReporter` replaces per-row output with
+a periodic aggregated progress line. cProfile and tracemalloc can be
+switched on for a run without changing the stages.
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import platform
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterator, List, Optional, Sequence
+
+try:
+    import resource
+except ImportError:  # Not available on Windows.
+    resource = None
+
+
+# Upper bounds (in milliseconds) of the download latency histogram buckets.
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+PROFILERS = ["cprofile", "tracemalloc"]
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Return the peak resident set size of this process so far, in megabytes.
+
+    This is a lifetime high-water mark: it never goes down, so it only
+    reflects the stage that set it. Returns ``None`` on platforms
+    without the ``resource`` module.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def current_rss_mb() -> Optional[float]:
+    """Return the current resident set size of this process in megabytes.
+
+    Read from ``/proc/self/statm``; returns ``None`` where it does not
+    exist (macOS, Windows).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+
+def _round_mb(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value, 1)
+
+
+class _RssSampler:
+    """Track the highest resident set size while a block runs.
+
+    A daemon thread reads :func:`current_rss_mb` every ``interval``
+    seconds, so a spike shorter than the interval can be missed. The
+    peak stays ``None`` where the current RSS cannot be read.
+    """
+
+    def __init__(self, interval: float = 0.01) -> None:
+        self.interval = interval
+        self.peak = current_rss_mb()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self) -> "_RssSampler":
+        if self.peak is not None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._sample()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self) -> None:
+        rss = current_rss_mb()
+        if rss is not None and rss > self.peak:
+            self.peak = rss
+
+
+@dataclass
+class StageMetrics:
+    """Measurements of one pipeline stage.
+
+    ``rss_start_mb`` and ``rss_end_mb`` are the resident set size when
+    the stage starts and ends, and ``peak_rss_mb`` the highest resident
+    set size sampled while it ran. ``process_peak_rss_mb`` is the process
+    peak so far, and ``peak_growth_mb`` how far this stage pushed that
+    peak above both the earlier peak and its own starting RSS (``0``
+    if it stayed below them). ``python_peak_mb`` is the tracemalloc
+    peak of the stage alone, if tracing is on.
+    """
+
+    name: str
+    rows_in: Optional[int] = None
+    rows_out: Optional[int] = None
+    seconds: float = 0.0
+    rss_start_mb: Optional[float] = None
+    rss_end_mb: Optional[float] = None
+    peak_rss_mb: Optional[float] = None
+    process_peak_rss_mb: Optional[float] = None
+    peak_growth_mb: Optional[float] = None
+    python_peak_mb: Optional[float] = None
+    extra: Dict[str, object] = field(default_factory=dict)
+
+
+class LatencyHistogram:
+    """Fixed-bucket histogram of request latencies for one host."""
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, seconds: float) -> None:
+        ms = seconds * 1000.0
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS_MS) and ms > LATENCY_BUCKETS_MS[bucket]:
+            bucket += 1
+        self.counts[bucket] += 1
+        self.total += 1
+        self.sum_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile_ms(self, q: float) -> Optional[float]:
+        """Upper bound of the bucket holding quantile ``q``."""
+        if not self.total:
+            return None
+        target = q * self.total
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS_MS, self.counts):
+            seen += count
+            if seen >= target:
+                return round(min(bound, self.max_ms), 1)
+        return round(self.max_ms, 1)
+
+    def to_dict(self) -> dict:
+        labels = [f"<={bound}" for bound in LATENCY_BUCKETS_MS] + [f">{LATENCY_BUCKETS_MS[-1]}"]
+        return {
+            "count": self.total,
+            "mean_ms": round(self.sum_ms / self.total, 1) if self.total else None,
+            "p50_ms": self.quantile_ms(0.50),
+            "p95_ms": self.quantile_ms(0.95),
+            "p99_ms": self.quantile_ms(0.99),
+            "max_ms": round(self.max_ms, 1),
+            "buckets": dict(zip(labels, self.counts)),
+        }
+
+
+class ProgressReporter:
+    """Print one aggregated progress line at most every ``interval`` seconds.
+
+    Parameters
+    ----------
+    label : str
+        Name shown at the start of each line, e.g. ``"download"``.
+    total : int
+        Number of items the stage will process.
+    interval : float, optional
+        Minimum number of seconds between two lines. The default is 10.
+    """
+
+    def __init__(self, label: str, total: int, interval: float = 10.0) -> None:
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.num_bytes = 0
+        self._start = time.perf_counter()
+        self._last = self._start
+        self._last_finished = -1
+
+    def update(self, done: int = 0, failed: int = 0, num_bytes: int = 0) -> None:
+        self.done += done
+        self.failed += failed
+        self.num_bytes += num_bytes
+        now = time.perf_counter()
+        if now - self._last >= self.interval:
+            self._last = now
+            self.print_line()
+
+    def finish(self) -> None:
+        """Print the final line unless it was just printed."""
+        if self.total and self.done + self.failed != self._last_finished:
+            self.print_line()
+
+    def print_line(self) -> None:
+        elapsed = max(time.perf_counter() - self._start, 1e-9)
+        finished = self.done + self.failed
+        self._last_finished = finished
+        rate = finished / elapsed
+        percent = 100.0 * finished / self.total if self.total else 100.0
+        eta = (self.total - finished) / rate if rate > 0 else float("inf")
+        print(
+            f"[progress] {self.label} {finished}/{self.total} ({percent:.1f}%) "
+            f"{rate:.1f}/s, {self.num_bytes / 1e6:.1f} MB, {self.failed} failed, "
+            f"eta {eta:.0f}s"
+        )
+
+
+class PipelineMetrics:
+    """Collect per-stage metrics and write them as a JSON report.
+
+    Parameters
+    ----------
+    profile : sequence of str, optional
+        Profilers to run for the lifetime of the object, any of
+        ``"cprofile"`` and ``"tracemalloc"``.
+    profile_path : str, optional
+        File the raw cProfile statistics are dumped to (readable with
+        :mod:`pstats` or snakeviz). Only used with ``"cprofile"``.
+    """
+
+    def __init__(self,
+                 profile: Sequence[str] = (),
+                 profile_path: Optional[str] = None,
+                ) -> None:
+        unknown = set(profile).difference(PROFILERS)
+        if unknown:
+            raise ValueError(f"Unknown profilers: {sorted(unknown)}. Choose from {PROFILERS}.")
+        self.stages: List[StageMetrics] = []
+        self.latency: Dict[str, LatencyHistogram] = {}
+        self.bytes_downloaded = 0
+        self.images_downloaded = 0
+        self.profile_path = profile_path
+        self._start = time.perf_counter()
+        self._profiler = None
+        self._top_allocations: List[dict] = []
+        self._top_functions: Optional[str] = None
+
+        if "tracemalloc" in profile and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if "cprofile" in profile:
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+
+    @contextmanager
+    def stage(self, name: str, rows_in: Optional[int] = None) -> Iterator[StageMetrics]:
+        """Time the enclosed block as stage ``name``.
+
+        The caller sets ``rows_out`` (and optionally ``extra``) on the
+        yielded :class:`StageMetrics`. The stage is recorded even if the
+        block raises.
+        """
+        metrics = StageMetrics(name=name, rows_in=rows_in)
+        rss_start = current_rss_mb()
+        peak_before = peak_rss_mb()
+        metrics.rss_start_mb = _round_mb(rss_start)
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        sampler = _RssSampler()
+        try:
+            with sampler:
+                yield metrics
+        finally:
+            metrics.seconds = round(time.perf_counter() - start, 4)
+            metrics.rss_end_mb = _round_mb(current_rss_mb())
+            metrics.peak_rss_mb = _round_mb(sampler.peak)
+            peak_after = peak_rss_mb()
+            metrics.process_peak_rss_mb = _round_mb(peak_after)
+            if peak_after is not None:
+                baseline = max(peak_before, rss_start or 0.0)
+                metrics.peak_growth_mb = round(max(0.0, peak_after - baseline), 1)
+            if tracemalloc.is_tracing():
+                metrics.python_peak_mb = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1)
+            self.stages.append(metrics)
+            rows = "" if metrics.rows_out is None else f", {metrics.rows_out} rows out"
+            print(f"[metrics] {name} took {metrics.seconds:.2f}s{rows}.")
+
+    def observe_download(self, host: str, seconds: float, ok: bool, num_bytes: int = 0) -> None:
+        """Record the latency and outcome of one request to ``host``."""
+        self.latency.setdefault(host, LatencyHistogram()).observe(seconds)
+        self.images_downloaded += ok
+        self.bytes_downloaded += num_bytes
+
+    def _stop_profilers(self) -> None:
+        if tracemalloc.is_tracing():
+            snapshot = tracemalloc.take_snapshot()
+            self._top_allocations = [
+                {"location": str(stat.traceback), "size_mb": round(stat.size / 2 ** 20, 2),
+                 "count": stat.count}
+                for stat in snapshot.statistics("lineno")[:15]
+            ]
+            tracemalloc.stop()
+        if self._profiler is not None:
+            self._profiler.disable()
+            if self.profile_path:
+                self._profiler.dump_stats(self.profile_path)
+            buffer = io.StringIO()
+            pstats.Stats(self._profiler, stream=buffer).sort_stats("cumulative").print_stats(25)
+            self._top_functions = buffer.getvalue()
+            self._profiler = None
+
+    def report(self) -> dict:
+        """Stop any profilers and return the metrics as a JSON-ready dict."""
+        self._stop_profilers()
+        report = {
+            "run": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "cpu_count": os.cpu_count(),
+                "seconds": round(time.perf_counter() - self._start, 4),
+                "peak_rss_mb": peak_rss_mb(),
+            },
+            "stages": [asdict(stage) for stage in self.stages],
+            "downloads": {
+                "images": self.images_downloaded,
+                "bytes": self.bytes_downloaded,
+                "latency_by_host": {host: hist.to_dict()
+                                    for host, hist in sorted(self.latency.items())},
+            },
+        }
+        if self._top_allocations:
+            report["top_allocations"] = self._top_allocations
+        return report
+
+    def write_report(self, path: str) -> dict:
+        """Write :meth:`report` to ``path`` as JSON and return it."""
+        report = self.report()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        if self._top_functions:
+            print(self._top_functions)
+        print(f"[done] Wrote metrics report to {path}.")
+        return report
@@ -0,0 +1,196 @@
+"""
+Memoize the DataFrame stages of the GBIF/Pl@ntNet data preparation pipeline.
+
+``format_gbif_data.py`` describes its table stages (load, filter,
+select, split) as a chain of :class:`Stage` objects and runs them with
+:func:`run_stages`. The key of every stage is a hash of its own
+parameters and the key of the stage before it, and the chain starts
+from a fingerprint of the source files, so a key changes exactly when
+some input of the stage changes. Results are pickled into a
+:class:`StageCache`, a directory bounded in size that evicts the least
+recently used entries. A rerun starts from the last stage whose result
+is cached, without touching the stages before it.
+"""
+
+import os
+import json
+import hashlib
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+
+from pipeline_metrics import PipelineMetrics
+
+
+# Bump when a stage starts producing different results for the same
+# inputs, so stale entries are no longer found.
+STAGE_CACHE_VERSION = 2
+
+
+def stage_key(name: str, params: dict, parent: Optional[str] = None) -> str:
+    """Hash a stage name, its JSON-serializable parameters and its parent key."""
+    payload = json.dumps(
+        {"stage": name, "params": params, "parent": parent, "version": STAGE_CACHE_VERSION},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class StageCache:
+    """Directory of pickled stage results with least-recently-used eviction.
+
+    Every entry is one ``<stage>-<key>.pkl`` file. Reading an entry
+    updates its modification time, which serves as the recency for
+    eviction; after each write the oldest entries are deleted until the
+    directory fits in ``max_bytes``.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory holding the entries. Created if missing.
+    max_bytes : int
+        Size limit of the directory in bytes. The entry just written is
+        kept even if it alone exceeds the limit.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, name: str, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{name}-{key}.pkl")
+
+    def contains(self, name: str, key: str) -> bool:
+        return os.path.exists(self._path(name, key))
+
+    def get(self, name: str, key: str) -> Optional[pd.DataFrame]:
+        """Return the cached result of stage ``name`` under ``key``, if any."""
+        path = self._path(name, key)
+        try:
+            result = pd.read_pickle(path)
+        except FileNotFoundError:
+            return None
+        except Exception as exc:  # noqa: BLE001
+            print(f"[warning] Discarding unreadable stage cache entry {path}: {exc}")
+            os.remove(path)
+            return None
+        os.utime(path)
+        return result
+
+    def put(self, name: str, key: str, result: pd.DataFrame) -> None:
+        """Store ``result`` and evict old entries beyond the size limit."""
+        path = self._path(name, key)
+        result.to_pickle(path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self.evict(keep=path)
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """Delete least recently used entries until the cache fits; return the count."""
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".pkl"):
+                continue
+            path = os.path.join(self.cache_dir, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            total -= size
+            evicted += 1
+        if evicted:
+            print(f"[cache] Evicted {evicted} stage results to stay under "
+                  f"{self.max_bytes / 2 ** 20:.0f} MB.")
+        return evicted
+
+
+@dataclass
+class Stage:
+    """One table stage of the pipeline.
+
+    ``run`` receives the result of the previous stage (``None`` for the
+    first one) and returns this stage's result. ``params`` lists every
+    input of the stage other than that result; for the first stage it
+    must include a fingerprint of the source data.
+    """
+
+    name: str
+    run: Callable[[Optional[pd.DataFrame]], pd.DataFrame]
+    params: Dict[str, object] = field(default_factory=dict)
+
+
+def run_stages(stages: List[Stage],
+               cache: Optional[StageCache] = None,
+               metrics: Optional[PipelineMetrics] = None,
+              ) -> Dict[str, pd.DataFrame]:
+    """Run a chain of stages, resuming from the last cached result.
+
+    Parameters
+    ----------
+    stages : list of Stage
+        Stages in execution order.
+    cache : StageCache, optional
+        Where results are looked up and stored. Without a cache every
+        stage runs.
+    metrics : PipelineMetrics, optional
+        Collector in which every stage that runs or is read from the
+        cache is recorded (cached ones with ``extra["cached"]``).
+
+    Returns
+    -------
+    dict
+        Result of every stage from the resumed one on, by stage name.
+        Stages before the last cached one are neither run nor loaded
+        and are missing from the dict.
+    """
+    keys = []
+    parent = None
+    for stage in stages:
+        parent = stage_key(stage.name, stage.params, parent)
+        keys.append(parent)
+
+    def record_stage(name: str, rows_in: Optional[int]):
+        return metrics.stage(name, rows_in=rows_in) if metrics else nullcontext()
+
+    results: Dict[str, pd.DataFrame] = {}
+    previous = None
+    start = 0
+    if cache is not None:
+        for i in range(len(stages) - 1, -1, -1):
+            if not cache.contains(stages[i].name, keys[i]):
+                continue
+            with record_stage(stages[i].name, None) as record:
+                cached = cache.get(stages[i].name, keys[i])
+                if cached is not None:
+                    print(f"[cache] Reusing the {stages[i].name} result ({len(cached)} rows).")
+                if record is not None and cached is not None:
+                    record.rows_out = len(cached)
+                    record.extra["cached"] = True
+            if cached is not None:
+                results[stages[i].name] = previous = cached
+                start = i + 1
+                break
+
+    for stage, key in zip(stages[start:], keys[start:]):
+        rows_in = None if previous is None else len(previous)
+        with record_stage(stage.name, rows_in) as record:
+            result = stage.run(previous)
+            if record is not None:
+                record.rows_out = len(result)
+        if cache is not None:
+            cache.put(stage.name, key, result)
+        results[stage.name] = previous = result
+    return results